@@ -0,0 +1,6 @@
+# Shared runtime helpers for the Anima python scripts.
+#
+# Scripts put the repository root on sys.path and import what they need from here instead of each parsing
+# ~/.anima/config.txt and building their own tool paths.
+
+from animaRuntime.executables import tools
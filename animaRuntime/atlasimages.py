@@ -0,0 +1,107 @@
+# Registered images of anatomical atlases
+# Paths of the transforms of each image and resampling of the images onto the reference, shared by the merge
+# (atlasing/anatomical/animaAnatomicalMergeImages.py) and reduce (animaAnatomicalReduceImages.py) scripts so that a
+# reduced average is the one the merge would have computed.
+
+import os
+
+from animaRuntime.executables import tools
+from animaRuntime.execution import call
+
+inverseResidualPath = os.path.join("residualDir", "sumNonlinear_inv_tr.nrrd")
+
+
+class AtlasImages(object):
+    """Images <prefixBase>/<prefix>_<n><filesExtension> of an atlas and their transforms in tempDir, resampled on
+    refImage. numIter is the iteration number given to the merge (0 for the first iteration, where image 1 is the
+    reference and is not registered)"""
+
+    def __init__(self, prefixBase, prefix, filesExtension, refImage, numIter):
+        self.prefixBase = prefixBase
+        self.prefix = prefix
+        self.filesExtension = filesExtension
+        self.refImage = refImage
+        self.numIter = numIter
+
+    def is_reference(self, a):
+        """Whether image a is the unregistered reference of the first iteration"""
+        return a == 1 and self.numIter == 0
+
+    def image_path(self, a):
+        return os.path.join(self.prefixBase, self.prefix + "_" + str(a) + self.filesExtension)
+
+    def linear_path(self, a):
+        return os.path.join("tempDir", self.prefix + "_" + str(a) + "_linear_tr.txt")
+
+    def nonlinear_path(self, a):
+        return os.path.join("tempDir", self.prefix + "_" + str(a) + "_nonlinear_tr.nrrd")
+
+    def resampled_path(self, a):
+        return os.path.join("tempDir", self.prefix + "_" + str(a) + "_at.nrrd")
+
+    def mask_path(self, a):
+        """Resampled mask of image a, None if the image has no mask"""
+        if not os.path.exists(os.path.join("Masks", "Mask_" + str(a) + self.filesExtension)):
+            return None
+
+        return os.path.join("tempDir", "Mask_" + str(a) + "_at.nrrd")
+
+    def write_reference_transforms(self):
+        """Writes the identity linear and zero nonlinear transforms of the reference of the first iteration"""
+        myfile = open(self.linear_path(1),"w")
+        myfile.write("#Insight Transform File V1.0\n")
+        myfile.write("# Transform 0\n")
+        myfile.write("Transform: AffineTransform_double_3_3\n")
+        myfile.write("Parameters: 1 0 0 0 1 0 0 0 1 0 0 0\n")
+        myfile.write("FixedParameters: 0 0 0\n")
+        myfile.close()
+
+        command = [tools.animaCreateImage,"-o",self.nonlinear_path(1),
+                   "-b","0","-g",self.image_path(1),"-v","3"]
+        call(command)
+
+    def transforms(self, a, residual=True):
+        """Transform serie of image a onto the reference, followed by the residual correction (inverse of the mean
+        nonlinear transform) if residual is True"""
+        serie = []
+        if not self.is_reference(a):
+            serie += [self.linear_path(a), self.nonlinear_path(a)]
+        if residual is True:
+            serie.append(inverseResidualPath)
+
+        return serie
+
+    def resample(self, a, transforms, threads):
+        """Resamples image a and its mask on the reference image with the transform serie given by transforms. Returns
+        the resampled image and mask (None without mask). Without transform (the reference of the first iteration is
+        already on the reference grid), the image and its mask are only converted, without interpolation"""
+        if len(transforms) == 0:
+            command = [tools.animaConvertImage, "-i", self.image_path(a), "-o", self.resampled_path(a)]
+            call(command)
+
+            if self.mask_path(a) is not None:
+                command = [tools.animaConvertImage, "-i", os.path.join("Masks", "Mask_" + str(a) + self.filesExtension),
+                           "-o", self.mask_path(a)]
+                call(command)
+
+            return self.resampled_path(a), self.mask_path(a)
+
+        command = [tools.animaTransformSerieXmlGenerator]
+        for transform in transforms:
+            command += ["-i", transform]
+        command += ["-o", os.path.join("tempDir", "trsf_" + str(a) + ".xml")]
+        call(command)
+
+        command = [tools.animaApplyTransformSerie, "-i", self.image_path(a),
+                   "-t", os.path.join("tempDir", "trsf_" + str(a) + ".xml"), "-g", self.refImage,
+                   "-o", self.resampled_path(a), "-p", str(threads)]
+        call(command)
+
+        if self.mask_path(a) is not None:
+            command = [tools.animaApplyTransformSerie, "-i",
+                       os.path.join("Masks", "Mask_" + str(a) + self.filesExtension),
+                       "-t", os.path.join("tempDir", "trsf_" + str(a) + ".xml"),
+                       "-g", self.refImage, "-o", self.mask_path(a), "-n", "nearest", "-p", str(threads)]
+            call(command)
+
+        return self.resampled_path(a), self.mask_path(a)
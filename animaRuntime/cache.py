@@ -0,0 +1,303 @@
+# Content-addressed cache of Anima tool results
+# Opt-in: enabled when a cache folder is configured (ANIMA_CACHE_DIR environment variable or cache-dir in the config
+# file). An invocation is identified by the tool (and its build), its non file arguments, the contents of its input
+# files and the names of its outputs. When the same invocation was already run successfully, its outputs are restored
+# from the cache instead of running the tool again.
+# Outputs are stored by hardlink when possible. They are restored by copy, since two restored outputs sharing their
+# data would both be modified by a tool writing one of them in place. Restoring by hardlink can be enabled
+# (ANIMA_CACHE_LINK=1 or cache-link = 1) when pipelines never overwrite their outputs. Cached files modified through a
+# hardlink are detected (size and mtime) and their entry is dropped.
+# The cache size is bounded (ANIMA_CACHE_SIZE or cache-size, in GB, 50 by default), least recently used entries being
+# evicted first.
+#
+# Outputs are the arguments following -o, -O or --out-* flags and the file arguments that do not exist before the
+# call, along with the files the tool writes next to them with the same name and another extension (e.g. detached
+# headers, .hdr/.img) or in a folder with that name. When the argument is a prefix rather than a file (e.g.
+# animaMCMEstimator -o prefix writes prefix.mcm, prefix_aic.nrrd...), the files named prefix_* are outputs too. Other
+# files of the output folders, possibly written by concurrent jobs, are never stored. Commands with folder arguments are
+# never cached since their outputs cannot be told apart.
+# Some inputs point to other files by path: transform series (.xml), multi-compartment model headers (.mcm) and image
+# lists (.txt, e.g. animaAverageImages -i). The files they reference (found relative to the current folder or to the
+# referencing file) are part of the key, recursively, so that regenerating them invalidates the entry. Commands whose
+# .xml or .mcm inputs cannot be parsed are not cached.
+
+import hashlib
+import json
+import os
+import shutil
+import xml.etree.ElementTree as ElementTree
+
+from animaRuntime import config, graph
+
+_digests = {}
+# Extensions of the inputs referencing other files
+_referencingExtensions = [".xml", ".mcm", ".txt"]
+_maxReferenceDepth = 4
+
+
+def cache_dir():
+    """Folder of the cache, empty if caching is disabled"""
+    if "ANIMA_CACHE_DIR" in os.environ:
+        return os.environ["ANIMA_CACHE_DIR"]
+
+    return config.get("cache-dir", "")
+
+
+def max_size():
+    """Maximal size of the cache in bytes"""
+    if "ANIMA_CACHE_SIZE" in os.environ:
+        return int(float(os.environ["ANIMA_CACHE_SIZE"]) * 1024 ** 3)
+
+    return int(float(config.get("cache-size", "50")) * 1024 ** 3)
+
+
+def link_restored():
+    """Tells if cached outputs are restored by hardlink rather than copied"""
+    if "ANIMA_CACHE_LINK" in os.environ:
+        return os.environ["ANIMA_CACHE_LINK"] == "1"
+
+    return config.get("cache-link", "0") == "1"
+
+
+def _file_digest(path):
+    fileStat = os.stat(path)
+    memoKey = (os.path.abspath(path), fileStat.st_size, fileStat.st_mtime_ns)
+    if memoKey not in _digests:
+        fileHash = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                fileHash.update(block)
+
+        _digests[memoKey] = fileHash.hexdigest()
+
+    return _digests[memoKey]
+
+
+def _referenced_files(path):
+    """Existing files referenced by path (a transform serie, MCM header or image list). Raises ValueError when an
+    XML file cannot be parsed"""
+    if path.endswith(".txt"):
+        with open(path, errors="replace") as listFile:
+            candidates = [line.strip() for line in listFile]
+    else:
+        try:
+            candidates = [(element.text or "").strip() for element in ElementTree.parse(path).iter()]
+        except ElementTree.ParseError as error:
+            raise ValueError("cannot parse " + path + ": " + str(error))
+
+    files = []
+    for candidate in candidates:
+        if candidate == "" or "\n" in candidate:
+            continue
+
+        for referencedPath in [candidate, os.path.join(os.path.dirname(path), candidate)]:
+            if os.path.isfile(referencedPath):
+                files.append(referencedPath)
+                break
+
+    return files
+
+
+def _input_digest(path, depth=0):
+    """Digest of an input file and of the files it references"""
+    digest = _file_digest(path)
+    if depth >= _maxReferenceDepth or os.path.splitext(path)[1] not in _referencingExtensions:
+        return digest
+
+    inputHash = hashlib.sha256(digest.encode())
+    for referencedPath in _referenced_files(path):
+        inputHash.update(("\0" + _input_digest(referencedPath, depth + 1)).encode())
+
+    return inputHash.hexdigest()
+
+
+def _stem(path):
+    name = os.path.basename(path)
+    if name.endswith(".nii.gz"):
+        return name[:-7]
+
+    return os.path.splitext(name)[0]
+
+
+def lookup(command):
+    """Computes the cache key of command (list of strings). Returns None if it cannot be cached, or a dict with the
+    key and the indexes of its output arguments"""
+    if cache_dir() == "" or not os.path.basename(command[0]).startswith("anima") or not os.path.isfile(command[0]):
+        return None
+
+    toolStat = os.stat(command[0])
+    keyHash = hashlib.sha256()
+    keyHash.update((os.path.basename(command[0]) + "\0" + str(toolStat.st_size) + "\0" +
+                    str(toolStat.st_mtime_ns) + "\0").encode())
+
+    outputs = []
+    for i in range(1, len(command)):
+        arg = command[i]
+        if os.path.isdir(arg):
+            return None
+
+        previous = command[i - 1]
+        if graph.is_path(arg) and (previous in graph.outputFlags or previous.startswith(graph.outputFlagsPrefix)):
+            outputs.append(i)
+            token = "out:" + os.path.basename(arg)
+        elif os.path.isfile(arg):
+            try:
+                token = "in:" + _input_digest(arg)
+            except ValueError:
+                return None
+        elif graph.is_path(arg):
+            outputs.append(i)
+            token = "out:" + os.path.basename(arg)
+        else:
+            token = "arg:" + arg
+
+        keyHash.update((token + "\0").encode())
+
+    if len(outputs) == 0:
+        return None
+
+    return {"key": keyHash.hexdigest(), "outputs": outputs}
+
+
+def _link_or_copy(source, destination):
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+def _written_outputs(command, outputs, startTime):
+    """(argument index, suffix, path) of the files written by the tool for each of its output arguments"""
+    files = []
+    seen = set()
+    for i in outputs:
+        folder = os.path.dirname(command[i]) or "."
+        stem = _stem(command[i])
+        if not os.path.isdir(folder):
+            continue
+
+        # Files named stem_* are only outputs of prefix arguments: they may be written by other jobs otherwise
+        isPrefix = not os.path.isfile(command[i])
+        for dirEntry in os.scandir(folder):
+            name = dirEntry.name
+            if not (name == stem or name.startswith(stem + ".") or (isPrefix and name.startswith(stem + "_"))):
+                continue
+
+            if dirEntry.is_dir():
+                candidates = [os.path.join(root, f) for root, _, names in os.walk(dirEntry.path) for f in names]
+            else:
+                candidates = [dirEntry.path]
+
+            for path in candidates:
+                realPath = os.path.realpath(path)
+                # Some file systems only keep mtime to the second
+                if realPath in seen or not os.path.isfile(path) or os.stat(path).st_mtime < int(startTime):
+                    continue
+
+                seen.add(realPath)
+                files.append((i, os.path.relpath(path, folder)[len(stem):], path))
+
+    return files
+
+
+def store(entry, command, startTime):
+    """Stores the outputs written by a successful run of command"""
+    files = _written_outputs(command, entry["outputs"], startTime)
+    if len(files) == 0:
+        return
+
+    entryDir = os.path.join(cache_dir(), entry["key"])
+    if os.path.exists(entryDir):
+        return
+
+    tmpEntryDir = entryDir + ".tmp" + str(os.getpid())
+    os.makedirs(tmpEntryDir, exist_ok=True)
+    meta = {"tool": os.path.basename(command[0]), "files": [], "size": 0}
+    for n, (i, suffix, path) in enumerate(files):
+        cachedPath = os.path.join(tmpEntryDir, str(n))
+        _link_or_copy(path, cachedPath)
+        # Size and mtime of the cached file tell if it was modified afterwards through a hardlink
+        cachedStat = os.stat(cachedPath)
+        meta["files"].append({"arg": i, "suffix": suffix, "file": str(n), "size": cachedStat.st_size,
+                              "mtime": cachedStat.st_mtime_ns})
+        meta["size"] += cachedStat.st_size
+
+    with open(os.path.join(tmpEntryDir, "meta.json"), "w") as metaFile:
+        json.dump(meta, metaFile)
+
+    try:
+        os.rename(tmpEntryDir, entryDir)
+    except OSError:
+        # Stored concurrently by another job
+        shutil.rmtree(tmpEntryDir, ignore_errors=True)
+
+    evict()
+
+
+def restore(entry, command):
+    """Restores the cached outputs of command. Returns the restored files, None if not in the cache"""
+    entryDir = os.path.join(cache_dir(), entry["key"])
+    metaFilePath = os.path.join(entryDir, "meta.json")
+    try:
+        with open(metaFilePath) as metaFile:
+            meta = json.load(metaFile)
+    except (OSError, ValueError):
+        return None
+
+    restored = []
+    try:
+        for cachedFile in meta["files"]:
+            cachedStat = os.stat(os.path.join(entryDir, cachedFile["file"]))
+            if cachedStat.st_size != cachedFile["size"] or cachedStat.st_mtime_ns != cachedFile["mtime"]:
+                shutil.rmtree(entryDir, ignore_errors=True)
+                return None
+
+        for cachedFile in meta["files"]:
+            arg = command[cachedFile["arg"]]
+            destination = os.path.join(os.path.dirname(arg), _stem(arg) + cachedFile["suffix"])
+            if os.path.dirname(destination) != "":
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+
+            if os.path.lexists(destination):
+                os.remove(destination)
+
+            if link_restored():
+                _link_or_copy(os.path.join(entryDir, cachedFile["file"]), destination)
+            else:
+                shutil.copy2(os.path.join(entryDir, cachedFile["file"]), destination)
+            restored.append(destination)
+
+        # The meta file modification time is the last use of the entry
+        os.utime(metaFilePath)
+    except OSError:
+        # Entry evicted concurrently, the tool is run instead
+        return None
+
+    return restored
+
+
+def evict():
+    """Removes least recently used entries until the cache fits in its maximal size"""
+    entries = []
+    totalSize = 0
+    for dirEntry in os.scandir(cache_dir()):
+        metaFilePath = os.path.join(dirEntry.path, "meta.json")
+        if ".tmp" in dirEntry.name or not os.path.isfile(metaFilePath):
+            continue
+
+        try:
+            with open(metaFilePath) as metaFile:
+                size = json.load(metaFile)["size"]
+            entries.append((os.stat(metaFilePath).st_mtime, size, dirEntry.path))
+        except (OSError, ValueError):
+            continue
+
+        totalSize += size
+
+    maxSize = max_size()
+    for _, size, entryDir in sorted(entries):
+        if totalSize <= maxSize:
+            break
+
+        shutil.rmtree(entryDir, ignore_errors=True)
+        totalSize -= size
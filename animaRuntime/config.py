@@ -0,0 +1,52 @@
+# Access to the Anima scripts configuration file (~/.anima/config.txt, see configure.py)
+# The file is parsed once, on first access, and shared by everything imported in the same interpreter.
+
+import os
+import sys
+
+if sys.version_info[0] > 2:
+    import configparser as ConfParser
+else:
+    import ConfigParser as ConfParser
+
+configFilePath = os.path.join(os.path.expanduser("~"), ".anima", "config.txt")
+configSection = "anima-scripts"
+
+_configParser = None
+
+
+def get_parser():
+    """Returns the configuration parser, reading the configuration file on first call"""
+    global _configParser
+    if _configParser is None:
+        if not os.path.exists(configFilePath):
+            sys.exit('Please create a configuration file for Anima python scripts. Refer to the README')
+
+        _configParser = ConfParser.RawConfigParser()
+        _configParser.read(configFilePath)
+
+    return _configParser
+
+
+def get(option, default=None):
+    """Returns an option of the anima-scripts section, or default if given and the option is not set"""
+    configParser = get_parser()
+    if default is not None and not configParser.has_option(configSection, option):
+        return default
+
+    return configParser.get(configSection, option)
+
+
+def anima_dir():
+    """Anima executables folder"""
+    return get("anima")
+
+
+def scripts_public_dir():
+    """Anima scripts public root folder"""
+    return get("anima-scripts-public-root")
+
+
+def extra_data_dir():
+    """Anima scripts data folder (atlases, templates...)"""
+    return get("extra-data-root")
@@ -0,0 +1,118 @@
+# Convergence of iterative atlas construction
+# After each iteration, merge scripts measure how much the template still moves: the norm of the mean nonlinear
+# transform of the images towards it (residualDir/sumNonlinear_tr, in mm) and the relative change of the average since
+# the previous iteration (log-Euclidean for tensor averages). Metrics are appended to convergence.txt in the atlas
+# folder. Once they are below the tolerances given to the builder, the merge creates the file converged (holding the
+# iteration number): jobs of the following iterations then exit right away and the builder does not submit any more
+# iterations when run again.
+
+import os
+
+from animaRuntime import imageio
+from animaRuntime.lazy import lazy_import
+
+np = lazy_import("numpy")
+
+metricsFileName = "convergence.txt"
+convergedFileName = "converged"
+
+
+def displacement_norm(fieldPath):
+    """Root mean square and maximum of the vector norm of a (velocity or displacement) field image"""
+    sumSquares = 0.0
+    maxNorm = 0.0
+    with imageio.ImageReader(fieldPath) as reader:
+        for start, stop in reader.slabs():
+            squares = np.sum(reader.read_values(start, stop) ** 2, axis=1)
+            sumSquares += float(np.sum(squares))
+            maxNorm = max(maxNorm, float(np.sqrt(np.max(squares))))
+
+        return float(np.sqrt(sumSquares / reader.numVoxels)), maxNorm
+
+
+def _tensor_log(values):
+    """Matrix logarithms of tensors in Anima vector representation (xx, xy, yy, xz, yz, zz), in the same representation
+    with off diagonal terms weighted by sqrt(2) so that euclidean norms of vectors are Frobenius norms of matrices"""
+    matrices = values[:, [0, 1, 3, 1, 2, 4, 3, 4, 5]].reshape(-1, 3, 3)
+    eigenValues, eigenVectors = np.linalg.eigh(matrices)
+    logs = np.einsum("nij,nj,nkj->nik", eigenVectors, np.log(np.maximum(eigenValues, 1.0e-12)), eigenVectors)
+    offDiagonal = np.sqrt(2.0)
+    return np.stack([logs[:, 0, 0], offDiagonal * logs[:, 0, 1], logs[:, 1, 1], offDiagonal * logs[:, 0, 2],
+                     offDiagonal * logs[:, 1, 2], logs[:, 2, 2]], axis=1)
+
+
+def relative_change(path, previousPath, logEuclidean=False):
+    """Norm of the difference between two images on the same grid, relative to the norm of previousPath. With
+    logEuclidean, images are tensor images compared on the logarithms of the tensors, where both are positive definite"""
+    sumDifferences = 0.0
+    sumPrevious = 0.0
+    with imageio.ImageReader(path) as reader, imageio.ImageReader(previousPath) as previousReader:
+        if reader.numVoxels != previousReader.numVoxels or reader.components != previousReader.components:
+            raise ValueError("image " + path + " does not have the same size as " + previousPath)
+
+        for start, stop in reader.slabs():
+            values = reader.read_values(start, stop)
+            previousValues = previousReader.read_values(start, stop)
+            if logEuclidean:
+                traces = values[:, 0] + values[:, 2] + values[:, 5]
+                previousTraces = previousValues[:, 0] + previousValues[:, 2] + previousValues[:, 5]
+                inside = (traces > 0) & (previousTraces > 0)
+                values = _tensor_log(values[inside])
+                previousValues = _tensor_log(previousValues[inside])
+
+            sumDifferences += float(np.sum((values - previousValues) ** 2))
+            sumPrevious += float(np.sum(previousValues ** 2))
+
+    if sumPrevious == 0:
+        return float("inf") if sumDifferences > 0 else 0.0
+
+    return float(np.sqrt(sumDifferences / sumPrevious))
+
+
+def record(iteration, displacementRms, displacementMax, change):
+    """Appends the metrics of an iteration to the metrics file of the current (atlas) folder. change is None for
+    iterations without previous average"""
+    newFile = not os.path.exists(metricsFileName)
+    with open(metricsFileName, "a") as metricsFile:
+        if newFile:
+            metricsFile.write("# iteration displacementRms(mm) displacementMax(mm) relativeChange\n")
+        metricsFile.write(str(iteration) + " " + "%.6g" % displacementRms + " " + "%.6g" % displacementMax + " " +
+                          ("%.6g" % change if change is not None else "nan") + "\n")
+
+    print("Iteration " + str(iteration) + ": mean displacement " + "%.4g" % displacementRms + " mm (max " +
+          "%.4g" % displacementMax + " mm), relative change of the average " +
+          ("%.4g" % change if change is not None else "unknown"))
+
+
+def is_converged(displacementRms, change, displacementTolerance, changeTolerance):
+    """Whether metrics are below the tolerances, a tolerance of 0 disabling its criterion and at least one being set"""
+    if displacementTolerance <= 0 and changeTolerance <= 0:
+        return False
+
+    if displacementTolerance > 0 and displacementRms > displacementTolerance:
+        return False
+
+    if changeTolerance > 0 and (change is None or change > changeTolerance):
+        return False
+
+    return True
+
+
+def mark_converged(iteration):
+    with open(convergedFileName, "w") as convergedFile:
+        convergedFile.write(str(iteration) + "\n")
+
+
+def converged_iteration(folder="."):
+    """Iteration at which the atlas in folder converged, None if it did not"""
+    path = os.path.join(folder, convergedFileName)
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as convergedFile:
+        return int(convergedFile.read().split()[0])
+
+
+def skip_if_converged_command(folder):
+    """Shell line making a job script exit when the atlas in folder has converged"""
+    return "if [ -e " + os.path.join(folder, convergedFileName) + " ]; then exit 0; fi\n"
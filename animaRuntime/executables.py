@@ -0,0 +1,41 @@
+# Lazy resolution of Anima executables
+# Tools are looked up in the configured Anima folder the first time they are used, so that a script only pays for
+# (and only checks) the executables it actually runs, and fails with a clear message instead of a subprocess traceback.
+
+import os
+import sys
+
+from animaRuntime import config
+
+
+class AnimaTools(object):
+    """Resolves Anima executables by attribute name, e.g. tools.animaApplyTransformSerie"""
+
+    def __init__(self):
+        self._paths = {}
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        return self.path(name)
+
+    def path(self, name):
+        """Returns the full path of an Anima executable, checking it exists on first call"""
+        if name not in self._paths:
+            toolPath = os.path.join(config.anima_dir(), name)
+            if not (os.path.isfile(toolPath) and os.access(toolPath, os.X_OK)):
+                sys.exit("Error: the Anima executable \"" + toolPath + "\" could not be found. Check the anima "
+                         "folder in " + config.configFilePath)
+
+            self._paths[name] = toolPath
+
+        return self._paths[name]
+
+    def require(self, *names):
+        """Checks up-front a list of executables, for scripts that only write them into job files"""
+        for name in names:
+            self.path(name)
+
+
+tools = AnimaTools()
@@ -0,0 +1,312 @@
+# Instrumented execution of external commands
+# Drop-in replacement for subprocess.call that records, for every command, wall and CPU time, peak RSS, exit status and
+# the size of the files it wrote. Records are appended to a JSON-lines trace when a trace folder is configured
+# (ANIMA_TRACE_DIR environment variable or trace-dir in the config file) and a per tool summary is printed when the
+# script exits. Summaries of traces gathered over several jobs can be printed with:
+#     python3 -m animaRuntime.execution trace1.jsonl [trace2.jsonl ...]
+# In process steps (run) are recorded the same way. Independent steps can be run concurrently with parallel_map, the
+# cores being split between workers with split_cores.
+# In plan mode (enable_plan), commands and file operations are not run but added to the step graph of the script, which
+# is printed on exit along with its critical path (see animaRuntime.graph).
+# When a cache folder is configured, Anima tool results are restored from the cache instead of recomputed (see
+# animaRuntime.cache). The duration of an array task restoring results is then not recorded (see animaRuntime.jobs).
+
+import atexit
+import concurrent.futures
+import glob
+import json
+import os
+import queue
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from animaRuntime import cache, config, graph, jobs
+
+records = []
+plan = None
+_traceFilePath = None
+# Records and plan steps may come from several threads (see parallel_map)
+_lock = threading.RLock()
+
+
+def trace_dir():
+    """Folder where JSON-lines traces are written, empty if tracing to file is disabled"""
+    if "ANIMA_TRACE_DIR" in os.environ:
+        return os.environ["ANIMA_TRACE_DIR"]
+
+    return config.get("trace-dir", "")
+
+
+def _trace_file_path():
+    global _traceFilePath
+    if _traceFilePath is None:
+        _traceFilePath = ""
+        traceDir = trace_dir()
+        if traceDir != "":
+            os.makedirs(traceDir, exist_ok=True)
+            scriptName = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+            _traceFilePath = os.path.join(traceDir, scriptName + "_" + socket.gethostname() + "_" +
+                                          str(os.getpid()) + ".jsonl")
+
+    return _traceFilePath
+
+
+def _written_files(command, startTime):
+    """Sizes of the files given as arguments that were (re)written since startTime"""
+    outputs = {}
+    for arg in command[1:]:
+        if arg in outputs or not os.path.isfile(arg):
+            continue
+
+        fileStat = os.stat(arg)
+        # Some file systems only keep mtime to the second
+        if fileStat.st_mtime >= int(startTime):
+            outputs[arg] = fileStat.st_size
+
+    return outputs
+
+
+def record(entry):
+    """Stores an execution record and appends it to the trace file if any"""
+    with _lock:
+        records.append(entry)
+        traceFilePath = _trace_file_path()
+        if traceFilePath != "":
+            with open(traceFilePath, "a") as traceFile:
+                traceFile.write(json.dumps(entry) + "\n")
+
+
+def enable_plan(traceFilePaths=None):
+    """Switches to plan mode: commands are added to a step graph instead of being run
+
+    Step durations are taken from the given traces, or from the traces of this script in the trace folder if none are
+    given."""
+    global plan
+    scriptName = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+    plan = graph.Pipeline(scriptName)
+    if not traceFilePaths and trace_dir() != "":
+        traceFilePaths = glob.glob(os.path.join(trace_dir(), scriptName + "_*.jsonl"))
+
+    traceEntries = read_traces(traceFilePaths or [])
+    atexit.register(lambda: print(_plan_with_durations(traceEntries)))
+
+
+def _plan_with_durations(traceEntries):
+    plan.set_durations(traceEntries)
+    return plan.format_plan()
+
+
+def call(command, inputs=None, outputs=None, threads=None, **kwargs):
+    """Runs command (list of arguments) like subprocess.call, recording its resource usage. Returns the exit status
+
+    inputs, outputs and threads declare what the step graph cannot infer from the command line (e.g. files produced by
+    a sub-script), they are only used in plan mode."""
+    command = [str(arg) for arg in command]
+    if plan is not None:
+        with _lock:
+            plan.add(command, inputs=inputs, outputs=outputs, threads=threads)
+        return 0
+
+    startTime = time.time()
+    entry = {"tool": os.path.basename(command[0]), "command": command, "cwd": os.getcwd(),
+             "script": os.path.basename(sys.argv[0]), "host": socket.gethostname(), "start": startTime}
+
+    cacheEntry = cache.lookup(command)
+    if cacheEntry is not None:
+        restored = cache.restore(cacheEntry, command)
+        if restored is not None:
+            entry.update({"wall": time.time() - startTime, "cpu": 0.0, "maxrss": 0, "status": 0, "cached": True,
+                          "outputs": dict((path, os.path.getsize(path)) for path in restored), "bytesWritten": 0})
+            record(entry)
+            jobs.mark_untimed_task()
+            return 0
+
+    try:
+        process = subprocess.Popen(command, **kwargs)
+    except OSError as error:
+        entry.update({"wall": 0.0, "cpu": 0.0, "maxrss": 0, "status": 127, "error": str(error), "outputs": {}})
+        record(entry)
+        raise
+
+    try:
+        _, waitStatus, usage = os.wait4(process.pid, 0)
+    except BaseException:
+        process.kill()
+        process.wait()
+        raise
+
+    status = os.waitstatus_to_exitcode(waitStatus)
+    process.returncode = status
+
+    outputs = _written_files(command, startTime)
+    entry.update({"wall": time.time() - startTime, "cpu": usage.ru_utime + usage.ru_stime,
+                  "user": usage.ru_utime, "system": usage.ru_stime,
+                  # ru_maxrss is in kilobytes on Linux
+                  "maxrss": usage.ru_maxrss * 1024, "blocksWritten": usage.ru_oublock,
+                  "status": status, "outputs": outputs, "bytesWritten": sum(outputs.values())})
+    record(entry)
+
+    if cacheEntry is not None and status == 0:
+        cache.store(cacheEntry, command, startTime)
+
+    return status
+
+
+def run(name, function, inputs, outputs):
+    """Runs function() in process as a step named name, recorded like an external command (added to the step graph
+    in plan mode). inputs and outputs are the files it reads and writes"""
+    if plan is not None:
+        with _lock:
+            plan.add([name] + inputs + outputs, inputs=inputs, outputs=outputs, threads=1)
+        return
+
+    startTime = time.time()
+    startCpu = time.process_time()
+    entry = {"tool": name, "command": [name] + inputs + outputs, "cwd": os.getcwd(),
+             "script": os.path.basename(sys.argv[0]), "host": socket.gethostname(), "start": startTime}
+    status = 0
+    try:
+        function()
+    except BaseException:
+        status = 1
+        raise
+    finally:
+        written = _written_files([name] + outputs, startTime)
+        entry.update({"wall": time.time() - startTime, "cpu": time.process_time() - startCpu,
+                      "maxrss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024, "status": status,
+                      "outputs": written, "bytesWritten": sum(written.values())})
+        record(entry)
+
+
+def split_cores(numCores, numTasks, threadsPerTask=2):
+    """Number of concurrent workers and of threads per worker to run numTasks multithreaded tasks on numCores cores.
+    Tools such as animaApplyTransformSerie scale badly with threads: a few threads for each of several concurrent
+    tasks use the cores better than all of them for one task at a time"""
+    workers = max(1, min(numTasks, numCores // max(1, threadsPerTask)))
+    return workers, max(1, numCores // workers)
+
+
+def parallel_map(function, items, workers):
+    """Runs function(item) for each item on a pool of workers threads, yielding (item, result) pairs in completion
+    order. The first exception raised by a call is raised again here, once running calls are finished
+
+    items may be produced over time (e.g. by animaRuntime.flags.iter_flags), each one being started as soon as it is
+    produced. With a single worker, calls are run one after the other in the calling thread."""
+    if workers <= 1:
+        for item in items:
+            yield item, function(item)
+        return
+
+    results = queue.Queue()
+
+    def work(item):
+        try:
+            results.put((item, function(item), None))
+        except BaseException as error:
+            results.put((item, None, error))
+
+    pending = 0
+    executor = concurrent.futures.ThreadPoolExecutor(workers)
+    try:
+        for item in items:
+            executor.submit(work, item)
+            pending += 1
+            while not results.empty():
+                item, result, error = results.get()
+                pending -= 1
+                if error is not None:
+                    raise error
+                yield item, result
+
+        while pending > 0:
+            item, result, error = results.get()
+            pending -= 1
+            if error is not None:
+                raise error
+            yield item, result
+    finally:
+        # Calls not started yet are cancelled on error
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def move(source, destination):
+    """shutil.move, recorded as a step in plan mode"""
+    if plan is not None:
+        plan.add(["move", source, destination], inputs=[source], outputs=[destination], threads=1)
+    else:
+        shutil.move(source, destination)
+
+
+def copy(source, destination):
+    """shutil.copy, recorded as a step in plan mode"""
+    if plan is not None:
+        plan.add(["copy", source, destination], inputs=[source], outputs=[destination], threads=1)
+    else:
+        shutil.copy(source, destination)
+
+
+def remove(path):
+    """os.remove, skipped in plan mode"""
+    if plan is None:
+        os.remove(path)
+
+
+def summarize(entries):
+    """Aggregates execution records per tool, sorted by decreasing total wall time"""
+    tools = {}
+    for entry in entries:
+        toolSummary = tools.setdefault(entry["tool"], {"tool": entry["tool"], "calls": 0, "cached": 0, "failures": 0,
+                                                        "wall": 0.0, "cpu": 0.0, "maxrss": 0, "bytesWritten": 0})
+        toolSummary["calls"] += 1
+        toolSummary["cached"] += int(entry.get("cached", False))
+        toolSummary["failures"] += int(entry["status"] != 0)
+        toolSummary["wall"] += entry["wall"]
+        toolSummary["cpu"] += entry["cpu"]
+        toolSummary["maxrss"] = max(toolSummary["maxrss"], entry["maxrss"])
+        toolSummary["bytesWritten"] += entry.get("bytesWritten", 0)
+
+    return sorted(tools.values(), key=lambda t: t["wall"], reverse=True)
+
+
+def format_summary(entries):
+    """Per tool summary table of execution records, as a string"""
+    summary = summarize(entries)
+    totalWall = sum(t["wall"] for t in summary) or 1.0
+    lines = ["%-40s %6s %6s %5s %10s %6s %10s %10s %10s" % ("Tool", "Calls", "Cached", "Fail", "Wall (s)", "Wall %",
+                                                            "CPU (s)", "RSS (MB)", "Out (MB)")]
+    for t in summary:
+        lines.append("%-40s %6d %6d %5d %10.1f %6.1f %10.1f %10.1f %10.1f" % (
+            t["tool"], t["calls"], t["cached"], t["failures"], t["wall"], 100.0 * t["wall"] / totalWall, t["cpu"],
+            t["maxrss"] / 1048576.0, t["bytesWritten"] / 1048576.0))
+
+    return "\n".join(lines)
+
+
+def read_traces(traceFilePaths):
+    """Loads execution records from JSON-lines trace files"""
+    entries = []
+    for traceFilePath in traceFilePaths:
+        with open(traceFilePath) as traceFile:
+            entries += [json.loads(line) for line in traceFile if line.strip()]
+
+    return entries
+
+
+def _print_summary():
+    if len(records) > 0:
+        print("Execution summary for " + os.path.basename(sys.argv[0]) + ":")
+        print(format_summary(records))
+
+
+atexit.register(_print_summary)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit("Usage: python3 -m animaRuntime.execution trace.jsonl [trace.jsonl ...]")
+
+    print(format_summary(read_traces(sys.argv[1:])))
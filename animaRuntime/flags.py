@@ -0,0 +1,143 @@
+# Completion flags of array jobs
+# Registration jobs of the atlas builders create residualDir/<prefix>_<n>_flag once image n is registered, and
+# residualDir/<prefix>_<n>_failed (holding the reason) when they fail. Merge jobs wait for the flags with
+# wait_for_flags (or process images as soon as they are registered with iter_flags), woken up by inotify when available,
+# with a short polling period growing up to maxPollPeriod otherwise (and in any case, since inotify does not see files
+# created by other NFS clients). They exit with an error listing the missing images as soon as one has failed (all its
+# attempts with speculation, see animaRuntime.speculation), or when no new flag appeared for a given time.
+
+import ctypes
+import ctypes.util
+import glob
+import os
+import select
+import sys
+import time
+
+from animaRuntime import speculation
+
+# Polling periods in seconds
+minPollPeriod = 1.0
+maxPollPeriod = 30.0
+
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+
+
+def flag_path(folder, prefix, index):
+    return os.path.join(folder, prefix + "_" + str(index) + "_flag")
+
+
+def failed_path(folder, prefix, index):
+    return os.path.join(folder, prefix + "_" + str(index) + "_failed")
+
+
+def mark_done(folder, prefix, index):
+    """Records that image index was processed"""
+    open(flag_path(folder, prefix, index), "a").close()
+
+
+def mark_failed(folder, prefix, index, reason):
+    """Records that the job processing image index failed"""
+    with open(failed_path(folder, prefix, index), "w") as failedFile:
+        failedFile.write(reason + "\n")
+
+
+class _Inotify(object):
+    """Wakes up when files are created or written in a folder (Linux only)"""
+
+    def __init__(self, folder):
+        libcName = ctypes.util.find_library("c")
+        self._libc = ctypes.CDLL(libcName, use_errno=True)
+        self._fd = self._libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        mask = _IN_CREATE | _IN_MOVED_TO | _IN_CLOSE_WRITE | _IN_ATTRIB
+        if self._libc.inotify_add_watch(self._fd, os.fsencode(folder), mask) < 0:
+            os.close(self._fd)
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+
+    def wait(self, timeout):
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if readable:
+            try:
+                while os.read(self._fd, 65536):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def close(self):
+        os.close(self._fd)
+
+
+def _watcher(folder):
+    try:
+        return _Inotify(folder)
+    except (OSError, AttributeError, TypeError):
+        return None
+
+
+def _report(folder, prefix, missing, failed, errorPattern):
+    message = "Error: missing registrations for images " + ", ".join(str(i) for i in missing)
+    for index in failed:
+        if os.path.exists(failed_path(folder, prefix, index)):
+            with open(failed_path(folder, prefix, index)) as failedFile:
+                message += "\nImage " + str(index) + " failed: " + failedFile.read().strip()
+        else:
+            message += "\nImage " + str(index) + " failed: " + "; ".join(speculation.failure_reasons(folder, prefix,
+                                                                                                    index))
+
+    errorFiles = [f for f in glob.glob(errorPattern or "") if os.path.isfile(f) and os.path.getsize(f) > 0]
+    if len(errorFiles) > 0:
+        message += "\nSee the job error outputs: " + " ".join(sorted(errorFiles))
+
+    sys.exit(message)
+
+
+def iter_flags(folder, prefix, indexes, timeout=None, errorPattern=None):
+    """Yields image indexes as their flag appears in folder, until all indexes are done
+
+    Exits with an error as soon as a job reported a failure, or when no new flag appeared for timeout seconds (None to
+    wait forever). Files matching errorPattern (e.g. the error outputs of the jobs) are listed in the error message when
+    not empty."""
+    missing = list(indexes)
+    numIndexes = len(missing)
+    watcher = _watcher(folder)
+    pollPeriod = minPollPeriod
+    lastProgress = time.time()
+    try:
+        while len(missing) > 0:
+            done = [i for i in missing if os.path.exists(flag_path(folder, prefix, i))]
+            if len(done) > 0:
+                lastProgress = time.time()
+                pollPeriod = minPollPeriod
+                for index in done:
+                    missing.remove(index)
+                    yield index
+                continue
+
+            failed = [i for i in missing if os.path.exists(failed_path(folder, prefix, i)) or
+                      speculation.failed(folder, prefix, i)]
+            if len(failed) > 0 or (timeout is not None and time.time() - lastProgress > timeout):
+                _report(folder, prefix, missing, failed, errorPattern)
+
+            print("Waiting for " + str(len(missing)) + " of " + str(numIndexes) + " registrations")
+            if watcher is not None:
+                watcher.wait(pollPeriod)
+            else:
+                time.sleep(pollPeriod)
+            pollPeriod = min(maxPollPeriod, pollPeriod * 1.5)
+    finally:
+        if watcher is not None:
+            watcher.close()
+
+
+def wait_for_flags(folder, prefix, indexes, timeout=None, errorPattern=None):
+    """Waits until the flag of each image index exists in folder (see iter_flags)"""
+    for _ in iter_flags(folder, prefix, indexes, timeout, errorPattern):
+        pass
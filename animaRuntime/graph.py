@@ -0,0 +1,192 @@
+# Step graph of a pipeline, built from the commands it runs
+# When a script runs in plan mode (see execution.enable_plan), commands are not executed but added as steps of a
+# Pipeline. Data dependencies between steps are derived from the files they read and write: a step depends on the last
+# step that wrote one of its inputs. Combined with durations recorded in execution traces, this gives the critical path
+# of the pipeline and the speedup a parallel execution could bring over the current sequential ordering.
+
+import os
+import re
+
+# Arguments following these flags are outputs for all Anima tools
+outputFlags = ["-o", "-O"]
+outputFlagsPrefix = "--out"
+
+# Tools for which -p is the number of threads (for registration tools it is the number of pyramid levels)
+threadsFlagP = ["animaApplyTransformSerie", "animaTensorApplyTransformSerie", "animaMCMApplyTransformSerie"]
+
+fileExtensions = re.compile(r"\.(nrrd|nhdr|nii|nii\.gz|gz|txt|xml|mcm|fds|vtk|vtp|bvec|bval|csv)$")
+
+
+def is_path(arg):
+    """Tells if a command argument looks like a file"""
+    return not arg.startswith("-") and (os.sep in arg or fileExtensions.search(arg) is not None)
+
+
+class Step(object):
+    """One command of a pipeline with the files it reads and writes"""
+
+    def __init__(self, index, command, inputs, outputs, threads):
+        self.index = index
+        self.command = command
+        self.tool = os.path.basename(command[0])
+        self.inputs = inputs
+        self.outputs = outputs
+        # 0 means the tool uses all available cores (Anima default)
+        self.threads = threads
+        self.dependencies = []
+        self.duration = None
+
+    def name(self):
+        if len(self.command) > 1 and self.command[1].endswith(".py"):
+            return str(self.index) + ":" + os.path.basename(self.command[1])
+
+        return str(self.index) + ":" + self.tool
+
+
+class Pipeline(object):
+    """Ordered list of steps forming a directed acyclic graph through their files"""
+
+    def __init__(self, name):
+        self.name = name
+        self.steps = []
+        self._producers = {}
+
+    def add(self, command, inputs=None, outputs=None, threads=None):
+        """Adds a command as a step. Inputs, outputs and threads are inferred from the command when not given"""
+        command = [str(arg) for arg in command]
+        inferredInputs, inferredOutputs = self._infer_files(command)
+        inputs = [str(f) for f in inputs] if inputs is not None else []
+        outputs = [str(f) for f in outputs] if outputs is not None else []
+        inputs = _unique(inputs + [f for f in inferredInputs if f not in outputs])
+        outputs = _unique(outputs + inferredOutputs)
+
+        step = Step(len(self.steps) + 1, command, inputs, outputs, _infer_threads(command) if threads is None else threads)
+        for inputFile in inputs:
+            producer = self._producers.get(os.path.normpath(inputFile))
+            if producer is not None and producer not in step.dependencies:
+                step.dependencies.append(producer)
+
+        for outputFile in outputs:
+            self._producers[os.path.normpath(outputFile)] = step
+
+        self.steps.append(step)
+        return step
+
+    def _infer_files(self, command):
+        inputs = []
+        outputs = []
+        for i in range(1, len(command)):
+            arg = command[i]
+            if not is_path(arg):
+                continue
+
+            previous = command[i - 1]
+            if previous in outputFlags or previous.startswith(outputFlagsPrefix):
+                # Files written in place (e.g. -i brain -o brain) are already in the inputs
+                outputs.append(arg)
+            elif self._is_known(arg):
+                inputs.append(arg)
+            else:
+                # Neither on disk nor produced before: the tool writes it (e.g. animaDTIScalarMaps -a)
+                outputs.append(arg)
+
+        return inputs, outputs
+
+    def _is_known(self, path):
+        return os.path.normpath(path) in self._producers or os.path.exists(path)
+
+    def set_durations(self, traceEntries):
+        """Assigns durations to steps from execution records of previous runs
+
+        Steps are matched on their tool and output file names (temporary folders differ between runs), then on the
+        average duration of their tool."""
+        byOutputs = {}
+        byTool = {}
+        for entry in traceEntries:
+            if entry.get("cached", False):
+                continue
+
+            key = (entry["tool"], _basenames(entry["command"][1:]))
+            byOutputs[key] = entry["wall"]
+            byTool.setdefault(entry["tool"], []).append(entry["wall"])
+
+        for step in self.steps:
+            key = (step.tool, _basenames(step.command[1:]))
+            if key in byOutputs:
+                step.duration = byOutputs[key]
+            elif step.tool in byTool:
+                step.duration = sum(byTool[step.tool]) / len(byTool[step.tool])
+
+    def critical_path(self):
+        """Returns (critical path steps, critical path duration, sequential duration), unknown durations counting as 0"""
+        finish = {}
+        previous = {}
+        for step in self.steps:
+            start = 0.0
+            previous[step] = None
+            for dependency in step.dependencies:
+                if finish[dependency] > start:
+                    start = finish[dependency]
+                    previous[step] = dependency
+
+            finish[step] = start + (step.duration or 0.0)
+
+        if len(self.steps) == 0:
+            return [], 0.0, 0.0
+
+        last = max(self.steps, key=lambda s: finish[s])
+        path = []
+        while last is not None:
+            path.insert(0, last)
+            last = previous[last]
+
+        return path, finish[path[-1]], sum(step.duration or 0.0 for step in self.steps)
+
+    def format_plan(self):
+        """Human readable dump of the graph and, if durations are known, of its critical path"""
+        lines = ["Step graph for " + self.name + " (" + str(len(self.steps)) + " steps)"]
+        for step in self.steps:
+            threads = "all" if step.threads == 0 else str(step.threads)
+            duration = "?" if step.duration is None else "%.1fs" % step.duration
+            lines.append("%-45s threads: %-4s duration: %-9s after: %s" % (
+                step.name(), threads, duration, ", ".join(d.name() for d in step.dependencies) or "-"))
+            lines.append("    in:  " + " ".join(step.inputs))
+            lines.append("    out: " + " ".join(step.outputs))
+
+        if any(step.duration is not None for step in self.steps):
+            path, pathDuration, sequentialDuration = self.critical_path()
+            lines.append("Critical path: " + " -> ".join(step.name() for step in path))
+            lines.append("Sequential time: %.1fs, critical path time: %.1fs" % (sequentialDuration, pathDuration))
+            if pathDuration > 0:
+                lines.append("Theoretical speedup from parallel execution: %.2fx" % (sequentialDuration / pathDuration))
+
+            unknown = [step.name() for step in self.steps if step.duration is None]
+            if len(unknown) > 0:
+                lines.append("No recorded duration for: " + ", ".join(unknown))
+
+        return "\n".join(lines)
+
+
+def _infer_threads(command):
+    tool = os.path.basename(command[0])
+    for i in range(1, len(command) - 1):
+        if command[i] == "-T" or (command[i] == "-p" and tool in threadsFlagP):
+            try:
+                return int(command[i + 1])
+            except ValueError:
+                return 0
+
+    return 0
+
+
+def _unique(values):
+    result = []
+    for value in values:
+        if value not in result:
+            result.append(value)
+
+    return result
+
+
+def _basenames(args):
+    return tuple(os.path.basename(arg) for arg in args if is_path(arg))
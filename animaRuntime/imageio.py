@@ -0,0 +1,369 @@
+# Voxel data input / output for in-process processing
+# Images are accessed as flat (voxels, components) arrays, voxels in file order (x fastest), read and written slab by
+# slab so that memory use does not depend on the image size:
+# - uncompressed NRRD and NIfTI data are memory-mapped, reading a slab is zero-copy,
+# - gzip compressed data (.nii.gz, NRRD gzip encoding) are decompressed as a stream, slabs being read in increasing
+#   order (going backwards restarts the stream),
+# - outputs are written as a stream too, in a temporary file renamed at the end so that an output may also be an input.
+# NIfTI vector images store each component after all voxels: compressed ones are read, and such outputs are written,
+# through an uncompressed temporary copy.
+#     with imageio.ImageReader("dwi.nii.gz") as reader, imageio.ImageWriter("out.nrrd", reader.header) as writer:
+#         for start, stop in reader.slabs():
+#             writer.write(reader.read_values(start, stop) * 2)
+
+import gzip
+import math
+import os
+import shutil
+import struct
+import tempfile
+
+from animaRuntime import images
+from animaRuntime.lazy import lazy_import
+
+np = lazy_import("numpy")
+
+# Approximate number of voxels per slab, slabs being made of whole slices
+slabVoxels = 1 << 18
+# Bytes read at once when skipping through a compressed stream
+_skipBlock = 1 << 24
+
+_numpyTypes = {"int8": "i1", "uint8": "u1", "int16": "i2", "uint16": "u2", "int32": "i4", "uint32": "u4",
+               "int64": "i8", "uint64": "u8", "float32": "f4", "float64": "f8"}
+_nrrdTypeNames = {"int8": "signed char", "uint8": "unsigned char", "int16": "short", "uint16": "unsigned short",
+                  "int32": "int", "uint32": "unsigned int", "int64": "long long", "uint64": "unsigned long long",
+                  "float32": "float", "float64": "double"}
+_niftiTypeCodes = {"uint8": 2, "int16": 4, "int32": 8, "float32": 16, "float64": 64, "int8": 256, "uint16": 512,
+                   "uint32": 768, "int64": 1024, "uint64": 1280}
+
+
+def num_voxels(header):
+    """Number of voxels (product of the sizes) of an image header"""
+    count = 1
+    for s in header["size"]:
+        count *= s
+
+    return count
+
+
+def slab_size(header):
+    """Number of voxels of the slabs of an image: whole slices, about slabVoxels in total"""
+    sliceVoxels = header["size"][0] * (header["size"][1] if len(header["size"]) > 1 else 1)
+    return max(1, slabVoxels // sliceVoxels) * sliceVoxels
+
+
+class ImageReader(object):
+    """Slab-wise access to the voxel data of an image"""
+
+    def __init__(self, path):
+        self.path = path
+        self.header = images.read_header(path)
+        if self.header["type"] not in _numpyTypes:
+            raise ValueError("unsupported pixel type " + self.header["type"] + ": " + path)
+
+        self.dtype = np.dtype(("<" if self.header["endian"] == "little" else ">") + _numpyTypes[self.header["type"]])
+        self.numVoxels = num_voxels(self.header)
+        self.components = self.header["components"]
+        self._dataPath = os.path.join(os.path.dirname(path), self.header["dataFile"])
+        self._data = None
+        self._stream = None
+        self._rawFile = None
+        self._spillFile = None
+        self._position = 0
+        self._lastSlab = None
+
+        encoding = self.header["encoding"]
+        if encoding == "raw":
+            self._map(self._dataPath, self.header["dataOffset"])
+        elif encoding not in ["gzip", "gz"]:
+            raise ValueError("unsupported encoding " + encoding + ": " + path)
+        elif not self.header["componentsFirst"] and self.components > 1:
+            # Components are far apart in the stream, decompress once to a temporary file
+            self._open_stream()
+            self._spillFile = tempfile.TemporaryFile()
+            shutil.copyfileobj(self._stream, self._spillFile, _skipBlock)
+            self._close_stream()
+            self._map(self._spillFile, 0)
+
+    def _map(self, source, offset):
+        count = self.numVoxels * self.components
+        data = np.memmap(source, dtype=self.dtype, mode="r", offset=offset, shape=(count,))
+        if self.header["componentsFirst"]:
+            self._data = data.reshape(self.numVoxels, self.components)
+        else:
+            self._data = data.reshape(self.components, self.numVoxels).T
+
+    def _open_stream(self):
+        self._close_stream()
+        if self.header["format"] == "nifti":
+            self._stream = gzip.open(self._dataPath, "rb")
+            self._skip(self.header["dataOffset"])
+        else:
+            self._rawFile = open(self._dataPath, "rb")
+            self._rawFile.seek(self.header["dataOffset"])
+            self._stream = gzip.GzipFile(fileobj=self._rawFile)
+        self._position = 0
+
+    def _close_stream(self):
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+        if self._rawFile is not None:
+            self._rawFile.close()
+            self._rawFile = None
+
+    def _skip(self, numBytes):
+        while numBytes > 0:
+            skipped = len(self._stream.read(min(numBytes, _skipBlock)))
+            if skipped == 0:
+                raise ValueError("truncated image data: " + self.path)
+            numBytes -= skipped
+
+    def read(self, start, stop):
+        """Stored values of voxels start to stop, as a (stop - start, components) array"""
+        if self._data is not None:
+            return self._data[start:stop]
+
+        # Operands using the same image twice read the same slab twice
+        if self._lastSlab is not None and self._lastSlab[0] == start and self._lastSlab[1] == stop:
+            return self._lastSlab[2]
+
+        if self._stream is None or start < self._position:
+            self._open_stream()
+
+        voxelBytes = self.components * self.dtype.itemsize
+        self._skip((start - self._position) * voxelBytes)
+        buffer = self._stream.read((stop - start) * voxelBytes)
+        if len(buffer) != (stop - start) * voxelBytes:
+            raise ValueError("truncated image data: " + self.path)
+
+        self._position = stop
+        self._lastSlab = (start, stop, np.frombuffer(buffer, dtype=self.dtype).reshape(stop - start, self.components))
+        return self._lastSlab[2]
+
+    def read_values(self, start, stop):
+        """Actual values (NIfTI scaling applied) of voxels start to stop, as float64"""
+        values = np.asarray(self.read(start, stop), dtype=np.float64)
+        slope, intercept = self.header.get("scale", [0.0, 0.0])
+        if slope != 0 and (slope != 1 or intercept != 0):
+            values = values * slope + intercept
+
+        return values
+
+    def slabs(self):
+        """(start, stop) voxel ranges covering the image, in file order"""
+        size = slab_size(self.header)
+        for start in range(0, self.numVoxels, size):
+            yield start, min(start + size, self.numVoxels)
+
+    def close(self):
+        self._close_stream()
+        self._data = None
+        if self._spillFile is not None:
+            self._spillFile.close()
+            self._spillFile = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+
+def _nrrd_header(header, type, components, encoding):
+    size = header["size"]
+    if len(size) != 3:
+        raise ValueError("only 3D images can be written as NRRD")
+
+    lines = ["NRRD0004", "type: " + _nrrdTypeNames[type]]
+    axes = ["(" + ",".join("%.17g" % (d * s) for d in direction) + ")"
+            for direction, s in zip(header["direction"], header["spacing"])]
+    if components > 1:
+        lines += ["dimension: 4", "space: left-posterior-superior",
+                  "sizes: " + str(components) + " " + " ".join(str(s) for s in size),
+                  "space directions: none " + " ".join(axes), "kinds: vector domain domain domain"]
+    else:
+        lines += ["dimension: 3", "space: left-posterior-superior", "sizes: " + " ".join(str(s) for s in size),
+                  "space directions: " + " ".join(axes), "kinds: domain domain domain"]
+
+    lines += ["endian: little", "encoding: " + encoding,
+              "space origin: (" + ",".join("%.17g" % o for o in header["origin"][:3]) + ")"]
+    return ("\n".join(lines) + "\n\n").encode("latin-1")
+
+
+def _quaternion(rotation):
+    """NIfTI quaternion (b, c, d) and qfac of an orthonormal matrix (rotation[row][column])"""
+    r = [list(row) for row in rotation]
+    determinant = (r[0][0] * (r[1][1] * r[2][2] - r[1][2] * r[2][1]) - r[0][1] * (r[1][0] * r[2][2] - r[1][2] * r[2][0]) +
+                   r[0][2] * (r[1][0] * r[2][1] - r[1][1] * r[2][0]))
+    qfac = 1.0
+    if determinant < 0:
+        qfac = -1.0
+        for row in r:
+            row[2] = -row[2]
+
+    a = r[0][0] + r[1][1] + r[2][2] + 1.0
+    if a > 0.5:
+        a = 0.5 * math.sqrt(a)
+        b = 0.25 * (r[2][1] - r[1][2]) / a
+        c = 0.25 * (r[0][2] - r[2][0]) / a
+        d = 0.25 * (r[1][0] - r[0][1]) / a
+    else:
+        xd = 1.0 + r[0][0] - (r[1][1] + r[2][2])
+        yd = 1.0 + r[1][1] - (r[0][0] + r[2][2])
+        zd = 1.0 + r[2][2] - (r[0][0] + r[1][1])
+        if xd > 1.0:
+            b = 0.5 * math.sqrt(xd)
+            c = 0.25 * (r[0][1] + r[1][0]) / b
+            d = 0.25 * (r[0][2] + r[2][0]) / b
+            a = 0.25 * (r[2][1] - r[1][2]) / b
+        elif yd > 1.0:
+            c = 0.5 * math.sqrt(yd)
+            b = 0.25 * (r[0][1] + r[1][0]) / c
+            d = 0.25 * (r[1][2] + r[2][1]) / c
+            a = 0.25 * (r[0][2] - r[2][0]) / c
+        else:
+            d = 0.5 * math.sqrt(zd)
+            b = 0.25 * (r[0][2] + r[2][0]) / d
+            c = 0.25 * (r[1][2] + r[2][1]) / d
+            a = 0.25 * (r[1][0] - r[0][1]) / d
+        if a < 0:
+            b, c, d = -b, -c, -d
+
+    return (b, c, d), qfac
+
+
+def _nifti_header(header, type, components, scale):
+    size = header["size"]
+    if len(size) not in [3, 4] or (len(size) == 4 and components > 1):
+        raise ValueError("only 3D images, or 4D scalar images, can be written as NIfTI")
+
+    niftiHeader = bytearray(352)
+    struct.pack_into("<i", niftiHeader, 0, 348)
+    timeSize = size[3] if len(size) == 4 else 1
+    if components > 1:
+        struct.pack_into("<8h", niftiHeader, 40, 5, size[0], size[1], size[2], 1, components, 1, 1)
+        # NIFTI_INTENT_VECTOR
+        struct.pack_into("<h", niftiHeader, 68, 1007)
+    else:
+        struct.pack_into("<8h", niftiHeader, 40, len(size), size[0], size[1], size[2], timeSize, 1, 1, 1)
+    struct.pack_into("<2h", niftiHeader, 70, _niftiTypeCodes[type], np.dtype(_numpyTypes[type]).itemsize * 8)
+
+    # Axes and origin back to RAS
+    axes = [[-d[0], -d[1], d[2]] for d in header["direction"][:3]]
+    origin = [-header["origin"][0], -header["origin"][1], header["origin"][2]]
+    quaternion, qfac = _quaternion([[axes[a][r] for a in range(3)] for r in range(3)])
+
+    spacing = header["spacing"]
+    struct.pack_into("<8f", niftiHeader, 76, qfac, spacing[0], spacing[1], spacing[2],
+                     spacing[3] if len(size) == 4 else 0, 0, 0, 0)
+    struct.pack_into("<3f", niftiHeader, 108, 352, scale[0], scale[1])
+    # Millimeters
+    struct.pack_into("<B", niftiHeader, 123, 2)
+    struct.pack_into("<2h", niftiHeader, 252, 1, 1)
+    struct.pack_into("<6f", niftiHeader, 256, quaternion[0], quaternion[1], quaternion[2], origin[0], origin[1],
+                     origin[2])
+    for r in range(3):
+        struct.pack_into("<4f", niftiHeader, 280 + 16 * r, axes[0][r] * spacing[0], axes[1][r] * spacing[1],
+                         axes[2][r] * spacing[2], origin[r])
+    niftiHeader[344:348] = b"n+1\0"
+    return bytes(niftiHeader)
+
+
+class ImageWriter(object):
+    """Writes an image slab by slab, in file order. The geometry (size, spacing, direction, origin) is taken from
+    header, typically the one of an ImageReader. NRRD outputs are gzip compressed if compress is True, .nii.gz ones
+    always are. scale is the NIfTI (slope, intercept) of the stored values"""
+
+    def __init__(self, path, header, type="float32", components=1, compress=None, scale=None):
+        self.path = path
+        self.header = header
+        self.type = type
+        self.components = components
+        self.numVoxels = num_voxels(header)
+        self._dtype = np.dtype("<" + _numpyTypes[type])
+        self._position = 0
+        self._planes = None
+        self._planesFile = None
+
+        isNifti = path.endswith(".nii") or path.endswith(".nii.gz")
+        compress = path.endswith(".gz") if isNifti else bool(compress)
+        self._tmpPath = os.path.join(os.path.dirname(path), "." + os.path.basename(path) + ".tmp" + str(os.getpid()))
+        self._file = open(self._tmpPath, "wb")
+        if not isNifti:
+            self._file.write(_nrrd_header(header, type, components, "gzip" if compress else "raw"))
+
+        self._stream = self._file
+        if compress:
+            self._stream = gzip.GzipFile(fileobj=self._file, mode="wb", compresslevel=6)
+        if isNifti:
+            self._stream.write(_nifti_header(header, type, components, scale or [1.0, 0.0]))
+
+        if isNifti and components > 1:
+            # Components are stored after all voxels, gathered in a temporary file until the end
+            self._planesFile = tempfile.TemporaryFile()
+            self._planes = np.memmap(self._planesFile, dtype=self._dtype, mode="w+",
+                                     shape=(components, self.numVoxels))
+
+    def write(self, values):
+        """Writes the next voxels, a (voxels, components) array (or (voxels,) for scalar images)"""
+        values = np.asarray(values).reshape(-1, self.components)
+        stop = self._position + values.shape[0]
+        if stop > self.numVoxels:
+            raise ValueError("too many voxels written to " + self.path)
+
+        if self._planes is not None:
+            self._planes[:, self._position:stop] = values.T
+        else:
+            self._stream.write(np.ascontiguousarray(values, dtype=self._dtype).tobytes())
+        self._position = stop
+
+    def close(self):
+        """Finishes writing and moves the image to its path"""
+        if self._position != self.numVoxels:
+            self.abort()
+            raise ValueError("missing voxels in " + self.path)
+
+        if self._planes is not None:
+            for component in range(self.components):
+                self._stream.write(self._planes[component].tobytes())
+            self._planes = None
+            self._planesFile.close()
+
+        if self._stream is not self._file:
+            self._stream.close()
+        self._file.close()
+        os.replace(self._tmpPath, self.path)
+
+    def abort(self):
+        """Stops writing and removes the partial image"""
+        if self._planesFile is not None:
+            self._planes = None
+            self._planesFile.close()
+        if self._stream is not self._file:
+            self._stream.close()
+        self._file.close()
+        if os.path.exists(self._tmpPath):
+            os.remove(self._tmpPath)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exceptionType, exception, traceback):
+        if exceptionType is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def extract_volumes(inputPath, outputPath, indexes):
+    """Writes the given volumes (increasing indexes along the 4th dimension) of a 4D image to outputPath"""
+    with ImageReader(inputPath) as reader:
+        volumeVoxels = num_voxels(reader.header) // reader.header["size"][3]
+        header = dict(reader.header, size=reader.header["size"][:3] + [len(indexes)])
+        with ImageWriter(outputPath, header, reader.header["type"], reader.components,
+                         scale=reader.header.get("scale")) as writer:
+            size = slab_size(reader.header)
+            for index in indexes:
+                for start in range(index * volumeVoxels, (index + 1) * volumeVoxels, size):
+                    writer.write(reader.read(start, min(start + size, (index + 1) * volumeVoxels)))
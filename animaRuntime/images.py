@@ -0,0 +1,391 @@
+# Image metadata without running Anima tools
+# Pure python readers for NRRD (attached or detached header) and NIfTI-1 headers, giving image size, spacing, direction,
+# pixel type and number of components as ITK (hence Anima) sees them. Directions are given as unit vectors of the image
+# axes in LPS coordinates, for both formats. Images in the other formats ITK reads (.mha, .hdr/.img, .mnc...) are found
+# by name and checked with animaConvertImage -I.
+# Metadata are kept in a per folder catalog (.anima_catalog.json) so that a dataset is only parsed once: entries are
+# reused as long as the file size and modification time are unchanged. A whole cohort can be checked with:
+#     python3 -m animaRuntime.images folder_or_image [...]
+
+import gzip
+import json
+import math
+import os
+import re
+import struct
+import subprocess
+import sys
+
+from animaRuntime.executables import tools
+
+catalogFileName = ".anima_catalog.json"
+imageExtensions = [".nrrd", ".nhdr", ".nii.gz", ".nii"]
+# Data files of the other formats, stored next to the header named like the image
+_dataExtensions = [".img", ".img.gz", ".raw", ".zraw"]
+
+_nrrdTypes = {
+    "signed char": "int8", "int8": "int8", "int8_t": "int8", "char": "int8",
+    "uchar": "uint8", "unsigned char": "uint8", "uint8": "uint8", "uint8_t": "uint8",
+    "short": "int16", "short int": "int16", "signed short": "int16", "signed short int": "int16", "int16": "int16",
+    "int16_t": "int16",
+    "ushort": "uint16", "unsigned short": "uint16", "unsigned short int": "uint16", "uint16": "uint16",
+    "uint16_t": "uint16",
+    "int": "int32", "signed int": "int32", "int32": "int32", "int32_t": "int32",
+    "uint": "uint32", "unsigned int": "uint32", "uint32": "uint32", "uint32_t": "uint32",
+    "longlong": "int64", "long long": "int64", "long long int": "int64", "signed long long": "int64",
+    "signed long long int": "int64", "int64": "int64", "int64_t": "int64",
+    "ulonglong": "uint64", "unsigned long long": "uint64", "unsigned long long int": "uint64", "uint64": "uint64",
+    "uint64_t": "uint64",
+    "float": "float32", "double": "float64", "block": "block"}
+
+_niftiTypes = {2: "uint8", 4: "int16", 8: "int32", 16: "float32", 32: "complex64", 64: "float64", 128: "rgb24",
+               256: "int8", 512: "uint16", 768: "uint32", 1024: "int64", 1280: "uint64", 1792: "complex128",
+               2304: "rgba32"}
+
+
+def image_prefix(path):
+    """Path without its image extension (handles .nii.gz)"""
+    if path.endswith(".nii.gz"):
+        return path[:-7]
+
+    return os.path.splitext(path)[0]
+
+
+def _normalize(vector):
+    norm = math.sqrt(sum(v * v for v in vector))
+    if norm == 0:
+        return norm, list(vector)
+
+    return norm, [v / norm for v in vector]
+
+
+def read_nrrd_header(path):
+    """Reads the header of a NRRD image"""
+    fields = {}
+    with open(path, "rb") as f:
+        rawLine = f.readline()
+        if not rawLine.startswith(b"NRRD"):
+            raise ValueError("not a NRRD file: " + path)
+
+        headerLength = len(rawLine)
+        while True:
+            rawLine = f.readline()
+            headerLength += len(rawLine)
+            line = rawLine.decode("latin-1").rstrip("\r\n")
+            if line == "":
+                break
+            if line.startswith("#") or ":=" in line or ": " not in line:
+                continue
+
+            key, value = line.split(": ", 1)
+            fields[key.strip().lower()] = value.strip()
+
+    sizes = [int(s) for s in fields["sizes"].split()]
+    dimension = int(fields.get("dimension", len(sizes)))
+    directions = None
+    if "space directions" in fields:
+        directions = []
+        for token in re.findall(r"none|\([^)]*\)", fields["space directions"]):
+            if token == "none":
+                directions.append(None)
+            else:
+                directions.append([float(v) for v in token.strip("()").split(",")])
+    kinds = fields.get("kinds", "").split()
+
+    size = []
+    spacing = []
+    direction = []
+    components = 1
+    for axis in range(dimension):
+        if directions is not None:
+            isSpatial = directions[axis] is not None
+        elif len(kinds) == dimension:
+            isSpatial = kinds[axis] in ["domain", "space", "time"]
+        else:
+            isSpatial = True
+
+        if not isSpatial:
+            components *= sizes[axis]
+            continue
+
+        size.append(sizes[axis])
+        if directions is not None:
+            norm, unit = _normalize(directions[axis])
+            spacing.append(norm)
+            direction.append(unit)
+        else:
+            spacings = fields.get("spacings", "").split()
+            spacing.append(float(spacings[axis]) if len(spacings) == dimension and spacings[axis] != "nan" else 1.0)
+            direction.append([1.0 if i == len(direction) else 0.0 for i in range(dimension)])
+
+    origin = [0.0] * len(size)
+    if "space origin" in fields:
+        origin = [float(v) for v in fields["space origin"].strip("()").split(",")]
+
+    # Data is either attached after the header, or in a detached file starting at its beginning
+    dataFile = fields.get("data file", fields.get("datafile", ""))
+    if dataFile == "":
+        dataFile = os.path.basename(path)
+        dataOffset = headerLength
+    else:
+        dataOffset = 0
+
+    return {"format": "nrrd", "size": size, "spacing": spacing, "direction": direction, "origin": origin,
+            "type": _nrrdTypes.get(fields.get("type", ""), fields.get("type", "")), "components": components,
+            "componentsFirst": directions is None or directions[0] is None, "encoding": fields.get("encoding", "raw"),
+            "endian": fields.get("endian", "little"), "dataFile": dataFile, "dataOffset": dataOffset}
+
+
+def read_nifti_header(path):
+    """Reads the header of a NIfTI-1 image (.nii or .nii.gz)"""
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        header = f.read(348)
+
+    if len(header) < 348:
+        raise ValueError("truncated NIfTI header: " + path)
+
+    endian = "<"
+    if struct.unpack("<i", header[0:4])[0] != 348:
+        endian = ">"
+        if struct.unpack(">i", header[0:4])[0] != 348:
+            raise ValueError("not a NIfTI-1 file (NIfTI-2 is not supported): " + path)
+
+    dim = struct.unpack(endian + "8h", header[40:56])
+    datatype = struct.unpack(endian + "h", header[70:72])[0]
+    pixdim = struct.unpack(endian + "8f", header[76:108])
+    qformCode, sformCode = struct.unpack(endian + "2h", header[252:256])
+    voxOffset, sclSlope, sclInter = struct.unpack(endian + "3f", header[108:120])
+    quatern = struct.unpack(endian + "3f", header[256:268])
+    qoffset = struct.unpack(endian + "3f", header[268:280])
+    srow = [struct.unpack(endian + "4f", header[280 + 16 * i:296 + 16 * i]) for i in range(3)]
+
+    numDims = dim[0]
+    # 5D images with a single time point are vector images (e.g. tensors, displacement fields)
+    if numDims >= 5 and dim[4] == 1:
+        size = list(dim[1:4])
+    else:
+        size = list(dim[1:min(numDims, 4) + 1])
+    components = 1
+    for d in dim[5:numDims + 1]:
+        components *= d
+
+    spacing = [abs(p) for p in pixdim[1:len(size) + 1]]
+
+    # Axis directions in RAS, then flipped to LPS like ITK does
+    if sformCode > 0:
+        axes = [_normalize([srow[0][a], srow[1][a], srow[2][a]])[1] for a in range(3)]
+    elif qformCode > 0:
+        b, c, d = quatern
+        a = math.sqrt(max(0.0, 1.0 - (b * b + c * c + d * d)))
+        rotation = [[a * a + b * b - c * c - d * d, 2 * (b * c - a * d), 2 * (b * d + a * c)],
+                    [2 * (b * c + a * d), a * a + c * c - b * b - d * d, 2 * (c * d - a * b)],
+                    [2 * (b * d - a * c), 2 * (c * d + a * b), a * a + d * d - c * c - b * b]]
+        qfac = -1.0 if pixdim[0] < 0 else 1.0
+        axes = [[rotation[0][i], rotation[1][i], rotation[2][i]] for i in range(3)]
+        axes[2] = [v * qfac for v in axes[2]]
+    else:
+        axes = [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]]
+
+    direction = [[-axis[0], -axis[1], axis[2]] for axis in axes]
+    if sformCode > 0:
+        origin = [-srow[0][3], -srow[1][3], srow[2][3]]
+    elif qformCode > 0:
+        origin = [-qoffset[0], -qoffset[1], qoffset[2]]
+    else:
+        origin = [0.0, 0.0, 0.0]
+    origin += [0.0] * (len(size) - 3)
+
+    # Time axis of 4D images
+    for extraAxis in range(3, len(size)):
+        direction.append([1.0 if i == extraAxis else 0.0 for i in range(len(size))])
+
+    # Components are stored after all voxels, as the 5th dimension
+    return {"format": "nifti", "size": size, "spacing": spacing, "direction": direction[:len(size)],
+            "origin": origin[:len(size)], "type": _niftiTypes.get(datatype, str(datatype)), "components": components,
+            "componentsFirst": False, "encoding": "gzip" if path.endswith(".gz") else "raw",
+            "endian": "little" if endian == "<" else "big", "dataFile": os.path.basename(path),
+            "dataOffset": int(voxOffset), "scale": [sclSlope, sclInter]}
+
+
+def read_header(path):
+    """Reads the header of a NRRD or NIfTI image"""
+    if path.endswith(".nrrd") or path.endswith(".nhdr"):
+        return read_nrrd_header(path)
+    if path.endswith(".nii") or path.endswith(".nii.gz"):
+        return read_nifti_header(path)
+
+    raise ValueError("unsupported image format: " + path)
+
+
+class Catalog(object):
+    """Image metadata of the images of one folder, persisted in the folder when it is writable"""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.filePath = os.path.join(folder, catalogFileName)
+        self.entries = {}
+        self._dirty = False
+        self._listing = None
+        self._names = None
+        try:
+            with open(self.filePath) as catalogFile:
+                self.entries = json.load(catalogFile)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def info(self, path):
+        """Metadata of an image of the folder (size, spacing, direction, type, components, fileSize, mtime)"""
+        name = os.path.basename(path)
+        fileStat = os.stat(path)
+        entry = self.entries.get(name)
+        if entry is None or entry["fileSize"] != fileStat.st_size or entry["mtime"] != fileStat.st_mtime_ns:
+            entry = read_header(path)
+            entry["fileSize"] = fileStat.st_size
+            entry["mtime"] = fileStat.st_mtime_ns
+            self.entries[name] = entry
+            self._dirty = True
+
+        return entry
+
+    def names(self):
+        """Names of the files of the folder"""
+        if self._names is None:
+            self._names = sorted(os.listdir(self.folder))
+
+        return self._names
+
+    def images(self):
+        """Names of the NRRD and NIfTI image files of the folder"""
+        if self._listing is None:
+            self._listing = [f for f in self.names() if has_header_reader(f)]
+
+        return self._listing
+
+    def find(self, prefix):
+        """Image of the folder named prefix + an image extension, None if there is none. NRRD and NIfTI images come
+        first, then files in other formats (any other extension, except data files of detached headers)"""
+        for name in self.images():
+            if image_prefix(name) == prefix:
+                return os.path.join(self.folder, name)
+
+        for name in self.names():
+            if name.startswith(prefix + ".") and not any(name.endswith(ext) for ext in _dataExtensions) and \
+                    os.path.isfile(os.path.join(self.folder, name)):
+                return os.path.join(self.folder, name)
+
+        return None
+
+    def save(self):
+        if not self._dirty:
+            return
+
+        tmpFilePath = self.filePath + "." + str(os.getpid())
+        try:
+            with open(tmpFilePath, "w") as catalogFile:
+                json.dump(self.entries, catalogFile)
+            os.replace(tmpFilePath, self.filePath)
+            self._dirty = False
+        except OSError:
+            # Read-only dataset, metadata are only kept for this run
+            pass
+
+
+_catalogs = {}
+
+
+def catalog(folder):
+    """Catalog of a folder, loaded once per process"""
+    folder = os.path.abspath(folder or ".")
+    if folder not in _catalogs:
+        _catalogs[folder] = Catalog(folder)
+
+    return _catalogs[folder]
+
+
+def has_header_reader(path):
+    """Whether the header of path is read in python (NRRD and NIfTI images)"""
+    return any(path.endswith(ext) for ext in imageExtensions)
+
+
+def image_info(path):
+    """Metadata of an image, from the catalog of its folder"""
+    folderCatalog = catalog(os.path.dirname(path))
+    info = folderCatalog.info(path)
+    folderCatalog.save()
+    return info
+
+
+def image_size(path):
+    """Size of an image along its axes, from its header for NRRD and NIfTI images and from animaConvertImage -I for
+    the other formats ITK reads (e.g. .mha, .hdr/.img)"""
+    try:
+        return image_info(path)["size"]
+    except (ValueError, KeyError, struct.error):
+        pass
+
+    convertOutput = subprocess.check_output([tools.animaConvertImage, "-i", path, "-I"], universal_newlines=True)
+    return [int(size) for size in convertOutput.split('\n')[1].split('[')[1].split(']')[0].split(', ')]
+
+
+def find_image(prefix):
+    """Path of the image named prefix + an image extension, None if there is none"""
+    return catalog(os.path.dirname(prefix)).find(os.path.basename(prefix))
+
+
+def image_extension(path):
+    """Image extension of path (e.g. .nii.gz, .mha), empty if it has none"""
+    for ext in imageExtensions:
+        if path.endswith(ext):
+            return ext
+
+    extension = os.path.splitext(path)[1]
+    if extension == ".gz":
+        extension = os.path.splitext(os.path.splitext(path)[0])[1] + extension
+
+    return extension
+
+
+def check_images(paths):
+    """Checks that images exist and have readable headers (read by animaConvertImage for formats other than NRRD and
+    NIfTI). Returns a list of error messages"""
+    errors = []
+    for path in paths:
+        if not os.path.exists(path):
+            errors.append(path + ": missing")
+            continue
+
+        try:
+            if has_header_reader(path):
+                image_info(path)
+            else:
+                image_size(path)
+        except (ValueError, KeyError, OSError, struct.error, IndexError, subprocess.CalledProcessError) as error:
+            errors.append(path + ": unreadable header (" + str(error) + ")")
+
+    return errors
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit("Usage: python3 -m animaRuntime.images folder_or_image [...]")
+
+    imagePaths = []
+    for arg in sys.argv[1:]:
+        if os.path.isdir(arg):
+            imagePaths += [os.path.join(arg, f) for f in catalog(arg).images()]
+        else:
+            imagePaths.append(arg)
+
+    for imagePath in imagePaths:
+        try:
+            imageInfo = image_info(imagePath)
+        except (ValueError, KeyError, OSError, struct.error):
+            continue
+        print("%-50s %-20s %-30s %-8s %d" % (os.path.basename(imagePath), "x".join(str(s) for s in imageInfo["size"]),
+                                            " x ".join("%.3g" % s for s in imageInfo["spacing"]), imageInfo["type"],
+                                            imageInfo["components"]))
+
+    imageErrors = check_images(imagePaths)
+    if len(imageErrors) > 0:
+        sys.exit("Error: invalid images:\n" + "\n".join(imageErrors))
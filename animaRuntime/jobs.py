@@ -0,0 +1,379 @@
+# Submission of job scripts to a scheduler
+# Job scripts are written for OAR (#OAR directives, OAR_ARRAY_INDEX for array jobs) and either submitted with oarsub or
+# run on the local machine, depending on the scheduler (--scheduler option of the scripts submitting jobs, ANIMA_SCHEDULER
+# environment variable or scheduler in the config file, oar by default).
+# The local scheduler runs array jobs and dependency chains with a pool of processes: jobs are started in submission
+# order as soon as their dependencies are done and enough cores are free for their requested core count, smaller jobs
+# filling the remaining cores. Its number of cores is os.cpu_count(), or ANIMA_LOCAL_CORES / local-cores in the config
+# file. Jobs depending on a failed job are cancelled.
+# Array jobs running one task per element (e.g. one registration per image) record the duration of each task in the
+# durations file of their working folder. Later submissions use these durations to set the walltime (longest measured
+# task times the walltime-margin factor) and, on OAR, to pack several short tasks in one array element, up to
+# pack-duration seconds per element (see array_layout and array_loop_start). Task names hold the settings their
+# duration depends on (e.g. the registration settings of an iteration). Failed tasks and tasks not doing their whole work
+# (tools results restored from the cache, transforms reused...) are not recorded: they mark themselves with
+# mark_untimed_task, or with touch "${ANIMA_UNTIMED_TASK}" in job scripts. The exit status of an array element is
+# the last non zero exit status of its tasks.
+# With speculation (set_speculation), the local scheduler starts a second run of the array elements running for longer
+# than a factor times the median duration of the finished elements of their array, with ANIMA_ATTEMPT=2 in their
+# environment, and keeps the first run to succeed (see animaRuntime.speculation).
+
+import math
+import os
+import re
+import signal
+import subprocess
+import sys
+import time
+
+from animaRuntime import config, speculation
+
+schedulers = ["oar", "local"]
+
+
+def default_scheduler():
+    """Scheduler used when none is given on the command line"""
+    if "ANIMA_SCHEDULER" in os.environ:
+        return os.environ["ANIMA_SCHEDULER"]
+
+    return config.get("scheduler", "oar")
+
+
+def local_cores():
+    """Number of cores available to the local scheduler"""
+    if "ANIMA_LOCAL_CORES" in os.environ:
+        return int(os.environ["ANIMA_LOCAL_CORES"])
+
+    return int(config.get("local-cores", str(os.cpu_count())))
+
+
+durationsFileName = ".anima_task_durations"
+# Marker file created by the tasks whose duration is not to be recorded
+untimedTaskVariable = "ANIMA_UNTIMED_TASK"
+# Number of last measured durations of a task used for estimates
+_numDurations = 100
+
+
+def pack_duration():
+    """Target duration in seconds of array elements running several short tasks"""
+    if "ANIMA_PACK_DURATION" in os.environ:
+        return float(os.environ["ANIMA_PACK_DURATION"])
+
+    return float(config.get("pack-duration", "1800"))
+
+
+def walltime_margin():
+    """Safety factor applied to measured durations to set walltimes"""
+    if "ANIMA_WALLTIME_MARGIN" in os.environ:
+        return float(os.environ["ANIMA_WALLTIME_MARGIN"])
+
+    return float(config.get("walltime-margin", "1.5"))
+
+
+def measured_durations(folder, task):
+    """Durations in seconds of the last runs of task recorded in folder"""
+    durations = []
+    path = os.path.join(folder, durationsFileName)
+    if os.path.exists(path):
+        with open(path) as durationsFile:
+            for line in durationsFile:
+                words = line.split()
+                if len(words) == 2 and words[0] == task:
+                    durations.append(float(words[1]))
+
+    return durations[-_numDurations:]
+
+
+def format_walltime(seconds):
+    seconds = int(math.ceil(seconds))
+    return "%02d:%02d:%02d" % (seconds // 3600, (seconds % 3600) // 60, seconds % 60)
+
+
+def walltime_seconds(walltime):
+    hours, minutes, seconds = walltime.split(":")
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+
+def array_layout(folder, task, numTasks, defaultWalltime):
+    """Number of array elements, tasks per element and walltime of an array job running numTasks tasks, from the
+    durations of task measured in folder (one task per element with defaultWalltime when none were measured)"""
+    durations = measured_durations(folder, task)
+    if len(durations) == 0:
+        return numTasks, 1, defaultWalltime
+
+    longest = max(max(durations), 1.0)
+    tasksPerJob = 1
+    # The local scheduler has no submission latency to save
+    if scheduler != "local":
+        tasksPerJob = max(1, min(numTasks, int(pack_duration() // longest)))
+
+    # At least ten minutes, scheduler and file system hiccups not being measured
+    walltime = max(600.0, tasksPerJob * longest * walltime_margin())
+    return int(math.ceil(numTasks / float(tasksPerJob))), tasksPerJob, format_walltime(walltime)
+
+
+def array_loop_start(firstTask, lastTask, tasksPerJob, indexes=None):
+    """Shell lines looping over the tasks of the current array element, with the task number in ${index}. With
+    indexes, tasks are positions (from 1) in that list and ${index} holds the value at that position. To be closed by
+    array_loop_end"""
+    lines = "first=$(( (OAR_ARRAY_INDEX - 1) * " + str(tasksPerJob) + " + " + str(firstTask) + " ))\n"
+    lines += "last=$(( first + " + str(tasksPerJob - 1) + " ))\n"
+    lines += "if [ ${last} -gt " + str(lastTask) + " ]; then last=" + str(lastTask) + "; fi\n"
+    if indexes is None:
+        lines += "for index in $(seq ${first} ${last}); do\n"
+    else:
+        lines += "indexes=(" + " ".join(str(i) for i in indexes) + ")\n"
+        lines += "for task in $(seq ${first} ${last}); do\n"
+        lines += "index=${indexes[$(( task - 1 ))]}\n"
+    lines += "taskStart=$(date +%s)\n"
+    lines += "export " + untimedTaskVariable + "=${TMPDIR:-/tmp}/anima_untimed_$$_${index}\n"
+    lines += "rm -f \"${" + untimedTaskVariable + "}\"\n"
+    return "arrayStatus=0\n" + lines
+
+
+def array_loop_end(folder, task):
+    """Shell lines recording the duration of task in folder and closing the loop of array_loop_start. Task is a single
+    word, that may use shell variables of the loop"""
+    return ("taskStatus=$?\n" +
+            "if [ ${taskStatus} -ne 0 ]; then\n" +
+            "arrayStatus=${taskStatus}\n" +
+            "elif [ ! -e \"${" + untimedTaskVariable + "}\" ]; then\n" +
+            "echo \"" + task + " $(( $(date +%s) - taskStart ))\" >> " +
+            os.path.join(os.path.abspath(folder), durationsFileName) + "\n" +
+            "fi\n" +
+            "rm -f \"${" + untimedTaskVariable + "}\"\n" +
+            "done\n" +
+            "exit ${arrayStatus}\n")
+
+
+def mark_untimed_task():
+    """Keeps the duration of the current array task from being recorded (see array_loop_end)"""
+    if untimedTaskVariable in os.environ:
+        open(os.environ[untimedTaskVariable], "w").close()
+
+
+class LocalJob(object):
+    """One job (or element of an array job) run by the local scheduler"""
+
+    def __init__(self, jobId, name, scriptPath, arrayIndex, dependencies, cores):
+        self.jobId = jobId
+        self.name = name
+        self.scriptPath = scriptPath
+        self.arrayIndex = arrayIndex
+        self.dependencies = dependencies
+        self.cores = cores
+        # pending, running, done, failed or cancelled
+        self.state = "pending"
+        self.process = None
+        self.start = None
+        self.duration = None
+        # Second run of the job started by speculation and, for such a run, the job it duplicates
+        self.duplicate = None
+        self.original = None
+
+    def label(self):
+        if self.arrayIndex is None:
+            return self.name + " (" + self.jobId + ")"
+
+        return self.name + "[" + str(self.arrayIndex) + "] (" + self.jobId + ")"
+
+
+class LocalScheduler(object):
+    """Runs OAR job scripts on the local machine with a process pool packed by cores"""
+
+    def __init__(self, numCores):
+        self.numCores = numCores
+        self.jobs = []
+        self._jobsById = {}
+
+    def submit(self, scriptPath, name, dependencies, cores):
+        with open(scriptPath) as scriptFile:
+            directives = scriptFile.read()
+
+        arrayMatch = re.search(r"^#OAR\s+--array\s+(\d+)", directives, re.M)
+        arrayIndexes = [None] if arrayMatch is None else range(1, int(arrayMatch.group(1)) + 1)
+
+        jobsIds = []
+        for arrayIndex in arrayIndexes:
+            job = LocalJob("local-" + str(len(self.jobs) + 1), name, scriptPath, arrayIndex, list(dependencies),
+                           min(cores, self.numCores))
+            self.jobs.append(job)
+            self._jobsById[job.jobId] = job
+            jobsIds.append(job.jobId)
+
+        return jobsIds
+
+    def _start(self, job, attempt=None):
+        with open(job.scriptPath) as scriptFile:
+            directives = scriptFile.read()
+
+        env = dict(os.environ)
+        env["OAR_JOB_ID"] = job.jobId
+        env["OAR_JOBID"] = job.jobId
+        env["OAR_JOB_NAME"] = job.name
+        if job.arrayIndex is not None:
+            env["OAR_ARRAY_INDEX"] = str(job.arrayIndex)
+        if attempt is not None:
+            env["ANIMA_ATTEMPT"] = str(attempt)
+
+        outputs = []
+        for flag in ["-O", "-E"]:
+            outputMatch = re.search(r"^#OAR\s+" + flag + r"\s+(\S+)", directives, re.M)
+            if outputMatch is None:
+                outputs.append(subprocess.DEVNULL)
+            else:
+                outputs.append(open(outputMatch.group(1).replace("%jobid%", job.jobId), "w"))
+
+        print("Starting job " + job.label() + " on " + str(job.cores) + " cores")
+        # In its own process group, to be stopped with the tools it runs
+        job.process = subprocess.Popen([job.scriptPath], env=env, stdout=outputs[0], stderr=outputs[1],
+                                       start_new_session=True)
+        for output in outputs:
+            if output is not subprocess.DEVNULL:
+                output.close()
+
+        job.state = "running"
+        job.start = time.time()
+
+    def _speculate(self, running, freeCores):
+        """Starts a second run of the array elements straggling behind the others of their array, returns the number
+        of cores used"""
+        usedCores = 0
+        for job in list(running):
+            if job.arrayIndex is None or job.duplicate is not None or job.original is not None:
+                continue
+
+            elements = [j for j in self.jobs if j.scriptPath == job.scriptPath and j.arrayIndex is not None]
+            durations = [j.duration for j in elements if j.state == "done"]
+            if len(speculation.stragglers(durations, {job.jobId: time.time() - job.start}, len(elements),
+                                          speculationFactor)) == 0 or job.cores > freeCores - usedCores:
+                continue
+
+            duplicate = LocalJob(job.jobId + "-2", job.name, job.scriptPath, job.arrayIndex, [], job.cores)
+            duplicate.original = job
+            job.duplicate = duplicate
+            print("Job " + job.label() + " is straggling, starting it again")
+            self._start(duplicate, attempt=2)
+            running.append(duplicate)
+            usedCores += job.cores
+
+        return usedCores
+
+    def _stop(self, job):
+        os.killpg(job.process.pid, signal.SIGTERM)
+        job.process.wait()
+        print("Job " + job.label() + " stopped: another run finished first")
+
+    def run(self):
+        """Runs all submitted jobs, returns the list of failed or cancelled jobs"""
+        freeCores = self.numCores
+        running = []
+        while True:
+            for job in self.jobs:
+                if job.state != "pending":
+                    continue
+
+                # Dependencies on jobs unknown to this scheduler are considered done
+                dependencies = [self._jobsById[d] for d in job.dependencies if d in self._jobsById]
+                if any(d.state in ["failed", "cancelled"] for d in dependencies):
+                    job.state = "cancelled"
+                    print("Cancelling job " + job.label() + ": a job it depends on did not succeed")
+                elif all(d.state == "done" for d in dependencies) and job.cores <= freeCores:
+                    self._start(job)
+                    running.append(job)
+                    freeCores -= job.cores
+
+            if len(running) == 0:
+                break
+
+            if speculationFactor > 0:
+                freeCores -= self._speculate(running, freeCores)
+
+            finished = [job for job in running if job.process.poll() is not None]
+            if len(finished) == 0:
+                time.sleep(1)
+                continue
+
+            for job in finished:
+                if job not in running:
+                    # Stopped while handling another finished run of the same job
+                    continue
+
+                running.remove(job)
+                freeCores += job.cores
+                succeeded = job.process.returncode == 0
+                original = job if job.original is None else job.original
+                other = original.duplicate if job is original else original
+                if other is not None and other in running:
+                    if not succeeded:
+                        print("Job " + job.label() + " failed (exit status " + str(job.process.returncode) +
+                              "), waiting for its other run")
+                        continue
+
+                    running.remove(other)
+                    freeCores += other.cores
+                    self._stop(other)
+
+                original.state = "done" if succeeded else "failed"
+                original.duration = time.time() - original.start
+                print("Job " + job.label() + " " + original.state + " (exit status " + str(job.process.returncode) + ")")
+
+        return [job for job in self.jobs if job.state != "done"]
+
+
+scheduler = None
+_localScheduler = None
+speculationFactor = 0
+
+
+def set_speculation(factor):
+    """Makes the local scheduler run again the array elements running for longer than factor times the median
+    duration of the finished elements of their array (0 disables speculation)"""
+    global speculationFactor
+    speculationFactor = factor
+
+
+def set_scheduler(name):
+    """Selects the scheduler jobs are submitted to (oar or local)"""
+    global scheduler, _localScheduler
+    if name not in schedulers:
+        sys.exit("Error: unknown scheduler \"" + name + "\", use one of: " + ", ".join(schedulers))
+
+    scheduler = name
+    if scheduler == "local" and _localScheduler is None:
+        _localScheduler = LocalScheduler(local_cores())
+
+
+def submit(scriptPath, name, dependencies=None, cores=1):
+    """Submits a job script after the given jobs, returns the ids of the created jobs (one per array element)"""
+    if scheduler is None:
+        set_scheduler(default_scheduler())
+
+    dependencies = [str(d) for d in (dependencies or [])]
+    if scheduler == "local":
+        return _localScheduler.submit(scriptPath, name, dependencies, cores)
+
+    oarRunCommand = ["oarsub", "-n", name]
+    for jobId in dependencies:
+        oarRunCommand += ["-a", jobId]
+    oarRunCommand += ["-S", scriptPath]
+
+    jobsIds = []
+    procStat = subprocess.run(oarRunCommand, stdout=subprocess.PIPE)
+    statLines = procStat.stdout.decode('utf-8').split('\n')
+    for statsLine in statLines:
+        if "OAR_JOB_ID" in statsLine:
+            jobsIds += [statsLine.split("=")[1]]
+
+    return jobsIds
+
+
+def wait():
+    """With the local scheduler, runs the submitted jobs and exits with an error if some did not succeed. Jobs
+    submitted to OAR run on their own, nothing is done"""
+    if scheduler != "local":
+        return
+
+    failedJobs = _localScheduler.run()
+    if len(failedJobs) > 0:
+        sys.exit("Error: the following jobs did not succeed: " + ", ".join(job.label() for job in failedJobs))
@@ -0,0 +1,37 @@
+# Deferred imports of heavy optional modules (numpy, scipy, pandas, pydicom, nibabel...)
+# The module is only really loaded on first attribute access, so code paths that never touch it do not pay for it,
+# and do not even require it to be installed.
+
+import importlib.util
+import sys
+
+
+class _MissingModule(object):
+    """Stands for a module that is not installed, failing only when it is actually used"""
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attribute):
+        raise ImportError("No module named " + self._name + ", please install it to use this option")
+
+
+def lazy_import(name):
+    """Returns a module object for name whose actual import is deferred until it is first used"""
+    if name in sys.modules:
+        return sys.modules[name]
+
+    try:
+        spec = importlib.util.find_spec(name)
+    except ImportError:
+        spec = None
+
+    if spec is None:
+        return _MissingModule(name)
+
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
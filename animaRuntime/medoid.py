@@ -0,0 +1,59 @@
+# Initial reference of atlas builds
+# Without a reference image, atlas builders start from the first image of the dataset, and an unusual first image costs
+# iterations before the template settles. The medoid of the dataset may be used instead: the image whose intensity
+# distribution is the closest to those of all the others. Each image is summarised by the histogram of a regular
+# subsample of its voxels (tensor images by their traces, other vector images by their norms), intensities being divided
+# by a high percentile of the nonzero ones so that scanner scalings do not matter, and images are compared by the L1
+# distance between their histograms. No registration is needed, and histograms of several images are computed at once.
+
+from animaRuntime import execution, imageio
+from animaRuntime.lazy import lazy_import
+
+np = lazy_import("numpy")
+
+# Approximate number of voxels sampled in each image
+sampleVoxels = 1 << 16
+numBins = 64
+# Percentile of the nonzero intensities mapped to the last bin
+percentile = 99
+
+
+def _scalar_values(values):
+    if values.shape[1] == 6:
+        return values[:, 0] + values[:, 2] + values[:, 5]
+
+    if values.shape[1] > 1:
+        return np.sqrt(np.sum(values ** 2, axis=1))
+
+    return values[:, 0]
+
+
+def histogram(path):
+    """Normalised intensity histogram of a subsample of the voxels of an image"""
+    samples = []
+    with imageio.ImageReader(path) as reader:
+        step = max(1, reader.numVoxels // sampleVoxels)
+        for start, stop in reader.slabs():
+            samples.append(_scalar_values(reader.read_values(start, stop)[(-start) % step::step]))
+
+    samples = np.concatenate(samples)
+    samples = samples[np.isfinite(samples) & (samples != 0)]
+    if len(samples) == 0:
+        raise ValueError("image " + path + " has no nonzero voxel")
+
+    scale = np.percentile(np.abs(samples), percentile)
+    counts, _ = np.histogram(np.clip(samples / scale, -1.0, 1.0), bins=numBins, range=(-1.0, 1.0))
+    return counts / float(np.sum(counts))
+
+
+def medoid(paths, workers=1):
+    """Position in paths of the image with the smallest sum of histogram distances to the others, and these sums"""
+    if len(paths) == 0:
+        raise ValueError("no image to choose a medoid from")
+
+    histograms = dict(execution.parallel_map(histogram, paths, workers))
+    distances = []
+    for path in paths:
+        distances.append(sum(float(np.sum(np.abs(histograms[path] - histograms[other]))) for other in paths))
+
+    return distances.index(min(distances)), distances
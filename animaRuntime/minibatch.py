@@ -0,0 +1,47 @@
+# Mini-batch atlas iterations
+# Early templates are far from the population mean, and a subset of the images moves them towards it about as well as
+# all of them. In mini-batch mode, the first iterations of the anatomical builder register and average a subset of the
+# images, growing geometrically from an initial size to all the images, used by the last iterations. Subsets are nested:
+# they are the first images of a random order of all of them, drawn once with heavier images more likely to come first
+# (weighted sampling without replacement), so that images of a subset are warm started by their transforms of the
+# previous iteration. As heavier images are already more likely to be drawn, images of a subset are averaged with equal
+# weights. The subset of each iteration is written to miniBatch_<k>.txt in the atlas folder, in the selection format of
+# animaRuntime.selection read by the merge and reduce scripts.
+
+import random
+
+
+def file_name(iteration):
+    return "miniBatch_" + str(iteration) + ".txt"
+
+
+def batch_sizes(numImages, initialSize, numIterations, fullIterations):
+    """Number of images of each iteration: from initialSize, growing geometrically to numImages over the iterations
+    before the last fullIterations ones, which use all the images"""
+    numBatches = max(0, numIterations - fullIterations)
+    initialSize = max(1, min(initialSize, numImages))
+    sizes = []
+    for k in range(numBatches):
+        sizes.append(min(numImages, int(round(initialSize * (float(numImages) / initialSize) ** (float(k) / numBatches)))))
+
+    return sizes + [numImages] * (numIterations - numBatches)
+
+
+def order(entries, seed, first=None):
+    """Entries of a selection (see animaRuntime.selection), in a random order where heavier images are more likely to
+    come first. Image first, if given, comes first"""
+    generator = random.Random(seed)
+    keys = dict((a, generator.random() ** (1.0 / weight) if weight > 0 else 0.0) for a, weight, _ in entries)
+    if first is not None:
+        keys[first] = 2.0
+
+    return sorted(entries, key=lambda entry: -keys[entry[0]])
+
+
+def batch(orderedEntries, size):
+    """Selection entries of the first size images of orderedEntries, with equal weights (all the entries unchanged when
+    size covers them)"""
+    if size >= len(orderedEntries):
+        return sorted(orderedEntries)
+
+    return sorted((a, 1.0 / size, mode) for a, _, mode in orderedEntries[:size])
@@ -0,0 +1,39 @@
+# Tree reduction of atlas averages
+# With hundreds of images, a single merge job reading every nonlinear transform and resampled image is bound by the
+# I/O and memory of one node. Averages are instead reduced over a tree of array jobs: at level 0, each job sums a
+# group of groupSize images into a partial weighted sum (sum of weighted values and sum of weights, see
+# animaRuntime.voxelwise.WeightedSum), at the next levels each job adds up groupSize partial sums of the previous
+# level, until a single job writes the mean. Since partial sums are exact sums (in double precision), the average is
+# the one of all images at once, and the wall time grows with the number of levels, log(N) / log(groupSize).
+
+import math
+import os
+
+
+def num_groups(numItems, groupSize, level):
+    """Number of jobs at level of the reduction of numItems images"""
+    return max(1, int(math.ceil(numItems / float(groupSize ** (level + 1)))))
+
+
+def num_levels(numItems, groupSize):
+    """Number of levels of the reduction of numItems images, the last one having a single job"""
+    if groupSize < 2:
+        raise ValueError("reduction groups need at least two items")
+
+    levels = 1
+    while num_groups(numItems, groupSize, levels - 1) > 1:
+        levels += 1
+
+    return levels
+
+
+def group_members(numItems, groupSize, level, group):
+    """Positions (from 0) of the images (level 0) or of the partial sums of the previous level reduced by job group
+    (from 1) of level"""
+    numInputs = numItems if level == 0 else num_groups(numItems, groupSize, level - 1)
+    return range((group - 1) * groupSize, min(group * groupSize, numInputs))
+
+
+def partial_prefix(folder, stage, level, group):
+    """Prefix of the partial sum written by job group of level, for the average named stage"""
+    return os.path.join(folder, "reduce_" + stage + "_" + str(level) + "_" + str(group))
@@ -0,0 +1,109 @@
+# Per iteration registration settings of the atlas builders
+# Early iterations register images onto a blurry average and do not need the full settings. A schedule overrides
+# options of the linear (animaPyramidalBMRegistration) and nonlinear (dense SVF block matching) registrations by
+# iteration. It is either a built-in schedule:
+#     full            same settings at every iteration (default)
+#     coarse-to-fine  first quarter of the iterations asymmetric and stopping two pyramid levels above full resolution,
+#                     up to half of them one level above, full settings for the others (and always for the last one)
+# or a text file with lines:
+#     <iterations> <linear|nonlinear> <option> <value> [<option> <value> ...]
+# where iterations is k, k-l, or k- (from k to the last one), e.g.:
+#     1-2 nonlinear -l 2 --sym-reg 0 --sp 4
+#     3-4 nonlinear -l 1
+# Lines are applied in order, later ones overriding earlier ones. Empty lines and lines starting with # are ignored.
+
+import os
+import sys
+
+schedules = ["full", "coarse-to-fine"]
+registrations = ["linear", "nonlinear"]
+
+
+def _builtin_lines(name, numIterations):
+    if name == "full":
+        return []
+
+    # The last iteration always uses the full settings
+    if numIterations < 2:
+        return []
+
+    quarter = max(1, numIterations // 4)
+    half = max(quarter, numIterations // 2)
+    lines = ["1-" + str(quarter) + " linear --sym-reg 0",
+             "1-" + str(quarter) + " nonlinear -l 2 --sym-reg 0"]
+    if half > quarter:
+        lines.append(str(quarter + 1) + "-" + str(half) + " nonlinear -l 1")
+
+    return lines
+
+
+def _parse_iterations(text, numIterations):
+    first, separator, last = text.partition("-")
+    if separator == "":
+        return int(first), int(first)
+
+    return int(first), int(last) if last != "" else numIterations
+
+
+def read(schedule, numIterations):
+    """Schedule lines as (first iteration, last iteration, registration, {option: value}) tuples, from a built-in name
+    or a schedule file. Exits with an error on invalid schedules"""
+    if schedule in schedules:
+        lines = _builtin_lines(schedule, numIterations)
+    elif os.path.isfile(schedule):
+        with open(schedule) as scheduleFile:
+            lines = scheduleFile.read().splitlines()
+    else:
+        sys.exit("Error: unknown schedule " + schedule + " (built-in schedules: " + ", ".join(schedules) + ")")
+
+    entries = []
+    for line in lines:
+        words = line.split()
+        if len(words) == 0 or words[0].startswith("#"):
+            continue
+
+        if len(words) < 2 or words[1] not in registrations or len(words) % 2 != 0:
+            sys.exit("Error: invalid schedule line in " + schedule + ": " + line)
+
+        try:
+            first, last = _parse_iterations(words[0], numIterations)
+        except ValueError:
+            sys.exit("Error: invalid iterations in schedule line of " + schedule + ": " + line)
+
+        entries.append((first, last, words[1], dict(zip(words[2::2], words[3::2]))))
+
+    return entries
+
+
+def options(schedule, registration, iteration, numIterations):
+    """Options overridden by schedule for the given registration (linear or nonlinear) at iteration"""
+    overrides = {}
+    for first, last, entryRegistration, entryOptions in read(schedule, numIterations):
+        if entryRegistration == registration and first <= iteration <= last:
+            overrides.update(entryOptions)
+
+    return overrides
+
+
+def settings_key(schedule, iteration, numIterations):
+    """Single word naming the settings of iteration (full when none is overridden), e.g. to tell apart the durations of
+    registrations run with different settings"""
+    words = []
+    for registration in registrations:
+        overrides = options(schedule, registration, iteration, numIterations)
+        if len(overrides) > 0:
+            words.append(registration + ":" + ",".join(option + "=" + overrides[option] for option in sorted(overrides)))
+
+    return "/".join(words) or "full"
+
+
+def apply(command, overrides):
+    """Command with the values of the options in overrides replaced, or appended when not in the command"""
+    command = list(command)
+    for option, value in overrides.items():
+        if option in command[1:]:
+            command[command.index(option, 1) + 1] = value
+        else:
+            command += [option, value]
+
+    return command
@@ -0,0 +1,51 @@
+# Scratch folders for intermediate files
+# Intermediates go to a temporary folder created under the scratch root: the --scratch-root option of the scripts, the
+# ANIMA_SCRATCH_ROOT environment variable or scratch-root in the config file, the system temporary folder (usually /tmp)
+# otherwise. Pointing it to a node-local disk or /dev/shm avoids writing large intermediates over NFS.
+# Large inputs can be staged in the scratch folder before processing, and final outputs written there are staged out
+# to their destination at the end. Both go through animaRuntime.execution so that they show up in step graphs.
+
+import os
+import tempfile
+
+from animaRuntime import config, execution
+
+
+def scratch_root(cliScratchRoot=None):
+    """Folder where temporary folders are created, None for the system default"""
+    if cliScratchRoot:
+        return cliScratchRoot
+
+    if "ANIMA_SCRATCH_ROOT" in os.environ:
+        return os.environ["ANIMA_SCRATCH_ROOT"] or None
+
+    return config.get("scratch-root", "") or None
+
+
+def make_temp_dir(cliScratchRoot=None):
+    """Creates a temporary folder under the scratch root and returns its path"""
+    root = scratch_root(cliScratchRoot)
+    if root is not None:
+        os.makedirs(root, exist_ok=True)
+
+    return tempfile.mkdtemp(prefix="anima_", dir=root)
+
+
+def _is_single_file_image(path):
+    # Detached NRRD headers reference their data file relatively, they are read in place
+    return path.endswith(".nrrd") or path.endswith(".nii") or path.endswith(".nii.gz")
+
+
+def stage_in(path, folder):
+    """Copies an input image to the scratch folder if it is not already on it. Returns the path to use"""
+    if not _is_single_file_image(path) or os.path.realpath(path).startswith(os.path.realpath(folder) + os.sep):
+        return path
+
+    localPath = os.path.join(folder, "in_" + os.path.basename(path))
+    execution.copy(path, localPath)
+    return localPath
+
+
+def stage_out(localPath, path):
+    """Moves a final output from the scratch folder to its destination"""
+    execution.move(localPath, path)
@@ -0,0 +1,58 @@
+# Weight based selection of the images of weighted atlases
+# Weighted atlases (e.g. longitudinal sub-atlases from animaComputeLongitudinalAtlasWeights.py) give nearly zero weights
+# to many images, registered and resampled at every iteration for a negligible contribution to the average. Builders
+# exclude the images whose weight relative to the largest one is below a threshold, the weights of the others being
+# renormalised to sum to one, and may register the images below a second threshold with an affine transform only (zero
+# nonlinear transform). The selection is written to selection.txt in the atlas folder, one line per kept image:
+#     <image number> <renormalised weight> <full|affine>
+# and read by the merge scripts, replacing the weights file.
+
+import sys
+
+fileName = "selection.txt"
+modes = ["full", "affine"]
+
+
+def select(weights, threshold, affineThreshold=0):
+    """(image number, renormalised weight, mode) of the images whose weight relative to the largest one is at least
+    threshold, mode being affine for those below affineThreshold"""
+    if threshold > 1 or affineThreshold > 1:
+        sys.exit("Error: weight thresholds are relative to the largest weight and cannot exceed 1")
+
+    largest = max(weights) if len(weights) > 0 else 0
+    if largest <= 0:
+        sys.exit("Error: weights must have a positive value to select images")
+
+    kept = [(a, w) for a, w in enumerate(weights, 1) if w >= threshold * largest]
+    total = sum(w for _, w in kept)
+    return [(a, w / total, "affine" if w < affineThreshold * largest else "full") for a, w in kept]
+
+
+def write(path, entries):
+    with open(path, "w") as selectionFile:
+        for a, weight, mode in entries:
+            selectionFile.write(str(a) + " " + repr(weight) + " " + mode + "\n")
+
+
+def read(path):
+    """Entries of a selection file, as returned by select"""
+    entries = []
+    with open(path) as selectionFile:
+        for line in selectionFile:
+            words = line.split()
+            if len(words) == 0:
+                continue
+
+            if len(words) != 3 or words[2] not in modes:
+                sys.exit("Error: invalid line in selection file " + path + ": " + line.strip())
+
+            entries.append((int(words[0]), float(words[1]), words[2]))
+
+    return entries
+
+
+def write_weights(entries, path):
+    """Writes the renormalised weights of entries in a weights file (as given to animaAverageImages -w)"""
+    with open(path, "w") as weightsFile:
+        for _, weight, _ in entries:
+            weightsFile.write(repr(weight) + "\n")
@@ -0,0 +1,122 @@
+# Speculative re-execution of straggling registrations
+# One slow node or one pathological image holds up a whole atlas iteration. With speculation, registrations running
+# for longer than a factor times the median duration of the finished registrations of their iteration (once at least
+# half of them and minDone are finished) are started again on other cores, each image being duplicated at most once.
+# The local scheduler duplicates its own array elements (see animaRuntime.jobs.set_speculation). On OAR, a watcher job
+# (atlasing/animaSpeculateRegistrations.py) follows the registrations in the job state database (animaRuntime.state)
+# and submits a job per duplicated image.
+# Attempts of a registration (--attempt of the register scripts) work on their own files. The first one to finish
+# claims the image by creating residualDir/<prefix>_<n>_claim and moves its transforms to their final paths before
+# creating the flag, the outputs of the others being discarded.
+# A failed attempt does not fail the image while another one may still register it: attempts create
+# residualDir/<prefix>_<n>_attempt<k>_started (the OAR watcher before submitting them) and
+# residualDir/<prefix>_<n>_attempt<k>_failed instead of the failed flag, and merge jobs consider the image failed once
+# all started attempts have failed (for failureSettleTime seconds, the time for a second run started just before to
+# create its marker).
+
+import glob
+import os
+import re
+import statistics
+import time
+
+minDone = 3
+minDoneFraction = 0.5
+failureSettleTime = 60.0
+
+
+def stragglers(durations, elapsed, numTasks, factor):
+    """Tasks (keys of elapsed, the time they have been running for) running for longer than factor times the median of
+    durations, the durations of the finished tasks out of numTasks"""
+    if factor <= 0 or len(durations) < max(minDone, minDoneFraction * numTasks):
+        return []
+
+    limit = factor * statistics.median(durations)
+    return [task for task, time in elapsed.items() if time > limit]
+
+
+def attempt_suffix(attempt):
+    """Suffix of the files of an attempt, empty without speculation (attempt 0)"""
+    return "" if attempt == 0 else "_attempt" + str(attempt)
+
+
+def claim_path(folder, prefix, index):
+    return os.path.join(folder, prefix + "_" + str(index) + "_claim")
+
+
+def attempt_marker_path(folder, prefix, index, attempt, kind):
+    """Marker of kind (started or failed) of an attempt at image index"""
+    return os.path.join(folder, prefix + "_" + str(index) + attempt_suffix(attempt) + "_" + kind)
+
+
+def _attempts(folder, prefix, index, kind):
+    """Marker paths of kind of the attempts at image index, by attempt number"""
+    attempts = {}
+    for path in glob.glob(os.path.join(folder, glob.escape(prefix + "_" + str(index)) + "_attempt*_" + kind)):
+        match = re.search(r"_attempt(\d+)_" + kind + "$", path)
+        if match is not None:
+            attempts[int(match.group(1))] = path
+
+    return attempts
+
+
+def mark_started(folder, prefix, index, attempt):
+    open(attempt_marker_path(folder, prefix, index, attempt, "started"), "a").close()
+
+
+def mark_attempt_failed(folder, prefix, index, attempt, reason):
+    """Records that an attempt at image index failed. Returns whether all started attempts have failed without any
+    having registered the image"""
+    with open(attempt_marker_path(folder, prefix, index, attempt, "failed"), "w") as failedFile:
+        failedFile.write(reason + "\n")
+
+    return failed(folder, prefix, index, 0)
+
+
+def failed(folder, prefix, index, settleTime=None):
+    """Whether all the attempts at image index started so far have failed, the last one for at least settleTime
+    seconds (default: failureSettleTime), without any having registered the image"""
+    if settleTime is None:
+        settleTime = failureSettleTime
+
+    failedAttempts = _attempts(folder, prefix, index, "failed")
+    if len(failedAttempts) == 0 or os.path.exists(claim_path(folder, prefix, index)):
+        return False
+
+    if not set(_attempts(folder, prefix, index, "started")) <= set(failedAttempts):
+        return False
+
+    try:
+        lastFailure = max(os.path.getmtime(path) for path in failedAttempts.values())
+    except FileNotFoundError:
+        return False
+
+    return time.time() - lastFailure >= settleTime
+
+
+def failure_reasons(folder, prefix, index):
+    """Reasons recorded by the failed attempts at image index"""
+    reasons = []
+    for attempt, path in sorted(_attempts(folder, prefix, index, "failed").items()):
+        with open(path) as failedFile:
+            reasons.append("attempt " + str(attempt) + ": " + failedFile.read().strip())
+
+    return reasons
+
+
+def publish(folder, prefix, index, paths):
+    """Moves the outputs of an attempt at image index (work path, final path pairs) to their final paths if it is the
+    first one to finish. Returns False when another attempt did, the outputs of this one being removed. All the outputs
+    must exist (failed attempts are recorded with mark_attempt_failed instead)"""
+    try:
+        # Exclusive creation is atomic, also on NFS (v3 and later)
+        os.close(os.open(claim_path(folder, prefix, index), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        for workPath, _ in paths:
+            os.remove(workPath)
+        return False
+
+    for workPath, finalPath in paths:
+        os.replace(workPath, finalPath)
+
+    return True
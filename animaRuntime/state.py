@@ -0,0 +1,136 @@
+# Job state of the atlas builders
+# Registration jobs record the status of their image at each iteration (running, done or failed, with the duration and
+# the output files of done ones) and merge jobs the completed iterations in a SQLite database in the atlas folder,
+# .anima_state.db. Builders run again on an unfinished atlas resume its first unfinished iteration: images done with
+# their outputs still in tempDir are not registered again, only missing and failed ones are resubmitted. The database
+# also answers status queries (--status of the builders) without listing the atlas folders.
+# Flag files are still written: merge jobs wait for them with inotify (see animaRuntime.flags), and iterations are
+# only done while their it_<k>_done marker and average exist, so that deleting them still redoes an iteration. Each
+# update is a single short transaction, concurrent jobs waiting up to busyTimeout seconds for the database lock. On NFS,
+# this relies on working file locks (lockd).
+
+import json
+import os
+import socket
+import sqlite3
+import time
+from contextlib import closing
+
+fileName = ".anima_state.db"
+busyTimeout = 120.0
+statuses = ["running", "done", "failed"]
+# Averages written by the merge jobs of the anatomical and DTI atlases
+averagePrefixes = ["averageForm", "averageDTI"]
+
+
+def _connect(folder):
+    connection = sqlite3.connect(os.path.join(folder, fileName), timeout=busyTimeout)
+    with connection:
+        connection.execute("CREATE TABLE IF NOT EXISTS images (iteration INTEGER, image INTEGER, status TEXT, "
+                           "start REAL, duration REAL, outputs TEXT, host TEXT, PRIMARY KEY (iteration, image))")
+        connection.execute("CREATE TABLE IF NOT EXISTS iterations (iteration INTEGER PRIMARY KEY, end REAL)")
+
+    return connection
+
+
+def record_image(folder, iteration, index, status, start, outputs=None):
+    """Records the status of image index at iteration in the atlas folder, start being the time its job started"""
+    if status not in statuses:
+        raise ValueError("unknown image status " + status)
+
+    duration = None if status == "running" else time.time() - start
+    with closing(_connect(folder)) as connection, connection:
+        connection.execute("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           (iteration, index, status, start, duration, json.dumps(outputs or []),
+                            socket.gethostname()))
+
+
+def image_statuses(folder, iteration):
+    """Status and output files of the images recorded at iteration, by image index"""
+    if not os.path.exists(os.path.join(folder, fileName)):
+        return {}
+
+    with closing(_connect(folder)) as connection:
+        rows = connection.execute("SELECT image, status, outputs FROM images WHERE iteration = ?",
+                                  (iteration,)).fetchall()
+
+    return dict((index, (status, json.loads(outputs))) for index, status, outputs in rows)
+
+
+def image_times(folder, iteration):
+    """Status, start time and duration (None while running) of the images recorded at iteration, by image index"""
+    if not os.path.exists(os.path.join(folder, fileName)):
+        return {}
+
+    with closing(_connect(folder)) as connection:
+        rows = connection.execute("SELECT image, status, start, duration FROM images WHERE iteration = ?",
+                                  (iteration,)).fetchall()
+
+    return dict((index, (status, start, duration)) for index, status, start, duration in rows)
+
+
+def completed_images(folder, iteration):
+    """Images done at iteration whose outputs still exist"""
+    return sorted(index for index, (status, outputs) in image_statuses(folder, iteration).items()
+                  if status == "done" and all(os.path.exists(os.path.join(folder, path)) for path in outputs))
+
+
+def record_iteration(folder, iteration):
+    with closing(_connect(folder)) as connection, connection:
+        connection.execute("INSERT OR REPLACE INTO iterations VALUES (?, ?)", (iteration, time.time()))
+
+
+def iteration_done(folder, iteration):
+    """Whether iteration was completed in the atlas folder: its it_<k>_done marker and its average exist. Deleting
+    either of them redoes the iteration, its record being dropped"""
+    if os.path.exists(os.path.join(folder, "it_" + str(iteration) + "_done")) and \
+            any(os.path.exists(os.path.join(folder, prefix + str(iteration) + ".nrrd")) for prefix in averagePrefixes):
+        return True
+
+    if os.path.exists(os.path.join(folder, fileName)):
+        with closing(_connect(folder)) as connection:
+            if connection.execute("SELECT 1 FROM iterations WHERE iteration = ?", (iteration,)).fetchone() is not None:
+                with connection:
+                    connection.execute("DELETE FROM iterations WHERE iteration = ?", (iteration,))
+
+    return False
+
+
+def fork(folder, destination, iteration):
+    """Copies the records of the iterations up to iteration from the atlas folder to the destination folder"""
+    with closing(_connect(folder)) as connection, closing(_connect(destination)) as destinationConnection, \
+            destinationConnection:
+        destinationConnection.executemany("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                          connection.execute("SELECT * FROM images WHERE iteration <= ?",
+                                                             (iteration,)).fetchall())
+        destinationConnection.executemany("INSERT OR REPLACE INTO iterations VALUES (?, ?)",
+                                          connection.execute("SELECT * FROM iterations WHERE iteration <= ?",
+                                                             (iteration,)).fetchall())
+
+
+def summary(folder):
+    """Text lines describing the recorded progress of the atlas in folder"""
+    if not os.path.exists(os.path.join(folder, fileName)):
+        return ["No job state recorded in " + folder]
+
+    with closing(_connect(folder)) as connection:
+        counts = connection.execute("SELECT iteration, status, COUNT(*), AVG(duration) FROM images "
+                                    "GROUP BY iteration, status ORDER BY iteration").fetchall()
+        doneIterations = set(row[0] for row in connection.execute("SELECT iteration FROM iterations"))
+
+    iterations = {}
+    for iteration, status, count, meanDuration in counts:
+        iterations.setdefault(iteration, {})[status] = (count, meanDuration)
+
+    lines = []
+    for iteration in sorted(set(iterations) | doneIterations):
+        line = "Iteration " + str(iteration) + (" (done):" if iteration in doneIterations else ":")
+        for status in statuses:
+            count, meanDuration = iterations.get(iteration, {}).get(status, (0, None))
+            line += " " + str(count) + " " + status
+            if meanDuration is not None:
+                line += " (mean " + "%.0f" % meanDuration + " s)"
+            line += ","
+        lines.append(line.rstrip(","))
+
+    return lines
@@ -0,0 +1,261 @@
+# Fused voxelwise operations
+# Chains of simple voxelwise tools (animaImageArithmetic, animaThrImage, animaMaskImage, animaDTIScalarMaps,
+# animaAverageImages...) read and write a whole image at each step. Here such a chain is written as an expression over
+# images and evaluated in process with numpy, in a single pass over the voxels, slab by slab (see animaRuntime.imageio):
+# no intermediate file, no process startup, and no input is loaded in full. For example, tract endings labels:
+#     endings = voxelwise.image(end) * 2 + voxelwise.image(begin)
+#     voxelwise.apply(endings - voxelwise.threshold(endings, 2.1), "labels.nrrd")
+# The output geometry (origin, spacing, direction) is the one of the first input image, all inputs having the same
+# number of voxels. Vector images (e.g. tensors) are handled as (voxels, components) arrays, scalar operands being
+# broadcast over components.
+
+from animaRuntime import execution, imageio
+from animaRuntime.lazy import lazy_import
+
+np = lazy_import("numpy")
+
+
+class Expression(object):
+    """Voxelwise expression over images, evaluated by evaluate() or apply()"""
+
+    def __init__(self, operator, operands):
+        self.operator = operator
+        self.operands = operands
+
+    def paths(self):
+        """Input images of the expression, in order of appearance"""
+        paths = []
+        for operand in self.operands:
+            paths += [p for p in operand.paths() if p not in paths]
+
+        return paths
+
+    def values(self, readers, start, stop):
+        """Values of the expression for voxels start to stop, given readers of the input images"""
+        return self.operator(*[operand.values(readers, start, stop) for operand in self.operands])
+
+    def __add__(self, other):
+        return Expression(lambda a, b: a + b, [self, _wrap(other)])
+
+    def __radd__(self, other):
+        return Expression(lambda a, b: a + b, [_wrap(other), self])
+
+    def __sub__(self, other):
+        return Expression(lambda a, b: a - b, [self, _wrap(other)])
+
+    def __rsub__(self, other):
+        return Expression(lambda a, b: a - b, [_wrap(other), self])
+
+    def __mul__(self, other):
+        return Expression(lambda a, b: a * b, [self, _wrap(other)])
+
+    def __rmul__(self, other):
+        return Expression(lambda a, b: a * b, [_wrap(other), self])
+
+    def __truediv__(self, other):
+        return Expression(lambda a, b: a / b, [self, _wrap(other)])
+
+    def __neg__(self):
+        return Expression(lambda a: -a, [self])
+
+
+class _Image(Expression):
+    def __init__(self, path):
+        Expression.__init__(self, None, [])
+        self.path = path
+
+    def paths(self):
+        return [self.path]
+
+    def values(self, readers, start, stop):
+        return readers[self.path].read_values(start, stop)
+
+
+class _Constant(Expression):
+    def __init__(self, value):
+        Expression.__init__(self, None, [])
+        self.value = float(value)
+
+    def paths(self):
+        return []
+
+    def values(self, readers, start, stop):
+        return self.value
+
+
+def _wrap(value):
+    if isinstance(value, Expression):
+        return value
+
+    return _Constant(value)
+
+
+def image(path):
+    """Voxel values of an image"""
+    return _Image(path)
+
+
+def threshold(expression, value):
+    """1 where expression is strictly above value, 0 elsewhere (as animaThrImage)"""
+    return Expression(lambda a: (a > value).astype(np.float64), [_wrap(expression)])
+
+
+def mask(expression, maskExpression):
+    """expression where maskExpression is strictly positive, 0 elsewhere (as animaMaskImage)"""
+    return Expression(lambda a, m: np.where(m > 0, a, 0.0), [_wrap(expression), _wrap(maskExpression)])
+
+
+def tensor_trace(expression):
+    """Trace of tensors in Anima vector representation (xx, xy, yy, xz, yz, zz). The ADC is a third of it"""
+    return Expression(lambda t: t[:, 0:1] + t[:, 2:3] + t[:, 5:6], [_wrap(expression)])
+
+
+def weighted_mean(expressions, weights=None, masks=None):
+    """Weighted mean of expressions (as animaAverageImages). With masks, each voxel is averaged over the expressions
+    whose mask is positive there, 0 where none is"""
+    weights = weights or [1.0] * len(expressions)
+    if len(weights) != len(expressions) or (masks is not None and len(masks) != len(expressions)):
+        raise ValueError("weighted_mean needs as many weights and masks as expressions")
+
+    numExpressions = len(expressions)
+
+    def mean(*values):
+        total = 0.0
+        totalWeight = 0.0
+        for i in range(numExpressions):
+            weight = weights[i]
+            if masks is not None:
+                weight = weights[i] * (values[numExpressions + i] > 0)
+            total = total + weight * values[i]
+            totalWeight = totalWeight + weight
+
+        if masks is None:
+            return total / totalWeight
+
+        return np.where(totalWeight > 0, total / np.where(totalWeight > 0, totalWeight, 1.0), 0.0)
+
+    return Expression(mean, [_wrap(e) for e in expressions] + [_wrap(m) for m in (masks or [])])
+
+
+def read_weights(path):
+    """Weights from a text file (one per line, as given to animaAverageImages -w)"""
+    with open(path) as weightsFile:
+        return [float(w) for w in weightsFile.read().split()]
+
+
+class WeightedSum(object):
+    """Running weighted sum of images, to average images as they are produced instead of once all exist (as
+    animaAverageImages, masked voxels not contributing). All images must have the same number of voxels and components"""
+
+    def __init__(self):
+        self.header = None
+        self.sum = None
+        self.weights = None
+        self.count = 0
+
+    def add(self, path, weight=1.0, maskPath=None):
+        """Adds weight * image path to the sum, only where the image maskPath (if any) is strictly positive"""
+        with imageio.ImageReader(path) as reader:
+            if self.sum is None:
+                self.header = reader.header
+                self.sum = np.zeros((reader.numVoxels, reader.components))
+                self.weights = np.zeros((reader.numVoxels, 1))
+            elif reader.numVoxels != self.sum.shape[0] or reader.components != self.sum.shape[1]:
+                raise ValueError("image " + path + " does not have the same size as the previous ones")
+
+            maskReader = None
+            if maskPath is not None:
+                maskReader = imageio.ImageReader(maskPath)
+            try:
+                for start, stop in reader.slabs():
+                    voxelWeights = np.full((stop - start, 1), float(weight))
+                    if maskReader is not None:
+                        voxelWeights *= maskReader.read_values(start, stop)[:, 0:1] > 0
+                    self.sum[start:stop] += voxelWeights * reader.read_values(start, stop)
+                    self.weights[start:stop] += voxelWeights
+            finally:
+                if maskReader is not None:
+                    maskReader.close()
+
+        self.count += 1
+
+    def write_partial(self, prefix):
+        """Writes the sum and the weights to prefix_sum.nrrd and prefix_weights.nrrd (in double precision), to be
+        combined with other partial sums by add_partial"""
+        if self.sum is None:
+            raise ValueError("no image to sum")
+
+        for path, values in [(prefix + "_sum.nrrd", self.sum), (prefix + "_weights.nrrd", self.weights)]:
+            with imageio.ImageWriter(path, self.header, "float64", values.shape[1]) as writer:
+                size = imageio.slab_size(self.header)
+                for start in range(0, values.shape[0], size):
+                    writer.write(values[start:min(start + size, values.shape[0])])
+
+    def add_partial(self, prefix):
+        """Adds a partial sum written by write_partial: the mean of partial sums of groups of images is the mean of
+        all the images"""
+        with imageio.ImageReader(prefix + "_sum.nrrd") as reader, \
+                imageio.ImageReader(prefix + "_weights.nrrd") as weightsReader:
+            if self.sum is None:
+                self.header = reader.header
+                self.sum = np.zeros((reader.numVoxels, reader.components))
+                self.weights = np.zeros((reader.numVoxels, 1))
+            elif reader.numVoxels != self.sum.shape[0] or reader.components != self.sum.shape[1]:
+                raise ValueError("partial sum " + prefix + " does not have the same size as the previous ones")
+
+            for start, stop in reader.slabs():
+                self.sum[start:stop] += reader.read_values(start, stop)
+                self.weights[start:stop] += weightsReader.read_values(start, stop)
+
+        self.count += 1
+
+    def write_mean(self, outputPath, type="float32", scale=1.0, compress=None):
+        """Writes scale times the weighted mean (0 where no image contributed) to outputPath"""
+        if self.sum is None:
+            raise ValueError("no image to average")
+
+        with imageio.ImageWriter(outputPath, self.header, type, self.sum.shape[1], compress) as writer:
+            numVoxels = self.sum.shape[0]
+            size = imageio.slab_size(self.header)
+            for start in range(0, numVoxels, size):
+                stop = min(start + size, numVoxels)
+                weights = self.weights[start:stop]
+                writer.write(np.where(weights > 0, scale * self.sum[start:stop] / np.where(weights > 0, weights, 1.0),
+                                      0.0))
+
+
+def evaluate(expression, outputPath, type="float32", compress=None):
+    """Evaluates expression over all voxels and writes it to outputPath (NRRD or NIfTI) with the given pixel type.
+    NRRD outputs are gzip compressed if compress is True, .nii.gz ones always are"""
+    paths = expression.paths()
+    if len(paths) == 0:
+        raise ValueError("voxelwise expression without input image")
+
+    readers = {}
+    writer = None
+    try:
+        for path in paths:
+            readers[path] = imageio.ImageReader(path)
+            if readers[path].numVoxels != readers[paths[0]].numVoxels:
+                raise ValueError("image " + path + " does not have the same size as " + paths[0])
+
+        reference = readers[paths[0]]
+        for start, stop in reference.slabs():
+            values = expression.values(readers, start, stop)
+            if writer is None:
+                writer = imageio.ImageWriter(outputPath, reference.header, type, values.shape[1], compress)
+            writer.write(np.broadcast_to(values, (stop - start, writer.components)))
+
+        writer.close()
+        writer = None
+    finally:
+        if writer is not None:
+            writer.abort()
+        for reader in readers.values():
+            reader.close()
+
+
+def apply(expression, outputPath, type="float32", compress=None):
+    """Evaluates expression into outputPath as a recorded step (see animaRuntime.execution.run)"""
+    execution.run("voxelwise", lambda: evaluate(expression, outputPath, type, compress), expression.paths(),
+                  [outputPath])
@@ -0,0 +1,115 @@
+# Warm start of atlas registrations
+# From one iteration to the next, the reference changes little: the transforms of the previous iteration are a good
+# initialization of the registrations. Merge scripts keep them (linear and nonlinear transforms of each image, and the
+# inverse residual applied to all of them) in warmStartDir before cleaning up tempDir, along with the iteration number.
+# Register scripts of the next iteration then start the affine registration from the previous linear transform and the
+# dense one from the previous nonlinear transform composed with the residual, with fewer pyramid levels.
+# When extending an atlas with new images, the images already in it reuse these transforms instead of being registered
+# again (see reuse).
+
+import glob
+import os
+import shutil
+
+from animaRuntime import tools
+from animaRuntime.execution import call
+
+folderName = "warmStartDir"
+_iterationFileName = "iteration"
+
+
+def save(prefix, indexes, iteration):
+    """Keeps the transforms of images indexes at the iteration from tempDir and residualDir of the current (atlas)
+    folder"""
+    os.makedirs(folderName, exist_ok=True)
+    iterationPath = os.path.join(folderName, _iterationFileName)
+    if os.path.exists(iterationPath):
+        os.remove(iterationPath)
+
+    # Transforms of images not registered at this iteration (e.g. outside its mini-batch) are no longer valid
+    for path in glob.glob(os.path.join(folderName, prefix + "_*_tr.*")):
+        os.remove(path)
+
+    sources = [os.path.join("residualDir", "sumNonlinear_inv_tr.nrrd")]
+    for a in indexes:
+        for suffix in ["_linear_tr.txt", "_nonlinear_tr.nrrd"]:
+            sources.append(os.path.join("tempDir", prefix + "_" + str(a) + suffix))
+
+    for source in sources:
+        # Replaced rather than overwritten: files of forked atlases are hard links to those of the original one
+        destination = os.path.join(folderName, os.path.basename(source))
+        if os.path.exists(destination):
+            os.remove(destination)
+        shutil.copy(source, destination)
+
+    # Written last: transforms are only used once all of them are there
+    with open(iterationPath, "w") as iterationFile:
+        iterationFile.write(str(iteration) + "\n")
+
+
+def saved_iteration(folder):
+    """Iteration whose transforms are kept in folder, None if there are none"""
+    iterationPath = os.path.join(folder, _iterationFileName)
+    if not os.path.exists(iterationPath):
+        return None
+
+    with open(iterationPath) as iterationFile:
+        return int(iterationFile.read().split()[0])
+
+
+def previous_transforms(folder, prefix, index, iteration):
+    """Linear, nonlinear and inverse residual transforms of image index saved by the iteration before iteration, None
+    if there are none"""
+    if saved_iteration(folder) != iteration - 1:
+        return None
+
+    paths = (os.path.join(folder, prefix + "_" + str(index) + "_linear_tr.txt"),
+             os.path.join(folder, prefix + "_" + str(index) + "_nonlinear_tr.nrrd"),
+             os.path.join(folder, "sumNonlinear_inv_tr.nrrd"))
+    if not all(os.path.exists(path) for path in paths):
+        return None
+
+    return paths
+
+
+def initial_field(previousTransforms, affinePath, refImage, bchOrder, outputPath):
+    """Writes to outputPath the dense transform that, following the affine transform affinePath, maps refImage onto
+    the image as the previous iteration did (previousTransforms as returned by previous_transforms)"""
+    linearPath, nonlinearPath, residualPath = previousTransforms
+    basePath = os.path.splitext(outputPath)[0]
+
+    # Difference between the new affine transform and the previous linear one, as a dense transform
+    command = [tools.animaLinearTransformArithmetic, "-i", affinePath, "-M", "-1", "-c", linearPath,
+               "-o", basePath + "_correction.txt"]
+    call(command)
+
+    command = [tools.animaLinearTransformToSVF, "-i", basePath + "_correction.txt", "-o", basePath + "_correction.nrrd",
+               "-g", refImage]
+    call(command)
+
+    command = [tools.animaDenseTransformArithmetic, "-i", basePath + "_correction.nrrd", "-c", nonlinearPath,
+               "-b", str(bchOrder), "-o", outputPath]
+    call(command)
+
+    command = [tools.animaDenseTransformArithmetic, "-i", outputPath, "-c", residualPath, "-b", str(bchOrder),
+               "-o", outputPath]
+    call(command)
+
+    os.remove(basePath + "_correction.txt")
+    os.remove(basePath + "_correction.nrrd")
+
+
+def compose(initialFieldPath, fieldPath, bchOrder):
+    """Replaces fieldPath, estimated after initialFieldPath, by their composition"""
+    command = [tools.animaDenseTransformArithmetic, "-i", initialFieldPath, "-c", fieldPath, "-b", str(bchOrder),
+               "-o", fieldPath]
+    call(command)
+
+
+def reuse(previousTransforms, linearPath, nonlinearPath, bchOrder):
+    """Writes the transforms mapping the current reference (average of the previous iteration) onto the image from the
+    previous ones: the previous linear transform, and the previous nonlinear one composed with the residual"""
+    shutil.copy(previousTransforms[0], linearPath)
+    command = [tools.animaDenseTransformArithmetic, "-i", previousTransforms[1], "-c", previousTransforms[2],
+               "-b", str(bchOrder), "-o", nonlinearPath]
+    call(command)
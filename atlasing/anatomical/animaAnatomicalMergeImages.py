@@ -5,23 +5,13 @@ import argparse
 import os
 import sys
 import glob
-from subprocess import call
+import itertools
 import shutil
 
-if sys.version_info[0] > 2:
-    import configparser as ConfParser
-else:
-    import ConfigParser as ConfParser
-
-configFilePath = os.path.join(os.path.expanduser("~"), ".anima",  "config.txt")
-if not os.path.exists(configFilePath):
-    print('Please create a configuration file for Anima python scripts. Refer to the README')
-    quit()
-
-configParser = ConfParser.RawConfigParser()
-configParser.read(configFilePath)
-
-animaDir = configParser.get("anima-scripts", 'anima')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, os.pardir))
+from animaRuntime import convergence, execution, flags, selection, state, tools, voxelwise, warmstart
+from animaRuntime.atlasimages import AtlasImages, inverseResidualPath
+from animaRuntime.execution import call
 
 # Argument parsing
 parser = argparse.ArgumentParser(
@@ -35,106 +25,173 @@ parser.add_argument('-w', '--weights', type=str, default="", help='Weights text
 parser.add_argument('-n', '--num-images', type=int, required=True, help='Number of images')
 parser.add_argument('-i', '--num-iter', type=int, required=True, help='Iteration number of atlas creation')
 parser.add_argument('-c', '--num-cores', type=int, default=40, help='Number of cores to run on')
+parser.add_argument('--flags-timeout', type=float, default=600,
+                    help="Seconds without any new registration flag after which missing registrations are considered "
+                         "failed (default: 600)")
+parser.add_argument('--displacement-tolerance', type=float, default=0,
+                    help="Mark the atlas as converged when the mean displacement of the template is below this value "
+                         "in mm (default: 0, disabled)")
+parser.add_argument('--change-tolerance', type=float, default=0,
+                    help="Mark the atlas as converged when the relative change of the average since the previous "
+                         "iteration is below this value (default: 0, disabled)")
+parser.add_argument('--warm-start', action='store_true',
+                    help="Keep the transforms of this iteration to start the registrations of the next one")
+parser.add_argument('--selection', type=str, default="",
+                    help="Selection file of the images kept in a weighted atlas, replacing -w (see "
+                         "animaRuntime/selection.py, default: all images)")
+parser.add_argument('--streaming', action='store_true',
+                    help="Add each image to the average as soon as it is registered (merge job started along with the "
+                         "registrations). The residual correction is then applied to the average rather than to each "
+                         "image, which interpolates the average once more")
+parser.add_argument('--reduced', action='store_true',
+                    help="Averages already computed by animaAnatomicalReduceImages.py, only finish the iteration")
 
 args = parser.parse_args()
 os.chdir(args.ref_dir)
 
-animaCreateImage = os.path.join(animaDir,"animaCreateImage")
-animaAverageImages = os.path.join(animaDir,"animaAverageImages")
-animaImageArithmetic = os.path.join(animaDir,"animaImageArithmetic")
-animaTransformSerieXmlGenerator = os.path.join(animaDir,"animaTransformSerieXmlGenerator")
-animaApplyTransformSerie = os.path.join(animaDir,"animaApplyTransformSerie")
+# Images averaged, with their weights
+imageIndexes = list(range(1, args.num_images + 1))
+weightsPath = args.weights
+if not args.selection == "":
+    selectedImages = selection.read(args.selection)
+    imageIndexes = [a for a, _, _ in selectedImages]
+    weightsPath = "selectedWeights.txt"
+    selection.write_weights(selectedImages, weightsPath)
+
+atlasImages = AtlasImages(args.prefix_base, args.prefix, args.files_extension, args.ref_image, args.num_iter)
+
+# In the first iteration, the first image is the reference and is not registered
+firstImage = 1
+if args.num_iter == 0 and args.reduced is False:
+    firstImage = 2
+    atlasImages.write_reference_transforms()
+
+errorPattern = "reg-" + str(max(args.num_iter, 1)) + ".*.error"
+averagePath = "averageForm" + str(max(args.num_iter, 1)) + ".nrrd"
+
+# Images are resampled concurrently, each with a share of the cores
+workers, threads = execution.split_cores(args.num_cores, len(imageIndexes))
+
+
+if args.reduced is True:
+    # The mean nonlinear transform and the average were reduced over groups of images, only partial sums remain
+    for f in glob.glob(os.path.join("residualDir", "reduce_*")):
+        os.remove(f)
+elif args.streaming:
+    # Each image is resampled with its own transforms and added to running weighted sums as soon as it is registered,
+    # the residual correction (inverse of the mean nonlinear transform) being applied once to the average at the end.
+    # This interpolates the average once more than resampling each image with its whole transform serie. In the first
+    # iteration, the reference image is added as is, as it is not resampled either before its residual correction
+    # without streaming
+    weights = [1.0] * len(imageIndexes)
+    if not weightsPath == "":
+        weights = voxelwise.read_weights(weightsPath)
+        if len(weights) != len(imageIndexes):
+            sys.exit("Error: " + weightsPath + " does not hold one weight per image")
+    weights = dict(zip(imageIndexes, weights))
+
+    imagesSum = voxelwise.WeightedSum()
+    nonlinearSum = voxelwise.WeightedSum()
+    registered = flags.iter_flags("residualDir", args.prefix, [a for a in imageIndexes if a >= firstImage],
+                                  timeout=args.flags_timeout, errorPattern=errorPattern)
+    if args.num_iter == 0:
+        registered = itertools.chain([1], registered)
+
+    def resample_registered(a):
+        return atlasImages.resample(a, atlasImages.transforms(a, residual=False), threads)
+
+    for a, (imagePath, maskPath) in execution.parallel_map(resample_registered, registered, workers):
+        execution.run("accumulate", lambda: imagesSum.add(imagePath, weights[a], maskPath),
+                      [imagePath] + ([maskPath] if maskPath is not None else []), [])
+        execution.run("accumulate", lambda: nonlinearSum.add(atlasImages.nonlinear_path(a), weights[a]),
+                      [atlasImages.nonlinear_path(a)], [])
+
+    # Same outputs as animaAverageImages -w (weights normalized by their sum, nonlinear transforms not masked) and
+    # animaImageArithmetic -M -1 without streaming
+    sumPath = os.path.join("residualDir", "sumNonlinear_tr.nrrd")
+    execution.run("average", lambda: nonlinearSum.write_mean(sumPath), [], [sumPath])
+    execution.run("average", lambda: nonlinearSum.write_mean(inverseResidualPath, scale=-1.0), [],
+                  [inverseResidualPath])
+    execution.run("average", lambda: imagesSum.write_mean(os.path.join("tempDir", "average_at.nrrd")), [],
+                  [os.path.join("tempDir", "average_at.nrrd")])
+
+    command = [tools.animaTransformSerieXmlGenerator, "-i", inverseResidualPath,
+               "-o", os.path.join("tempDir", "trsf_residual.xml")]
+    call(command)
 
-# test if all images are here
-nimTest = args.num_images
-if args.num_iter == 0:
-    nimTest -= 1
+    command = [tools.animaApplyTransformSerie, "-i", os.path.join("tempDir", "average_at.nrrd"),
+               "-t", os.path.join("tempDir", "trsf_residual.xml"), "-g", args.ref_image, "-o", averagePath,
+               "-p", str(args.num_cores)]
+    call(command)
+else:
+    # Wait for all registrations, failing as soon as one is known to have failed
+    flags.wait_for_flags("residualDir", args.prefix, [a for a in imageIndexes if a >= firstImage],
+                         timeout=args.flags_timeout, errorPattern=errorPattern)
 
-numData = len(glob.glob(os.path.join("residualDir",args.prefix + "_*_flag")))
-while numData < nimTest:
-    print("Missing data " + str(numData) + " " + str(nimTest))
-    call(["sleep","600"])
-    numData = len(glob.glob(os.path.join("residualDir", args.prefix + "_*_flag")))
+    myfile = open("sumNonlinear.txt","w")
+    for a in imageIndexes:
+        myfile.write(atlasImages.nonlinear_path(a) + "\n")
 
-# if ok proceed
-if args.num_iter == 0:
-    # Write identity transform
-    myfile = open(os.path.join("tempDir",args.prefix + "_1_linear_tr.txt"),"w")
-    myfile.write("#Insight Transform File V1.0\n")
-    myfile.write("# Transform 0\n")
-    myfile.write("Transform: AffineTransform_double_3_3\n")
-    myfile.write("Parameters: 1 0 0 0 1 0 0 0 1 0 0 0\n")
-    myfile.write("FixedParameters: 0 0 0\n")
     myfile.close()
 
-    command = [animaCreateImage,"-o",os.path.join("tempDir",args.prefix + "_1_nonlinear_tr.nrrd"),
-               "-b","0","-g",os.path.join(args.prefix_base,args.prefix + "_1" + args.files_extension),"-v","3"]
+    command = [tools.animaAverageImages, "-i", "sumNonlinear.txt","-o",os.path.join("residualDir","sumNonlinear_tr.nrrd")]
+    if not weightsPath == "":
+        command += ["-w",weightsPath]
+
     call(command)
 
-myfile = open("sumNonlinear.txt","w")
-for a in range(1,args.num_images + 1):
-    myfile.write(os.path.join("tempDir",args.prefix + "_" + str(a) + "_nonlinear_tr.nrrd") + "\n")
-
-myfile.close()
-
-command = [animaAverageImages, "-i", "sumNonlinear.txt","-o",os.path.join("residualDir","sumNonlinear_tr.nrrd")]
-if not args.weights == "":
-    command += ["-w",args.weights]
-
-call(command)
-
-command = [animaImageArithmetic,"-i",os.path.join("residualDir", "sumNonlinear_tr.nrrd"), "-M", "-1",
-           "-o", os.path.join("residualDir", "sumNonlinear_inv_tr.nrrd")]
-call(command)
-
-myfileImages = open("refIms.txt","w")
-myfileMasks = open("masksIms.txt","w")
-for a in range(1,args.num_images+1):
-    if a == 1 and args.num_iter == 0:
-        command = [animaTransformSerieXmlGenerator,"-i",os.path.join("residualDir", "sumNonlinear_inv_tr.nrrd"),
-                   "-o",os.path.join("tempDir", "trsf_" + str(a) + ".xml")]
-        call(command)
-    else:
-        command = [animaTransformSerieXmlGenerator,"-i",os.path.join("tempDir", args.prefix + "_" + str(a) + "_linear_tr.txt"),
-                   "-i", os.path.join("tempDir",args.prefix + "_" + str(a) + "_nonlinear_tr.nrrd"),
-                   "-i",os.path.join("residualDir","sumNonlinear_inv_tr.nrrd"),
-                   "-o",os.path.join("tempDir","trsf_" + str(a) + ".xml")]
-        call(command)
-
-    command = [animaApplyTransformSerie, "-i",
-               os.path.join(args.prefix_base, args.prefix + "_" + str(a) + args.files_extension),
-               "-t", os.path.join("tempDir", "trsf_" + str(a) + ".xml"), "-g", args.ref_image,
-               "-o",os.path.join("tempDir", args.prefix + "_" + str(a) + "_at.nrrd"),"-p",str(args.num_cores)]
+    command = [tools.animaImageArithmetic,"-i",os.path.join("residualDir", "sumNonlinear_tr.nrrd"), "-M", "-1",
+               "-o", inverseResidualPath]
     call(command)
-    myfileImages.write(os.path.join("tempDir", args.prefix + "_" + str(a) + "_at.nrrd\n"))
 
-    if os.path.exists(os.path.join("Masks", "Mask_" + str(a) + args.files_extension)):
-        command = [animaApplyTransformSerie, "-i", os.path.join("Masks", "Mask_" + str(a) + args.files_extension),
-                   "-t", os.path.join("tempDir", "trsf_" + str(a) + ".xml"),
-                   "-g", args.ref_image, "-o", os.path.join("tempDir", "Mask_" + str(a) + "_at.nrrd"),
-                   "-n", "nearest", "-p", str(args.num_cores)]
-        call(command)
-        myfileMasks.write(os.path.join("tempDir","Mask_" + str(a) + "_at.nrrd\n"))
+    for _ in execution.parallel_map(lambda a: atlasImages.resample(a, atlasImages.transforms(a), threads),
+                                    imageIndexes, workers):
+        pass
 
-myfileImages.close()
-myfileMasks.close()
+    # Lists in image order, matching the weights
+    myfileImages = open("refIms.txt","w")
+    myfileMasks = open("masksIms.txt","w")
+    for a in imageIndexes:
+        myfileImages.write(atlasImages.resampled_path(a) + "\n")
+        if atlasImages.mask_path(a) is not None:
+            myfileMasks.write(atlasImages.mask_path(a) + "\n")
 
-if args.num_iter == 0:
-    command = [animaAverageImages,"-i","refIms.txt","-o","averageForm1.nrrd"]
-else:
-    command = [animaAverageImages,"-i","refIms.txt","-o","averageForm" + str(args.num_iter) + ".nrrd"]
+    myfileImages.close()
+    myfileMasks.close()
+
+    command = [tools.animaAverageImages,"-i","refIms.txt","-o",averagePath]
+    if not weightsPath == "":
+        command += ["-w",weightsPath]
+
+    if os.path.exists(os.path.join("Masks","Mask_1" + args.files_extension)):
+        command += ["-m","masksIms.txt"]
+
+    call(command)
+
+# Convergence metrics, computed before residualDir is cleaned up
+iteration = max(args.num_iter, 1)
+if os.path.exists(averagePath):
+    displacementRms, displacementMax = convergence.displacement_norm(inverseResidualPath)
+    change = None
+    previousPath = "averageForm" + str(iteration - 1) + ".nrrd"
+    if iteration > 1 and os.path.exists(previousPath):
+        change = convergence.relative_change(averagePath, previousPath)
 
-if not args.weights == "":
-    command += ["-w",args.weights]
+    convergence.record(iteration, displacementRms, displacementMax, change)
+    if convergence.is_converged(displacementRms, change, args.displacement_tolerance, args.change_tolerance):
+        convergence.mark_converged(iteration)
 
-if os.path.exists(os.path.join("Masks","Mask_1" + args.files_extension)):
-    command += ["-m","masksIms.txt"]
+    if args.warm_start is True:
+        warmstart.save(args.prefix, imageIndexes, iteration)
 
-call(command)
+    # Second runs of straggling registrations not started yet are no longer needed
+    for f in glob.glob("specRun_" + str(iteration) + "_*"):
+        os.remove(f)
 
 if args.num_iter == 0:
     if os.path.exists("averageForm1.nrrd"):
         open("it_1_done","w").close()
+        state.record_iteration(os.getcwd(), 1)
         if os.path.exists("iterRun_2"):
             shutil.rmtree("residualDir")
             shutil.rmtree("tempDir")
@@ -144,6 +201,7 @@ if args.num_iter == 0:
 else:
     if os.path.exists("averageForm" + str(args.num_iter) + ".nrrd"):
         open("it_" + str(args.num_iter) + "_done","w").close()
+        state.record_iteration(os.getcwd(), args.num_iter)
         t = args.num_iter + 1
         if os.path.exists("iterRun_" + str(t)):
             shutil.rmtree("residualDir")
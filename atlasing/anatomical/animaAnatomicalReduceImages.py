@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+# Warning: works only on unix-like systems, not windows where "python animaAnatomicalReduceImages.py ..." has to be run
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, os.pardir))
+from animaRuntime import execution, flags, reduction, selection, voxelwise
+from animaRuntime.atlasimages import AtlasImages, inverseResidualPath
+
+# Argument parsing
+parser = argparse.ArgumentParser(
+    description="Reduces a group of registered images or of partial sums into a partial sum, or into the average at the "
+                "last level (to be used from build anatomical atlas, see animaRuntime/reduction.py).")
+parser.add_argument('-d', '--ref-dir', type=str, required=True, help='Reference (working) folder')
+parser.add_argument('-r', '--ref-image', type=str, required=True, help='Reference image')
+parser.add_argument('-e', '--files-extension', type=str, required=True, help='Input files extension')
+parser.add_argument('-B', '--prefix-base', type=str, required=True, help='Prefix base')
+parser.add_argument('-p', '--prefix', type=str, required=True, help='Prefix')
+parser.add_argument('-w', '--weights', type=str, default="", help='Weights text file')
+parser.add_argument('--selection', type=str, default="",
+                    help="Selection file of the images kept in a weighted atlas, replacing -w (see "
+                         "animaRuntime/selection.py, default: all images)")
+parser.add_argument('-n', '--num-images', type=int, required=True, help='Number of images')
+parser.add_argument('-i', '--num-iter', type=int, required=True, help='Iteration number of atlas creation')
+parser.add_argument('-c', '--num-cores', type=int, default=40, help='Number of cores to run on')
+parser.add_argument('--stage', type=str, required=True, choices=["nonlinear", "images"],
+                    help="Average reduced: mean nonlinear transform, or average of the resampled images")
+parser.add_argument('--level', type=int, required=True, help='Level of the reduction')
+parser.add_argument('--group', type=int, required=True, help='Group reduced at this level (from 1)')
+parser.add_argument('--group-size', type=int, required=True, help='Number of inputs of each group')
+parser.add_argument('--flags-timeout', type=float, default=600,
+                    help="Seconds without any new registration flag after which missing registrations are considered "
+                         "failed (default: 600)")
+
+args = parser.parse_args()
+os.chdir(args.ref_dir)
+
+# Images averaged, with their weights
+imageIndexes = list(range(1, args.num_images + 1))
+weights = [1.0] * args.num_images
+if not args.selection == "":
+    selectedImages = selection.read(args.selection)
+    imageIndexes = [a for a, _, _ in selectedImages]
+    weights = [w for _, w, _ in selectedImages]
+elif not args.weights == "":
+    weights = voxelwise.read_weights(args.weights)
+    if len(weights) != args.num_images:
+        sys.exit("Error: " + args.weights + " does not hold one weight per image")
+
+members = reduction.group_members(len(imageIndexes), args.group_size, args.level, args.group)
+lastLevel = reduction.num_levels(len(imageIndexes), args.group_size) - 1
+atlasImages = AtlasImages(args.prefix_base, args.prefix, args.files_extension, args.ref_image, args.num_iter)
+
+weightedSum = voxelwise.WeightedSum()
+if args.level > 0:
+    for m in members:
+        partialPrefix = reduction.partial_prefix("residualDir", args.stage, args.level - 1, m + 1)
+        execution.run("accumulate", lambda: weightedSum.add_partial(partialPrefix),
+                      [partialPrefix + "_sum.nrrd", partialPrefix + "_weights.nrrd"], [])
+elif args.stage == "nonlinear":
+    groupImages = [imageIndexes[m] for m in members]
+
+    # In the first iteration, the first image is the reference and is not registered
+    if args.num_iter == 0 and 1 in groupImages:
+        atlasImages.write_reference_transforms()
+
+    flags.wait_for_flags("residualDir", args.prefix, [a for a in groupImages if not atlasImages.is_reference(a)],
+                         timeout=args.flags_timeout, errorPattern="reg-" + str(max(args.num_iter, 1)) + ".*.error")
+
+    for m in members:
+        a = imageIndexes[m]
+        execution.run("accumulate", lambda: weightedSum.add(atlasImages.nonlinear_path(a), weights[m]),
+                      [atlasImages.nonlinear_path(a)], [])
+else:
+    # Images of the group are resampled concurrently, each with a share of the cores
+    workers, threads = execution.split_cores(args.num_cores, len(members))
+
+    def resample_with_residual(m):
+        a = imageIndexes[m]
+        return atlasImages.resample(a, atlasImages.transforms(a), threads)
+
+    for m, (imagePath, maskPath) in execution.parallel_map(resample_with_residual, members, workers):
+        execution.run("accumulate", lambda: weightedSum.add(imagePath, weights[m], maskPath),
+                      [imagePath] + ([maskPath] if maskPath is not None else []), [])
+
+if args.level < lastLevel:
+    partialPrefix = reduction.partial_prefix("residualDir", args.stage, args.level, args.group)
+    execution.run("partial sum", lambda: weightedSum.write_partial(partialPrefix), [],
+                  [partialPrefix + "_sum.nrrd", partialPrefix + "_weights.nrrd"])
+elif args.stage == "nonlinear":
+    sumPath = os.path.join("residualDir", "sumNonlinear_tr.nrrd")
+    execution.run("average", lambda: weightedSum.write_mean(sumPath), [], [sumPath])
+    execution.run("average", lambda: weightedSum.write_mean(inverseResidualPath, scale=-1.0), [],
+                  [inverseResidualPath])
+else:
+    averagePath = "averageForm" + str(max(args.num_iter, 1)) + ".nrrd"
+    execution.run("average", lambda: weightedSum.write_mean(averagePath), [], [averagePath])
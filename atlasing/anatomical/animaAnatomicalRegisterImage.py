@@ -4,23 +4,12 @@
 import argparse
 import os
 import sys
-from subprocess import call
 import shutil
+import time
 
-if sys.version_info[0] > 2:
-    import configparser as ConfParser
-else:
-    import ConfigParser as ConfParser
-
-configFilePath = os.path.join(os.path.expanduser("~"), ".anima",  "config.txt")
-if not os.path.exists(configFilePath):
-    print('Please create a configuration file for Anima python scripts. Refer to the README')
-    quit()
-
-configParser = ConfParser.RawConfigParser()
-configParser.read(configFilePath)
-
-animaDir = configParser.get("anima-scripts", 'anima')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, os.pardir))
+from animaRuntime import flags, jobs, schedule, speculation, state, tools, warmstart
+from animaRuntime.execution import call
 
 # Argument parsing
 parser = argparse.ArgumentParser(
@@ -34,76 +23,175 @@ parser.add_argument('-b', '--bch-order', type=int, default=2, help='BCH order wh
 parser.add_argument('-n', '--num-image', type=int, required=True, help='Image number')
 parser.add_argument('-c', '--num-cores', type=int, default=40, help='Number of cores to run on')
 parser.add_argument('--rigid', action='store_true', help="Unbiased atlas up to a rigid transformation")
+parser.add_argument('--schedule', type=str, default="full",
+                    help="Registration schedule: built-in schedule name or schedule file (default: full, see "
+                         "animaRuntime/schedule.py)")
+parser.add_argument('--iteration', type=int, default=1, help='Atlas iteration, for the schedule (default: 1)')
+parser.add_argument('--num-iterations', type=int, default=1, help='Number of atlas iterations, for the schedule (default: 1)')
+parser.add_argument('--warm-start', action='store_true',
+                    help="Start from the transforms of the previous iteration when available")
+parser.add_argument('--reuse-transforms', action='store_true',
+                    help="Reuse the transforms of the previous iteration instead of registering the image (images "
+                         "already in an extended atlas)")
+parser.add_argument('--affine-only', action='store_true',
+                    help="Only register the image with an affine (or rigid) transform, its nonlinear transform being "
+                         "zero (low weight images of weighted atlases)")
+parser.add_argument('--attempt', type=int, default=0,
+                    help="Attempt number when registrations may be run speculatively more than once, the first "
+                         "attempt to finish being kept (default: 0, single attempt)")
 
 args = parser.parse_args()
 os.chdir(args.ref_dir)
 basePrefBase = os.path.dirname(args.prefix_base)
 
-animaPyramidalBMRegistration = os.path.join(animaDir,"animaPyramidalBMRegistration")
-animaDenseSVFBMRegistration = os.path.join(animaDir,"animaDenseSVFBMRegistration")
-animaTransformSerieXmlGenerator = os.path.join(animaDir,"animaTransformSerieXmlGenerator")
-animaLinearTransformArithmetic = os.path.join(animaDir,"animaLinearTransformArithmetic")
-animaLinearTransformToSVF = os.path.join(animaDir,"animaLinearTransformToSVF")
-animaDenseTransformArithmetic = os.path.join(animaDir,"animaDenseTransformArithmetic")
+# Speculative attempts work on their own files (see animaRuntime.speculation)
+imageName = args.prefix + "_" + str(args.num_image)
+attemptSuffix = speculation.attempt_suffix(args.attempt)
+workName = imageName + attemptSuffix
 
-filesExtension = args.files_extension
-
-# Rigid / affine registration
-command = [animaPyramidalBMRegistration,"-r",args.ref_image,"-m",os.path.join(args.prefix_base,args.prefix + "_" + str(args.num_image) + filesExtension),
-           "-o",os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_aff.nrrd"),
-           "-O",os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_aff_tr.txt"),
-           "--out-rigid",os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_aff_nr_tr.txt"),
-           "--ot","2","-p","3","-l","0","-I","2","-T",str(args.num_cores),"--sym-reg","2"]
-call(command)
-
-# Non-Rigid registration
-
-# For basic atlases
-command = [animaDenseSVFBMRegistration,"-r",args.ref_image,"-m",os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_aff.nrrd"),
-           "-o",os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_bal.nrrd"),
-           "-O",os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_bal_tr.nrrd"),
-           "--sr","1","--es","3","--fs","2","-T",str(args.num_cores),"--sym-reg","2","--metric","1"]
-call(command)
-
-if args.rigid is True:
-    shutil.move(os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_aff_nr_tr.txt"),
-                os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_linear_tr.txt"))
-
-    command = [animaLinearTransformArithmetic,"-i",os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_linear_tr.txt"),
-               "-M","-1","-c",os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_aff_tr.txt"),
-               "-o",os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_linearaddon_tr.txt")]
-    call(command)
+startTime = time.time()
+if args.attempt > 0:
+    speculation.mark_started(os.path.join(basePrefBase,"residualDir"), args.prefix, args.num_image, args.attempt)
 
-    command = [animaLinearTransformToSVF,"-i",os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_linearaddon_tr.txt"),
-               "-o",os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_linearaddon_tr.nrrd"),
-               "-g",args.ref_image]
-    call(command)
+# A second attempt would otherwise hide the result of the first one if it finished in between
+if args.attempt <= 1:
+    state.record_image(os.getcwd(), args.iteration, args.num_image, "running", startTime)
 
-    command = [animaDenseTransformArithmetic,"-i",os.path.join(basePrefBase, "tempDir", args.prefix + "_" + str(args.num_image) + "_linearaddon_tr.nrrd"),
-               "-c",os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_bal_tr.nrrd"),
-               "-b",str(args.bch_order),
-               "-o",os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_nonlinear_tr.nrrd")]
-    call(command)
-else:
-    shutil.move(os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_aff_tr.txt"),
-                os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_linear_tr.txt"))
-    shutil.move(os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_bal_tr.nrrd"),
-                os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_nonlinear_tr.nrrd"))
-
-if os.path.exists(os.path.join(os.getcwd(), "residualDir", args.prefix + "_" + str(args.num_image) + "_nonlinear_tr.nrrd")):
-    os.remove(os.path.join(os.getcwd(), "residualDir", args.prefix + "_" + str(args.num_image) + "_nonlinear_tr.nrrd"))
-
-os.symlink(os.path.join(os.getcwd(),"tempDir",args.prefix + "_" + str(args.num_image) + "_linear_tr.txt"),
-           os.path.join(os.getcwd(), "residualDir", args.prefix + "_" + str(args.num_image) + "_linear_tr.txt"))
+filesExtension = args.files_extension
 
-os.symlink(os.path.join(os.getcwd(),"tempDir",args.prefix + "_" + str(args.num_image) + "_nonlinear_tr.nrrd"),
-           os.path.join(os.getcwd(), "residualDir", args.prefix + "_" + str(args.num_image) + "_nonlinear_tr.nrrd"))
+# Transforms of the previous iteration: the registrations start closer to the solution and need one less pyramid level
+previousTransforms = None
+if args.warm_start is True or args.reuse_transforms is True:
+    previousTransforms = warmstart.previous_transforms(os.path.join(basePrefBase, warmstart.folderName), args.prefix,
+                                                       args.num_image, args.iteration)
 
-if os.path.exists(os.path.join(os.getcwd(),"tempDir",args.prefix + "_" + str(args.num_image) + "_nonlinear_tr.nrrd")):
-    open(os.path.join(basePrefBase,"residualDir",args.prefix + "_" + str(args.num_image) + "_flag"), 'a').close()
+if args.reuse_transforms is True:
+    if previousTransforms is None:
+        sys.exit("Error: no transforms of the previous iteration to reuse for image " + str(args.num_image))
 
-if os.path.exists(os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_bal_tr.nrrd")):
-    os.remove(os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_bal_tr.nrrd"))
+    # Much shorter than a registration, not to be used to set walltimes
+    jobs.mark_untimed_task()
+    warmstart.reuse(previousTransforms, os.path.join(basePrefBase,"tempDir",workName + "_linear_tr.txt"),
+                    os.path.join(basePrefBase,"tempDir",workName + "_nonlinear_tr.nrrd"), args.bch_order)
+else:
+    # Rigid / affine registration
+    command = [tools.animaPyramidalBMRegistration,"-r",args.ref_image,"-m",os.path.join(args.prefix_base,imageName + filesExtension),
+               "-o",os.path.join(basePrefBase,"tempDir",workName + "_aff.nrrd"),
+               "-O",os.path.join(basePrefBase,"tempDir",workName + "_aff_tr.txt"),
+               "--out-rigid",os.path.join(basePrefBase,"tempDir",workName + "_aff_nr_tr.txt"),
+               "--ot","2","-p","3","-l","0","-I","2","-T",str(args.num_cores),"--sym-reg","2"]
+    if previousTransforms is not None:
+        command = schedule.apply(command, {"-i": previousTransforms[0], "-p": "2"})
+    command = schedule.apply(command, schedule.options(args.schedule, "linear", args.iteration, args.num_iterations))
+    call(command)
 
-if os.path.exists(os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_linearaddon_tr.nrrd")):
-    os.remove(os.path.join(basePrefBase,"tempDir",args.prefix + "_" + str(args.num_image) + "_linearaddon_tr.nrrd"))
+    if args.affine_only is True:
+        # Zero nonlinear transform in place of the estimated one
+        command = [tools.animaCreateImage,"-b","0","-v","3","-g",args.ref_image,
+                   "-o",os.path.join(basePrefBase,"tempDir",workName + "_bal_tr.nrrd")]
+        call(command)
+    else:
+        # Non-Rigid registration
+        warmFieldPath = os.path.join(basePrefBase,"tempDir",workName + "_warm_tr.nrrd")
+        if previousTransforms is not None:
+            # Moving image resampled with the affine transform followed by the previous nonlinear one
+            warmstart.initial_field(previousTransforms, os.path.join(basePrefBase,"tempDir",workName + "_aff_tr.txt"),
+                                    args.ref_image, args.bch_order, warmFieldPath)
+
+            command = [tools.animaTransformSerieXmlGenerator,"-i",os.path.join(basePrefBase,"tempDir",workName + "_aff_tr.txt"),
+                       "-i",warmFieldPath,"-o",os.path.join(basePrefBase,"tempDir",workName + "_warm_tr.xml")]
+            call(command)
+
+            command = [tools.animaApplyTransformSerie,"-i",os.path.join(args.prefix_base,imageName + filesExtension),
+                       "-t",os.path.join(basePrefBase,"tempDir",workName + "_warm_tr.xml"),"-g",args.ref_image,
+                       "-o",os.path.join(basePrefBase,"tempDir",workName + "_aff.nrrd"),"-p",str(args.num_cores)]
+            call(command)
+
+        # For basic atlases
+        command = [tools.animaDenseSVFBMRegistration,"-r",args.ref_image,"-m",os.path.join(basePrefBase,"tempDir",workName + "_aff.nrrd"),
+                   "-o",os.path.join(basePrefBase,"tempDir",workName + "_bal.nrrd"),
+                   "-O",os.path.join(basePrefBase,"tempDir",workName + "_bal_tr.nrrd"),
+                   "--sr","1","--es","3","--fs","2","-T",str(args.num_cores),"--sym-reg","2","--metric","1"]
+        if previousTransforms is not None:
+            command = schedule.apply(command, {"-p": "2"})
+        command = schedule.apply(command, schedule.options(args.schedule, "nonlinear", args.iteration, args.num_iterations))
+        call(command)
+
+        if previousTransforms is not None:
+            warmstart.compose(warmFieldPath, os.path.join(basePrefBase,"tempDir",workName + "_bal_tr.nrrd"),
+                              args.bch_order)
+
+    if args.rigid is True:
+        shutil.move(os.path.join(basePrefBase,"tempDir",workName + "_aff_nr_tr.txt"),
+                    os.path.join(basePrefBase,"tempDir",workName + "_linear_tr.txt"))
+
+        command = [tools.animaLinearTransformArithmetic,"-i",os.path.join(basePrefBase,"tempDir",workName + "_linear_tr.txt"),
+                   "-M","-1","-c",os.path.join(basePrefBase,"tempDir",workName + "_aff_tr.txt"),
+                   "-o",os.path.join(basePrefBase,"tempDir",workName + "_linearaddon_tr.txt")]
+        call(command)
+
+        command = [tools.animaLinearTransformToSVF,"-i",os.path.join(basePrefBase,"tempDir",workName + "_linearaddon_tr.txt"),
+                   "-o",os.path.join(basePrefBase,"tempDir",workName + "_linearaddon_tr.nrrd"),
+                   "-g",args.ref_image]
+        call(command)
+
+        command = [tools.animaDenseTransformArithmetic,"-i",os.path.join(basePrefBase, "tempDir", workName + "_linearaddon_tr.nrrd"),
+                   "-c",os.path.join(basePrefBase,"tempDir",workName + "_bal_tr.nrrd"),
+                   "-b",str(args.bch_order),
+                   "-o",os.path.join(basePrefBase,"tempDir",workName + "_nonlinear_tr.nrrd")]
+        call(command)
+    else:
+        shutil.move(os.path.join(basePrefBase,"tempDir",workName + "_aff_tr.txt"),
+                    os.path.join(basePrefBase,"tempDir",workName + "_linear_tr.txt"))
+        shutil.move(os.path.join(basePrefBase,"tempDir",workName + "_bal_tr.nrrd"),
+                    os.path.join(basePrefBase,"tempDir",workName + "_nonlinear_tr.nrrd"))
+
+# The first attempt to finish publishes its transforms, the others are discarded
+published = True
+if args.attempt > 0:
+    if not os.path.exists(os.path.join(basePrefBase,"tempDir",workName + "_nonlinear_tr.nrrd")):
+        # The image only fails once no other attempt may still register it
+        published = False
+        if speculation.mark_attempt_failed(os.path.join(basePrefBase,"residualDir"), args.prefix, args.num_image,
+                                           args.attempt, "no nonlinear transform was produced"):
+            state.record_image(os.getcwd(), args.iteration, args.num_image, "failed", startTime)
+    elif state.iteration_done(os.getcwd(), args.iteration):
+        # Iteration merged without this attempt
+        published = False
+    else:
+        published = speculation.publish(os.path.join(basePrefBase,"residualDir"), args.prefix, args.num_image,
+                                        [(os.path.join(basePrefBase,"tempDir",workName + "_linear_tr.txt"),
+                                          os.path.join(basePrefBase,"tempDir",imageName + "_linear_tr.txt")),
+                                         (os.path.join(basePrefBase,"tempDir",workName + "_nonlinear_tr.nrrd"),
+                                          os.path.join(basePrefBase,"tempDir",imageName + "_nonlinear_tr.nrrd"))])
+
+if published:
+    if os.path.exists(os.path.join(os.getcwd(), "residualDir", args.prefix + "_" + str(args.num_image) + "_nonlinear_tr.nrrd")):
+        os.remove(os.path.join(os.getcwd(), "residualDir", args.prefix + "_" + str(args.num_image) + "_nonlinear_tr.nrrd"))
+
+    os.symlink(os.path.join(os.getcwd(),"tempDir",args.prefix + "_" + str(args.num_image) + "_linear_tr.txt"),
+               os.path.join(os.getcwd(), "residualDir", args.prefix + "_" + str(args.num_image) + "_linear_tr.txt"))
+
+    os.symlink(os.path.join(os.getcwd(),"tempDir",args.prefix + "_" + str(args.num_image) + "_nonlinear_tr.nrrd"),
+               os.path.join(os.getcwd(), "residualDir", args.prefix + "_" + str(args.num_image) + "_nonlinear_tr.nrrd"))
+
+    if os.path.exists(os.path.join(os.getcwd(),"tempDir",args.prefix + "_" + str(args.num_image) + "_nonlinear_tr.nrrd")):
+        open(os.path.join(basePrefBase,"residualDir",args.prefix + "_" + str(args.num_image) + "_flag"), 'a').close()
+        state.record_image(os.getcwd(), args.iteration, args.num_image, "done", startTime,
+                           [os.path.join("tempDir",args.prefix + "_" + str(args.num_image) + "_linear_tr.txt"),
+                            os.path.join("tempDir",args.prefix + "_" + str(args.num_image) + "_nonlinear_tr.nrrd")])
+    else:
+        flags.mark_failed(os.path.join(basePrefBase,"residualDir"), args.prefix, args.num_image,
+                          "no nonlinear transform was produced")
+        state.record_image(os.getcwd(), args.iteration, args.num_image, "failed", startTime)
+
+if os.path.exists(os.path.join(basePrefBase,"tempDir",workName + "_bal_tr.nrrd")):
+    os.remove(os.path.join(basePrefBase,"tempDir",workName + "_bal_tr.nrrd"))
+
+if os.path.exists(os.path.join(basePrefBase,"tempDir",workName + "_linearaddon_tr.nrrd")):
+    os.remove(os.path.join(basePrefBase,"tempDir",workName + "_linearaddon_tr.nrrd"))
+
+for warmPath in [os.path.join(basePrefBase,"tempDir",workName + "_warm_tr.nrrd"),
+                 os.path.join(basePrefBase,"tempDir",workName + "_warm_tr.xml")]:
+    if os.path.exists(warmPath):
+        os.remove(warmPath)
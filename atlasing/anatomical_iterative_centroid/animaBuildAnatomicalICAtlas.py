@@ -6,24 +6,15 @@ import os
 import glob
 import stat
 import sys
-import subprocess
 import shutil
 
-if sys.version_info[0] > 2:
-    import configparser as ConfParser
-else:
-    import ConfigParser as ConfParser
-
-configFilePath = os.path.join(os.path.expanduser("~"), ".anima",  "config.txt")
-if not os.path.exists(configFilePath):
-    print('Please create a configuration file for Anima python scripts. Refer to the README')
-    quit()
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, os.pardir))
+from animaRuntime import config, images, jobs, tools
+from animaRuntime.execution import call
 
-configParser = ConfParser.RawConfigParser()
-configParser.read(configFilePath)
+animaScriptsDir = config.scripts_public_dir()
 
-animaDir = configParser.get("anima-scripts", 'anima')
-animaScriptsDir = configParser.get("anima-scripts", 'anima-scripts-public-root')
+imageFormats = ["nrrd", "nii", "nii.gz"]
 
 # Argument parsing
 parser = argparse.ArgumentParser(
@@ -34,8 +25,18 @@ parser.add_argument('-c', '--num-cores', type=int, default=8, help='Number of co
 parser.add_argument('-b', '--bch-order', type=int, default=2, help='BCH order when composing transformations (default: 2)')
 parser.add_argument('-s', '--start', type=int, default=1, help='number of images in the starting atlas (default: 1)')
 parser.add_argument('--rigid', action='store_true', help="Unbiased atlas up to a rigid transformation")
+parser.add_argument('-f', '--intermediate-format', type=str, default=config.get("intermediate-format", "nrrd"),
+                    choices=imageFormats, help='Format of intermediate images, uncompressed is faster (default: nrrd, or intermediate-format in the config file)')
+parser.add_argument('-e', '--atlas-format', type=str, default="nii.gz", choices=imageFormats,
+                    help='Format of the final atlas image (default: nii.gz)')
+parser.add_argument('--scheduler', type=str, default=jobs.default_scheduler(), choices=jobs.schedulers,
+                    help="Submit jobs to OAR or run them on this machine (default: oar, or scheduler in the config file)")
 
 args = parser.parse_args()
+jobs.set_scheduler(args.scheduler)
+
+intermediateExtension = "." + args.intermediate_format
+atlasExtension = "." + args.atlas_format
 
 if not os.path.exists('tempDir'):
     os.makedirs('tempDir')
@@ -48,11 +49,26 @@ os.makedirs('residualDir')
 prefixBase = os.path.dirname(args.data_prefix)
 prefix = os.path.basename(args.data_prefix)
 
+# Check the whole dataset before submitting any job
+imageErrors = images.check_images([args.data_prefix + "_" + str(i) + ".nii.gz" for i in range(1, args.num_images + 1)])
+if len(imageErrors) > 0:
+    sys.exit("Error: invalid dataset images:\n" + "\n".join(imageErrors))
+
 if args.start == 1 or args.start == 0:
-    shutil.copyfile(os.path.join(prefixBase, prefix + "_1.nii.gz"), "averageForm1.nii.gz")
-    args.start = 1 
+    startImage = os.path.join(prefixBase, prefix + "_1.nii.gz")
+    args.start = 1
+else:
+    # Starting atlas built previously, possibly in another format
+    startImage = "averageForm" + str(args.start) + atlasExtension
+
+startForm = "averageForm" + str(args.start) + intermediateExtension
+if startImage != startForm and (args.start == 1 or not os.path.exists(startForm)):
+    if intermediateExtension == ".nii.gz":
+        shutil.copyfile(startImage, startForm)
+    else:
+        call([tools.animaConvertImage, "-i", startImage, "-o", startForm])
 
-previousMergeId = 0
+previousMergeIds = []
 
 for k in range(args.start + 1, args.num_images + 1):
     if os.path.exists('it_' + str(k) + '_done'):
@@ -62,7 +78,7 @@ for k in range(args.start + 1, args.num_images + 1):
 
     print("*************Incorporating image: " + str(k) + " in atlas: " + ref)
 
-    for f in glob.glob("residualDir/" + prefix + '_*_nl_tr.nii.gz') + glob.glob("residualDir/" + prefix + '_*_flag'):
+    for f in glob.glob("residualDir/" + prefix + '_*_nl_tr' + intermediateExtension) + glob.glob("residualDir/" + prefix + '_*_flag'):
         os.remove(f)
 
     nCoresPhysical = int(args.num_cores / 2)
@@ -79,8 +95,8 @@ for k in range(args.start + 1, args.num_images + 1):
     myfile.write("cd " + os.getcwd() + "\n")
 
     myfile.write(os.path.join(animaScriptsDir,"atlasing/anatomical_iterative_centroid/animaICAnatomicalRegisterImage.py") +
-                 " -d " + os.getcwd() + " -r " + ref + ".nii.gz -B " + prefixBase + " -p " + prefix + " -i " + str(k) +
-                 " -b " + str(args.bch_order) + " -c " + str(args.num_cores))
+                 " -d " + os.getcwd() + " -r " + ref + intermediateExtension + " -B " + prefixBase + " -p " + prefix + " -i " + str(k) +
+                 " -b " + str(args.bch_order) + " -c " + str(args.num_cores) + " -x " + intermediateExtension)
 
     if args.rigid is True:
         myfile.write(" --rigid\n")
@@ -90,49 +106,37 @@ for k in range(args.start + 1, args.num_images + 1):
     myfile.close()
     os.chmod(fileName, stat.S_IRWXU)
 
-    oarRunCommand = ["oarsub"]
-    if previousMergeId == 0:
-        oarRunCommand += ["-n","reg-" + str(k),"-S", os.getcwd() + "/regRun_" + str(k)]
-    else:
-        oarRunCommand += ["-n","reg-" + str(k),"-a",str(previousMergeId),"-S", os.getcwd() + "/regRun_" + str(k)]
+    previousRegIds = jobs.submit(os.getcwd() + "/regRun_" + str(k), "reg-" + str(k), dependencies=previousMergeIds,
+                                 cores=args.num_cores)
 
-    procStat = subprocess.run(oarRunCommand, stdout=subprocess.PIPE)
-    statLines = procStat.stdout.decode('utf-8').split('\n')
-    for statsLine in statLines:
-        if "OAR_JOB_ID" in statsLine:
-            previousRegId = statsLine.split("=")[1]
-            break
-
-    numJobs = k
+    # Short compositions are packed in array elements, walltime set from the durations of previous ones
+    numJobs, tasksPerJob, walltime = jobs.array_layout(os.getcwd(), "ic-composition", k, "01:59:00")
 
     fileName = 'bchRun_' + str(k)
     myfile = open(fileName,"w")
     myfile.write("#!/bin/bash\n")
     if args.num_cores<=16:
-        myfile.write("#OAR -l {hyperthreading=\'NO\'}/nodes=1/core=" + str(args.num_cores) + ",walltime=01:59:00\n")
-    myfile.write("#OAR -l {hyperthreading=\'YES\'}/nodes=1/core=" + str(nCoresPhysical) + ",walltime=01:59:00\n")
+        myfile.write("#OAR -l {hyperthreading=\'NO\'}/nodes=1/core=" + str(args.num_cores) + ",walltime=" + walltime + "\n")
+    myfile.write("#OAR -l {hyperthreading=\'YES\'}/nodes=1/core=" + str(nCoresPhysical) + ",walltime=" + walltime + "\n")
     myfile.write("#OAR --array " + str(numJobs) + "\n")
     myfile.write("#OAR -O " + os.getcwd() + "/bch-" + str(k) + ".%jobid%.output\n")
     myfile.write("#OAR -E " + os.getcwd() + "/bch-" + str(k) + ".%jobid%.error\n")
 
     myfile.write("cd " + os.getcwd() + "\n")
 
+    myfile.write(jobs.array_loop_start(1, k, tasksPerJob))
     myfile.write(os.path.join(animaScriptsDir,"atlasing/anatomical_iterative_centroid/animaICAnatomicalComposeTransformations.py") +
                  " -d " + os.getcwd() + " -B " + prefixBase + " -p " + prefix + " -i " + str(k) +
                  " -c " + str(args.num_cores) + " -s " + str(args.start) + " -b " + str(args.bch_order) +
-                 " -a $OAR_ARRAY_INDEX \n")
+                 " -x " + intermediateExtension +
+                 " -a ${index}\n")
+    myfile.write(jobs.array_loop_end(os.getcwd(), "ic-composition"))
 
     myfile.close()
     os.chmod(fileName, stat.S_IRWXU)
 
-    oarRunCommand = ["oarsub","-n","bch-" + str(k),"-S",os.getcwd() + "/bchRun_" + str(k), "-a", str(previousRegId)]
-    
-    jobsIds = []
-    procStat = subprocess.run(oarRunCommand, stdout=subprocess.PIPE)
-    statLines = procStat.stdout.decode('utf-8').split('\n')
-    for statsLine in statLines:
-        if "OAR_JOB_ID" in statsLine:
-            jobsIds += [statsLine.split("=")[1]]
+    jobsIds = jobs.submit(os.getcwd() + "/bchRun_" + str(k), "bch-" + str(k), dependencies=previousRegIds,
+                          cores=args.num_cores)
 
     fileName = 'mergeRun_' + str(k)
     myfile = open(fileName,"w")
@@ -147,19 +151,18 @@ for k in range(args.start + 1, args.num_images + 1):
 
     myfile.write(os.path.join(animaScriptsDir,"atlasing/anatomical_iterative_centroid/animaICAnatomicalMergeImages.py") +
                  " -d " + os.getcwd() + " -B " + prefixBase + " -p " + prefix + " -i " + str(k) +
-                 " -c " + str(args.num_cores) + "\n")
+                 " -c " + str(args.num_cores) + " -x " + intermediateExtension)
+
+    # Only the final atlas is written in the requested format
+    if k == args.num_images:
+        myfile.write(" -o " + atlasExtension + "\n")
+    else:
+        myfile.write("\n")
 
     myfile.close()
     os.chmod(fileName, stat.S_IRWXU)
 
-    oarRunCommand = ["oarsub"]
-    for jobId in jobsIds:
-        oarRunCommand += ["-a",jobId]
-    oarRunCommand += ["-n","merge-" + str(k),"-S", os.getcwd() + "/mergeRun_" + str(k)]
-
-    procStat = subprocess.run(oarRunCommand, stdout=subprocess.PIPE)
-    statLines = procStat.stdout.decode('utf-8').split('\n')
-    for statsLine in statLines:
-        if "OAR_JOB_ID" in statsLine:
-            previousMergeId = statsLine.split("=")[1]
-            break
+    previousMergeIds = jobs.submit(os.getcwd() + "/mergeRun_" + str(k), "merge-" + str(k), dependencies=jobsIds,
+                                   cores=args.num_cores)
+
+jobs.wait()
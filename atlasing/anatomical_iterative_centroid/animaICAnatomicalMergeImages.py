@@ -5,23 +5,11 @@ import argparse
 import os
 import sys
 import glob
-from subprocess import call
 import shutil
 
-if sys.version_info[0] > 2:
-    import configparser as ConfParser
-else:
-    import ConfigParser as ConfParser
-
-configFilePath = os.path.join(os.path.expanduser("~"), ".anima",  "config.txt")
-if not os.path.exists(configFilePath):
-    print('Please create a configuration file for Anima python scripts. Refer to the README')
-    quit()
-
-configParser = ConfParser.RawConfigParser()
-configParser.read(configFilePath)
-
-animaDir = configParser.get("anima-scripts", 'anima')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, os.pardir))
+from animaRuntime import tools
+from animaRuntime.execution import call
 
 # Argument parsing
 parser = argparse.ArgumentParser(
@@ -31,24 +19,26 @@ parser.add_argument('-B', '--prefix-base', type=str, required=True, help='Prefix
 parser.add_argument('-p', '--prefix', type=str, required=True, help='Prefix')
 parser.add_argument('-i', '--num-iter', type=int, required=True, help='Iteration number of atlas creation')
 parser.add_argument('-c', '--num-cores', type=int, default=40, help='Number of cores to run on')
+parser.add_argument('-x', '--intermediate-ext', type=str, default=".nrrd", help='Extension (format) of intermediate images (default: .nrrd)')
+parser.add_argument('-o', '--output-ext', type=str, default="", help='Extension (format) of the average image (default: same as intermediate images)')
 
 args = parser.parse_args()
 os.chdir(args.ref_dir)
 
-animaAverageImages = os.path.join(animaDir,"animaAverageImages")
+outputExtension = args.output_ext if args.output_ext != "" else args.intermediate_ext
 
 myfile = open("avgImg.txt","w")
 myfileMasks = open("masksIms.txt","w")
 for a in range(1,args.num_iter + 1):
-    myfile.write(os.path.join("tempDir",args.prefix + "_" + str(a) + "_at.nii.gz") + "\n")
+    myfile.write(os.path.join("tempDir",args.prefix + "_" + str(a) + "_at" + args.intermediate_ext) + "\n")
 
     if os.path.exists(os.path.join("Masks", "Mask_" + str(a) + ".nii.gz")):
-        myfileMasks.write(os.path.join("tempDir","Mask_" + str(a) + "_at.nii.gz\n"))
+        myfileMasks.write(os.path.join("tempDir","Mask_" + str(a) + "_at" + args.intermediate_ext) + "\n")
 
 myfile.close()
 myfileMasks.close()
 
-command = [animaAverageImages, "-i", "avgImg.txt","-o","averageForm" + str(args.num_iter) +".nii.gz"]
+command = [tools.animaAverageImages, "-i", "avgImg.txt","-o","averageForm" + str(args.num_iter) + outputExtension]
 
 if os.path.exists(os.path.join("Masks","Mask_1.nii.gz")):
     command += ["-m","masksIms.txt"]
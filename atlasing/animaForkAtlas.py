@@ -0,0 +1,83 @@
+#!/usr/bin/python3
+# Warning: works only on unix-like systems, not windows where "python animaForkAtlas.py ..." has to be run
+
+import argparse
+import glob
+import os
+import shutil
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+from animaRuntime import convergence, jobs, state, warmstart
+
+# Argument parsing
+parser = argparse.ArgumentParser(
+    description="Creates a new atlas folder continuing an anatomical or DTI atlas from one of its completed iterations: "
+                "the atlas builder run in the new folder (with other options, e.g. weights, BCH order or rigid) starts "
+                "at the next iteration. Averages and transforms are hard linked when possible, copied otherwise.")
+parser.add_argument('-s', '--source-dir', type=str, required=True, help='Atlas folder forked')
+parser.add_argument('-d', '--destination-dir', type=str, required=True, help='New atlas folder (created)')
+parser.add_argument('-i', '--iteration', type=int, required=True, help='Completed iteration the new atlas starts from')
+
+args = parser.parse_args()
+sourceDir = os.path.abspath(args.source_dir)
+destinationDir = os.path.abspath(args.destination_dir)
+
+if not state.iteration_done(sourceDir, args.iteration):
+    sys.exit("Error: iteration " + str(args.iteration) + " is not completed in " + sourceDir)
+
+if os.path.exists(destinationDir) and len(os.listdir(destinationDir)) > 0:
+    sys.exit("Error: " + destinationDir + " already exists and is not empty")
+
+averagePrefix = "averageForm"
+if not os.path.exists(os.path.join(sourceDir, averagePrefix + str(args.iteration) + ".nrrd")):
+    averagePrefix = "averageDTI"
+    if not os.path.exists(os.path.join(sourceDir, averagePrefix + str(args.iteration) + ".nrrd")):
+        sys.exit("Error: no average of iteration " + str(args.iteration) + " in " + sourceDir)
+
+os.makedirs(destinationDir, exist_ok=True)
+
+
+def link(path):
+    """Hard links path, relative to the source folder, in the destination folder (copies it across file systems)"""
+    destination = os.path.join(destinationDir, path)
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    try:
+        os.link(os.path.join(sourceDir, path), destination)
+    except OSError:
+        shutil.copy2(os.path.join(sourceDir, path), destination)
+
+
+# Files never modified once written are shared: jobs replace files instead of rewriting them
+for k in range(1, args.iteration + 1):
+    for path in [averagePrefix + str(k) + ".nrrd", "it_" + str(k) + "_done"]:
+        if os.path.exists(os.path.join(sourceDir, path)):
+            link(path)
+
+for path in glob.glob(os.path.join(sourceDir, "Masks", "*")):
+    link(os.path.relpath(path, sourceDir))
+
+# Transforms of the iteration, to warm start the next one or extend the new atlas
+if warmstart.saved_iteration(os.path.join(sourceDir, warmstart.folderName)) == args.iteration:
+    for path in glob.glob(os.path.join(sourceDir, warmstart.folderName, "*")):
+        link(os.path.relpath(path, sourceDir))
+else:
+    print("Transforms of iteration " + str(args.iteration) + " not kept (atlas built without --warm-start), the next "
+          "iteration of the new atlas registers images from scratch")
+
+# Files updated by jobs are copied
+if os.path.exists(os.path.join(sourceDir, state.fileName)):
+    state.fork(sourceDir, destinationDir, args.iteration)
+
+if os.path.exists(os.path.join(sourceDir, jobs.durationsFileName)):
+    shutil.copy(os.path.join(sourceDir, jobs.durationsFileName), destinationDir)
+
+if os.path.exists(os.path.join(sourceDir, convergence.metricsFileName)):
+    with open(os.path.join(sourceDir, convergence.metricsFileName)) as metricsFile, \
+            open(os.path.join(destinationDir, convergence.metricsFileName), "w") as destinationFile:
+        for line in metricsFile:
+            if line.startswith("#") or int(line.split()[0]) <= args.iteration:
+                destinationFile.write(line)
+
+print("Atlas of " + sourceDir + " forked at iteration " + str(args.iteration) + " in " + destinationDir +
+      ", run the atlas builder there to continue it")
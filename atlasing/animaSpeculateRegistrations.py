@@ -0,0 +1,60 @@
+#!/usr/bin/python3
+# Warning: works only on unix-like systems, not windows where "python animaSpeculateRegistrations.py ..." has to be run
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+from animaRuntime import flags, jobs, speculation, state
+
+# Argument parsing
+parser = argparse.ArgumentParser(
+    description="Follows the registrations of an atlas iteration run on OAR and submits a second run of the straggling "
+                "ones (to be used from the atlas builders, see animaRuntime/speculation.py).")
+parser.add_argument('-d', '--ref-dir', type=str, required=True, help='Reference (working) folder')
+parser.add_argument('-i', '--iteration', type=int, required=True, help='Atlas iteration')
+parser.add_argument('-p', '--prefix', type=str, required=True, help='Prefix')
+parser.add_argument('-t', '--template', type=str, required=True,
+                    help="Job script registering image ${index}, with index set by an \"index=$1\" line")
+parser.add_argument('-f', '--factor', type=float, required=True,
+                    help="Registrations running for longer than this factor times the median duration are run again")
+parser.add_argument('-n', '--images', type=int, nargs='+', required=True, help='Images registered at this iteration')
+parser.add_argument('--timeout', type=float, default=7200,
+                    help="Seconds after which the watcher stops, e.g. the walltime of the registrations (default: 7200)")
+parser.add_argument('--poll-period', type=float, default=30, help='Seconds between two checks (default: 30)')
+
+args = parser.parse_args()
+os.chdir(args.ref_dir)
+jobs.set_scheduler("oar")
+
+with open(args.template) as templateFile:
+    template = templateFile.read()
+
+pending = set(args.images)
+duplicated = set()
+deadline = time.time() + args.timeout
+while len(pending) > 0 and time.time() < deadline and not state.iteration_done(os.getcwd(), args.iteration):
+    pending = set(a for a in pending if not os.path.exists(flags.flag_path("residualDir", args.prefix, a)) and
+                  not os.path.exists(flags.failed_path("residualDir", args.prefix, a)) and
+                  not speculation.failed("residualDir", args.prefix, a))
+
+    times = state.image_times(os.getcwd(), args.iteration)
+    durations = [duration for status, _, duration in times.values() if status == "done"]
+    elapsed = dict((a, time.time() - times[a][1]) for a in pending - duplicated
+                   if a in times and times[a][0] == "running")
+
+    for a in speculation.stragglers(durations, elapsed, len(args.images), args.factor):
+        scriptPath = os.path.join(os.getcwd(), "specRun_" + str(args.iteration) + "_" + str(a))
+        with open(scriptPath, "w") as scriptFile:
+            scriptFile.write(template.replace("index=$1\n", "index=" + str(a) + "\n"))
+        os.chmod(scriptPath, 0o700)
+
+        # Marked before submission: the first attempt failing meanwhile does not fail the image
+        speculation.mark_started("residualDir", args.prefix, a, 2)
+        print("Registration of image " + str(a) + " running for " + "%.0f" % elapsed[a] + " s, submitting it again")
+        jobs.submit(scriptPath, "spec-" + str(args.iteration) + "-" + str(a))
+        duplicated.add(a)
+
+    time.sleep(args.poll_period)
@@ -6,24 +6,12 @@ import os
 import glob
 import stat
 import sys
-import subprocess
 import shutil
 
-if sys.version_info[0] > 2:
-    import configparser as ConfParser
-else:
-    import ConfigParser as ConfParser
-
-configFilePath = os.path.join(os.path.expanduser("~"), ".anima",  "config.txt")
-if not os.path.exists(configFilePath):
-    print('Please create a configuration file for Anima python scripts. Refer to the README')
-    quit()
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, os.pardir))
+from animaRuntime import config, convergence, flags, images, jobs, medoid, schedule, selection, state, voxelwise, warmstart
 
-configParser = ConfParser.RawConfigParser()
-configParser.read(configFilePath)
-
-animaDir = configParser.get("anima-scripts", 'anima')
-animaScriptsDir = configParser.get("anima-scripts", 'anima-scripts-public-root')
+animaScriptsDir = config.scripts_public_dir()
 
 # Argument parsing
 parser = argparse.ArgumentParser(
@@ -34,14 +22,125 @@ parser.add_argument('-n', '--num-images', type=int, required=True, help='Number
 parser.add_argument('-c', '--num-cores', type=int, default=8, help='Number of cores to run on (default: 8)')
 parser.add_argument('-b', '--bch-order', type=int, default=2, help='BCH order when composing transformations in rigid unbiased (default: 2)')
 parser.add_argument('-w', '--weights-file', type=str, default="", help='Link to weights file if needed, otherwise using equal weights (default: none)')
+parser.add_argument('--weight-threshold', type=float, default=0,
+                    help="Exclude the images whose weight relative to the largest one is below this value, the weights "
+                         "of the others being renormalised (default: 0, all images)")
+parser.add_argument('--affine-weight-threshold', type=float, default=0,
+                    help="Register the images whose relative weight is below this value with an affine (or rigid) "
+                         "transform only (default: 0, none)")
 parser.add_argument('-r', '--ref-image', type=str, default="", help='Reference image for the first round of registrations')
+parser.add_argument('--medoid-reference', action='store_true',
+                    help="Without reference image, start from the medoid of the dataset (image whose intensity "
+                         "histogram is the closest to those of the others) instead of the first image")
 parser.add_argument('--rigid', action='store_true', help="Unbiased atlas up to a rigid transformation")
+parser.add_argument('--warm-start', action='store_true',
+                    help="Start the registrations of each iteration from the transforms of the previous one")
+parser.add_argument('--extend', type=int, default=0,
+                    help="Extend the atlas built in this folder from the given number of images (the first ones) to "
+                         "--num-images: only the new images are registered, followed by refresh iterations (default: "
+                         "0, new atlas)")
+parser.add_argument('--refresh-iterations', type=int, default=2,
+                    help="Number of iterations after the extension one in extend mode (default: 2)")
+parser.add_argument('--schedule', type=str, default="full",
+                    help="Registration settings by iteration: full, coarse-to-fine or a schedule file (default: full, "
+                         "see animaRuntime/schedule.py)")
+parser.add_argument('--speculate', type=float, default=0,
+                    help="Run again the registrations running for longer than this factor times the median duration "
+                         "of the finished ones of their iteration, keeping the first run to finish (default: 0, "
+                         "disabled)")
+parser.add_argument('--displacement-tolerance', type=float, default=0,
+                    help="Stop iterating once the mean displacement of the template is below this value in mm "
+                         "(default: 0, disabled)")
+parser.add_argument('--change-tolerance', type=float, default=0,
+                    help="Stop iterating once the relative change of the average between two iterations is below this "
+                         "value (default: 0, disabled). Both criteria must be met when both are set. Remove the "
+                         "converged file to run more iterations")
+parser.add_argument('--status', action='store_true',
+                    help="Print the recorded progress of the atlas built in this folder and exit")
+parser.add_argument('--scheduler', type=str, default=jobs.default_scheduler(), choices=jobs.schedulers,
+                    help="Submit jobs to OAR or run them on this machine (default: oar, or scheduler in the config file)")
 
 args = parser.parse_args()
+if args.status is True:
+    print("\n".join(state.summary(os.getcwd())))
+    sys.exit(0)
+
+jobs.set_scheduler(args.scheduler)
+jobs.set_speculation(args.speculate)
+
+# Job scripts are run from another folder
+registrationSchedule = args.schedule
+if registrationSchedule not in schedule.schedules:
+    registrationSchedule = os.path.abspath(registrationSchedule)
+
+# Images registered and averaged, those with negligible weights being left out
+registeredImages = list(range(1, args.num_images + 1))
+affineImages = []
+selectionPath = ""
+if args.weight_threshold > 0 or args.affine_weight_threshold > 0:
+    if args.weights_file == "":
+        sys.exit("Error: weight thresholds need a weights file")
+
+    if args.extend > 0:
+        sys.exit("Error: extend mode cannot be used with weight thresholds")
+
+    weights = voxelwise.read_weights(args.weights_file)
+    if len(weights) != args.num_images:
+        sys.exit("Error: " + args.weights_file + " does not hold one weight per image")
+
+    selectedImages = selection.select(weights, args.weight_threshold, args.affine_weight_threshold)
+    selectionPath = os.path.join(os.getcwd(), selection.fileName)
+    selection.write(selectionPath, selectedImages)
+    registeredImages = [a for a, _, _ in selectedImages]
+    affineImages = [a for a, _, mode in selectedImages if mode == "affine"]
+    print(str(len(registeredImages)) + " of " + str(args.num_images) + " images kept, " + str(len(affineImages)) +
+          " of them registered with an affine transform only")
+
+    # The first image is the reference of the first iteration, replaced by the one with the largest weight when left out
+    if args.ref_image == "" and 1 not in registeredImages and args.medoid_reference is False:
+        args.ref_image = images.find_image(args.data_prefix + "_" + str(weights.index(max(weights)) + 1))
+        if args.ref_image is None:
+            sys.exit("Error: no image found for prefix " + args.data_prefix + "_" + str(weights.index(max(weights)) + 1))
+
+if args.medoid_reference is True and args.ref_image == "" and args.extend == 0 and \
+        not state.iteration_done(os.getcwd(), 1):
+    candidates = [images.find_image(args.data_prefix + "_" + str(a)) for a in registeredImages]
+    if None in candidates:
+        sys.exit("Error: no image found for prefix " + args.data_prefix + "_" +
+                 str(registeredImages[candidates.index(None)]))
+
+    medoidPosition, _ = medoid.medoid(candidates, min(args.num_cores, len(candidates)))
+    args.ref_image = candidates[medoidPosition]
+    print("Image " + str(registeredImages[medoidPosition]) + " is the medoid of the dataset, used as first reference")
 
 if not os.path.exists('tempDir'):
     os.makedirs('tempDir')
 
+if args.extend > 0:
+    # The images already in the atlas reuse the transforms of its last iteration, kept by the merge (--warm-start) or
+    # still in tempDir and residualDir otherwise
+    lastIteration = 0
+    while state.iteration_done(os.getcwd(), lastIteration + 1):
+        lastIteration += 1
+
+    if lastIteration == 0 or args.extend >= args.num_images:
+        sys.exit("Error: extend mode needs an atlas built in this folder and more images than it has")
+
+    if warmstart.saved_iteration(warmstart.folderName) != lastIteration:
+        if not os.path.exists(os.path.join("residualDir", "sumNonlinear_inv_tr.nrrd")):
+            sys.exit("Error: transforms of the last iteration not found, the atlas has to be built with --warm-start "
+                     "to be extended")
+        warmstart.save(os.path.basename(args.data_prefix), range(1, args.extend + 1), lastIteration)
+
+    if os.path.exists(convergence.convergedFileName):
+        os.remove(convergence.convergedFileName)
+
+    extensionIteration = lastIteration + 1
+    args.num_iterations = extensionIteration + args.refresh_iterations
+
+# Check the schedule before submitting any job, once the number of iterations is known (extend mode adds some)
+schedule.read(registrationSchedule, args.num_iterations)
+
 if os.path.exists('residualDir'):
     shutil.rmtree("residualDir")
 
@@ -65,109 +164,218 @@ prefix = os.path.basename(args.data_prefix)
 
 # Get extension of files if a reference image was not given
 if filesExtension == "":
-    refBasename = os.path.basename(ref)
-    filesList = os.listdir(prefixBase)
-    for f in filesList:
-        if refBasename in f:
-            filesExtension = os.path.splitext(f)[1]
-            if filesExtension == '.gz':
-                filesExtension = os.path.splitext(os.path.splitext(f)[0])[1] + filesExtension
-
-previousMergeId = 0
+    refImage = images.find_image(ref)
+    if refImage is None:
+        sys.exit("Error: no image found for prefix " + ref)
+    filesExtension = images.image_extension(refImage)
+
+# Check the whole dataset before submitting any job
+imageErrors = images.check_images([args.data_prefix + "_" + str(i) + filesExtension for i in registeredImages])
+if len(imageErrors) > 0:
+    sys.exit("Error: invalid dataset images:\n" + "\n".join(imageErrors))
+
+previousMergeIds = []
 ref = ref + filesExtension
+firstPendingIteration = True
 
 for k in range(1, args.num_iterations + 1):
-    if os.path.exists('it_' + str(k) + '_done'):
+    if state.iteration_done(os.getcwd(), k):
         ref = "averageDTI" + str(k) + ".nrrd"
         firstImage = 1
         continue
 
-    print("*************Iteration " + str(k) + ", processing reference: " + ref)
+    if convergence.converged_iteration() is not None:
+        print("Atlas converged at iteration " + str(convergence.converged_iteration()) + ", no more iterations submitted")
+        break
 
-    for f in glob.glob("residualDir/" + prefix + '_*_linear_tr.txt') + glob.glob("residualDir/" + prefix + '_*_nonlinear_tr.nrrd') + glob.glob("residualDir/" + prefix + '_*_flag'):
-        os.remove(f)
+    print("*************Iteration " + str(k) + ", processing reference: " + ref)
 
-    numJobs = args.num_images - firstImage + 1
+    # Flags are only cleaned before the first unfinished iteration: those of its images already registered are created
+    # again below, and must still exist when its merge job runs after the later iterations are submitted
+    completedImages = []
+    if firstPendingIteration is True:
+        for f in glob.glob("residualDir/" + prefix + '_*_linear_tr.txt') + glob.glob("residualDir/" + prefix + '_*_nonlinear_tr.nrrd') + glob.glob("residualDir/" + prefix + '_*_flag') + glob.glob("residualDir/" + prefix + '_*_failed') + glob.glob("residualDir/" + prefix + '_*_claim') + glob.glob("residualDir/" + prefix + '_*_started'):
+            os.remove(f)
+
+        # Images of the first unfinished iteration registered by a previous run of the builder are not registered again
+        completedImages = state.completed_images(os.getcwd(), k)
+        for a in completedImages:
+            flags.mark_done("residualDir", prefix, a)
+        if len(completedImages) > 0:
+            print(str(len(completedImages)) + " images already registered at this iteration, not submitted again")
+        firstPendingIteration = False
+
+    # Short registrations are packed in array elements, walltime set from the durations of previous registrations with
+    # the settings of this iteration
+    durationsTask = "dti-registration"
+    if args.rigid is True:
+        durationsTask += "-rigid"
+    if args.warm_start is True and k > 1:
+        durationsTask += "-warm"
+    durationsTask += "/" + schedule.settings_key(registrationSchedule, k, args.num_iterations)
+    tasks = [a for a in registeredImages if a >= firstImage and a not in completedImages]
+    numJobs, tasksPerJob, walltime = jobs.array_layout(os.getcwd(), durationsTask, len(tasks), "07:59:00")
     nCoresPhysical = int(args.num_cores / 2)
 
     fileName = 'iterRun_' + str(k)
     myfile = open(fileName,"w")
     myfile.write("#!/bin/bash\n")
-    if args.num_cores <= 16:
-        myfile.write("#OAR -l {hyperthreading=\'NO\'}/nodes=1/core=" + str(args.num_cores) + ",walltime=07:59:00\n")
-    myfile.write("#OAR -l {hyperthreading=\'YES\'}/nodes=1/core=" + str(nCoresPhysical) + ",walltime=07:59:00\n")
+    if args.num_cores<=16:
+        myfile.write("#OAR -l {hyperthreading=\'NO\'}/nodes=1/core=" + str(args.num_cores) + ",walltime=" + walltime + "\n")
+    myfile.write("#OAR -l {hyperthreading=\'YES\'}/nodes=1/core=" + str(nCoresPhysical) + ",walltime=" + walltime + "\n")
     myfile.write("#OAR --array " + str(numJobs) + "\n")
     myfile.write("#OAR -O " + os.getcwd() + "/reg-" + str(k) + ".%jobid%.output\n")
     myfile.write("#OAR -E " + os.getcwd() + "/reg-" + str(k) + ".%jobid%.error\n")
 
     myfile.write("cd " + os.getcwd() + "\n")
+    myfile.write(convergence.skip_if_converged_command(os.getcwd()))
 
+    numIt=k
     if k == 1 and args.ref_image == "":
         numIt=0
-        myfile.write("let index=${OAR_ARRAY_INDEX}+1\n")
-        myfile.write(os.path.join(animaScriptsDir,"atlasing/dti/animaRegisterDTImage.py") +
-                     " -d " + os.getcwd() + " -r " + ref + " -B " + prefixBase + " -p " + prefix + " -e " + filesExtension +
-                     " -n $index -b " + str(args.bch_order) + " -c " + str(args.num_cores))
+
+    if tasks == list(range(firstImage, args.num_images + 1)):
+        myfile.write(jobs.array_loop_start(firstImage, args.num_images, tasksPerJob))
     else:
-        numIt=k
-        myfile.write(os.path.join(animaScriptsDir,"atlasing/dti/animaRegisterDTImage.py") +
-                     " -d " + os.getcwd() + " -r " + ref + " -B " + prefixBase + " -p " + prefix + " -e " + filesExtension +
-                     " -n $OAR_ARRAY_INDEX -b " + str(args.bch_order) + " -c " + str(args.num_cores))
+        myfile.write(jobs.array_loop_start(1, len(tasks), tasksPerJob, indexes=tasks))
+
+    # Registration of image ${index}, also used by the scripts running straggling registrations again
+    registerLines = ""
+    if len(affineImages) > 0:
+        registerLines += "affine=\"\"\n"
+        registerLines += "case ${index} in " + "|".join(str(a) for a in affineImages) + ") affine=\"--affine-only\";; esac\n"
+    if args.extend > 0 and k == extensionIteration:
+        # Images already in the atlas are not registered again
+        registerLines += "reuse=\"\"\n"
+        registerLines += "if [ ${index} -le " + str(args.extend) + " ]; then reuse=\"--reuse-transforms\"; fi\n"
+
+    registerLines += (os.path.join(animaScriptsDir,"atlasing/dti/animaRegisterDTImage.py") +
+                      " -d " + os.getcwd() + " -r " + ref + " -B " + prefixBase + " -p " + prefix + " -e " + filesExtension +
+                      " -n ${index} -b " + str(args.bch_order) + " -c " + str(args.num_cores))
 
     if args.rigid is True:
-        myfile.write(" --rigid\n")
-    else:
-        myfile.write("\n")
+        registerLines += " --rigid"
+
+    if args.extend > 0 and k == extensionIteration:
+        registerLines += " $reuse"
+
+    if len(affineImages) > 0:
+        registerLines += " $affine"
+
+    registerLines += (" --schedule " + registrationSchedule + " --iteration " + str(k) + " --num-iterations " +
+                      str(args.num_iterations))
+
+    if args.warm_start is True:
+        registerLines += " --warm-start"
+
+    myfile.write(registerLines)
+    if args.speculate > 0:
+        # Second runs started by the local scheduler set ANIMA_ATTEMPT
+        myfile.write(" --attempt ${ANIMA_ATTEMPT:-1}")
+
+    # Lets the merge job fail fast instead of waiting for the flag of this image, once no other attempt may still
+    # register it with speculation
+    failedName = prefix + "_${index}_failed"
+    if args.speculate > 0:
+        failedName = prefix + "_${index}_attempt${ANIMA_ATTEMPT:-1}_failed"
+    myfile.write(" || { echo \"registration script exited with an error\" > " +
+                 os.path.join(os.getcwd(), "residualDir", failedName) + "; touch \"${" + jobs.untimedTaskVariable +
+                 "}\"; }\n")
+    # Images registered with an affine transform only are timed apart
+    myfile.write(jobs.array_loop_end(os.getcwd(), durationsTask + "${affine}"))
 
     myfile.close()
     os.chmod(fileName, stat.S_IRWXU)
 
-    oarRunCommand = ["oarsub"]
-    if previousMergeId == 0:
-        oarRunCommand += ["-n","reg-" + str(k),"-S", os.getcwd() + "/iterRun_" + str(k)]
-    else:
-        oarRunCommand += ["-n","reg-" + str(k),"-a",str(previousMergeId),"-S", os.getcwd() + "/iterRun_" + str(k)]
-
-    jobsIds = []
-    procStat = subprocess.run(oarRunCommand, stdout=subprocess.PIPE)
-    statLines = procStat.stdout.decode('utf-8').split('\n')
-    for statsLine in statLines:
-        if "OAR_JOB_ID" in statsLine:
-            jobsIds += [statsLine.split("=")[1]]
+    # The script is still written when all images are registered: merge jobs remove it
+    jobsIds = previousMergeIds
+    if len(tasks) > 0:
+        jobsIds = jobs.submit(os.getcwd() + "/iterRun_" + str(k), "reg-" + str(k), dependencies=previousMergeIds,
+                              cores=args.num_cores)
+
+    # On OAR, a watcher job submits second runs of the straggling registrations, and the merge job cannot depend on
+    # the registrations it no longer needs
+    speculateOnOar = args.speculate > 0 and jobs.scheduler == "oar"
+    if speculateOnOar and len(tasks) > 0:
+        fileName = 'specRun_' + str(k)
+        myfile = open(fileName,"w")
+        myfile.write("#!/bin/bash\n")
+        if args.num_cores<=16:
+            myfile.write("#OAR -l {hyperthreading=\'NO\'}/nodes=1/core=" + str(args.num_cores) + ",walltime=" + walltime + "\n")
+        myfile.write("#OAR -l {hyperthreading=\'YES\'}/nodes=1/core=" + str(nCoresPhysical) + ",walltime=" + walltime + "\n")
+        myfile.write("#OAR -O " + os.getcwd() + "/spec-" + str(k) + ".%jobid%.output\n")
+        myfile.write("#OAR -E " + os.getcwd() + "/spec-" + str(k) + ".%jobid%.error\n")
+        myfile.write("cd " + os.getcwd() + "\n")
+        myfile.write(convergence.skip_if_converged_command(os.getcwd()))
+        # Set for each image by the watcher
+        myfile.write("index=$1\n")
+        myfile.write(registerLines + " --attempt 2 || echo \"registration script exited with an error\" > " +
+                     os.path.join(os.getcwd(), "residualDir", prefix + "_${index}_attempt2_failed") + "\n")
+        myfile.close()
+
+        watchTimeout = jobs.walltime_seconds(walltime) + 7200
+        fileName = 'watchRun_' + str(k)
+        myfile = open(fileName,"w")
+        myfile.write("#!/bin/bash\n")
+        myfile.write("#OAR -l nodes=1/core=1,walltime=" + jobs.format_walltime(watchTimeout + 600) + "\n")
+        myfile.write("#OAR -O " + os.getcwd() + "/watch-" + str(k) + ".%jobid%.output\n")
+        myfile.write("#OAR -E " + os.getcwd() + "/watch-" + str(k) + ".%jobid%.error\n")
+        myfile.write("cd " + os.getcwd() + "\n")
+        myfile.write(convergence.skip_if_converged_command(os.getcwd()))
+        myfile.write(os.path.join(animaScriptsDir,"atlasing/animaSpeculateRegistrations.py") + " -d " + os.getcwd() +
+                     " -i " + str(k) + " -p " + prefix + " -t " + os.path.join(os.getcwd(), "specRun_" + str(k)) +
+                     " -f " + str(args.speculate) + " --timeout " + str(watchTimeout) + " -n " +
+                     " ".join(str(a) for a in tasks) + "\n")
+        myfile.close()
+        os.chmod(fileName, stat.S_IRWXU)
+
+        jobs.submit(os.getcwd() + "/watchRun_" + str(k), "watch-" + str(k), dependencies=previousMergeIds)
+
+    # The merge job then waits for the registrations, hence the walltime covering both
+    mergeWaits = speculateOnOar
+    mergeWalltime = "03:59:00"
+    if mergeWaits is True:
+        mergeWalltime = jobs.format_walltime(jobs.walltime_seconds(walltime) + 4 * 3600)
 
     fileName = 'mergeRun_' + str(k)
     myfile = open(fileName,"w")
     myfile.write("#!/bin/bash\n")
     if args.num_cores<=16:
-        myfile.write("#OAR -l {hyperthreading=\'NO\'}/nodes=1/core=" + str(args.num_cores) + ",walltime=03:59:00\n")
-    myfile.write("#OAR -l {hyperthreading=\'YES\'}/nodes=1/core=" + str(nCoresPhysical) + ",walltime=03:59:00\n")
+        myfile.write("#OAR -l {hyperthreading=\'NO\'}/nodes=1/core=" + str(args.num_cores) + ",walltime=" + mergeWalltime + "\n")
+    myfile.write("#OAR -l {hyperthreading=\'YES\'}/nodes=1/core=" + str(nCoresPhysical) + ",walltime=" + mergeWalltime + "\n")
     myfile.write("#OAR -O " + os.getcwd() + "/merge-" + str(k) + ".%jobid%.output\n")
     myfile.write("#OAR -E " + os.getcwd() + "/merge-" + str(k) + ".%jobid%.error\n")
 
     myfile.write("cd " + os.getcwd() + "\n")
+    myfile.write(convergence.skip_if_converged_command(os.getcwd()))
     myfile.write(os.path.join(animaScriptsDir,"atlasing/dti/animaMergeDTImages.py") +
                  " -d " + os.getcwd() + " -B " + prefixBase + " -p " + prefix + " -i " + str(numIt) +
                  " -n " + str(args.num_images) + " -r " + ref + " -e " + filesExtension + " -c " + str(args.num_cores))
 
-    if not args.weights_file == "":
-        myfile.write(" -w " + args.weights_file + "\n")
-    else:
-        myfile.write("\n")
+    if not selectionPath == "":
+        myfile.write(" --selection " + selectionPath)
+    elif not args.weights_file == "":
+        myfile.write(" -w " + args.weights_file)
 
-    myfile.close()
-    os.chmod(fileName, stat.S_IRWXU)
+    if args.warm_start is True:
+        myfile.write(" --warm-start")
 
-    oarRunCommand = ["oarsub","-n","merge-" + str(k),"-S",os.getcwd() + "/mergeRun_" + str(k)]
+    myfile.write(" --displacement-tolerance " + str(args.displacement_tolerance) + " --change-tolerance " +
+                 str(args.change_tolerance))
 
-    for jobId in jobsIds:
-        oarRunCommand += ["-a",jobId]
+    if mergeWaits is True:
+        # Registrations may all run for their whole walltime before the first flag appears
+        myfile.write(" --flags-timeout " + str(jobs.walltime_seconds(walltime)))
 
-    procStat = subprocess.run(oarRunCommand, stdout=subprocess.PIPE)
-    statLines = procStat.stdout.decode('utf-8').split('\n')
-    for statsLine in statLines:
-        if "OAR_JOB_ID" in statsLine:
-            previousMergeId = statsLine.split("=")[1]
-            break
+    myfile.write("\n")
+    myfile.close()
+    os.chmod(fileName, stat.S_IRWXU)
+
+    mergeDependencies = previousMergeIds if mergeWaits is True else jobsIds
+    previousMergeIds = jobs.submit(os.getcwd() + "/mergeRun_" + str(k), "merge-" + str(k),
+                                   dependencies=mergeDependencies, cores=args.num_cores)
 
     ref = "averageDTI" + str(k) + ".nrrd"
     firstImage = 1
+
+jobs.wait()
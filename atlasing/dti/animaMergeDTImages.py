@@ -5,23 +5,11 @@ import argparse
 import os
 import sys
 import glob
-from subprocess import call
 import shutil
 
-if sys.version_info[0] > 2:
-    import configparser as ConfParser
-else:
-    import ConfigParser as ConfParser
-
-configFilePath = os.path.join(os.path.expanduser("~"), ".anima",  "config.txt")
-if not os.path.exists(configFilePath):
-    print('Please create a configuration file for Anima python scripts. Refer to the README')
-    quit()
-
-configParser = ConfParser.RawConfigParser()
-configParser.read(configFilePath)
-
-animaDir = configParser.get("anima-scripts", 'anima')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, os.pardir))
+from animaRuntime import convergence, execution, flags, selection, state, tools, voxelwise, warmstart
+from animaRuntime.execution import call
 
 # Argument parsing
 parser = argparse.ArgumentParser(
@@ -36,29 +24,40 @@ parser.add_argument('-b', '--bch-order', type=int, default=2, help='BCH order wh
 parser.add_argument('-n', '--num-images', type=int, required=True, help='Number of images')
 parser.add_argument('-i', '--num-iter', type=int, required=True, help='Iteration number of atlas creation')
 parser.add_argument('-c', '--num-cores', type=int, default=40, help='Number of cores to run on')
+parser.add_argument('--flags-timeout', type=float, default=600,
+                    help="Seconds without any new registration flag after which missing registrations are considered "
+                         "failed (default: 600)")
+parser.add_argument('--displacement-tolerance', type=float, default=0,
+                    help="Mark the atlas as converged when the mean displacement of the template is below this value "
+                         "in mm (default: 0, disabled)")
+parser.add_argument('--change-tolerance', type=float, default=0,
+                    help="Mark the atlas as converged when the relative change of the average since the previous "
+                         "iteration is below this value (default: 0, disabled)")
+parser.add_argument('--warm-start', action='store_true',
+                    help="Keep the transforms of this iteration to start the registrations of the next one")
+parser.add_argument('--selection', type=str, default="",
+                    help="Selection file of the images kept in a weighted atlas, replacing -w (see "
+                         "animaRuntime/selection.py, default: all images)")
 
 args = parser.parse_args()
 os.chdir(args.ref_dir)
 
-animaCreateImage = os.path.join(animaDir,"animaCreateImage")
-animaAverageImages = os.path.join(animaDir,"animaAverageImages")
-animaImageArithmetic = os.path.join(animaDir,"animaImageArithmetic")
-animaTransformSerieXmlGenerator = os.path.join(animaDir,"animaTransformSerieXmlGenerator")
-animaTensorApplyTransformSerie = os.path.join(animaDir,"animaTensorApplyTransformSerie")
-animaDTIScalarMaps = os.path.join(animaDir,"animaDTIScalarMaps")
-animaThrImage = os.path.join(animaDir,"animaThrImage")
-animaMaskImage = os.path.join(animaDir,"animaMaskImage")
-
-# test if all images are here
-nimTest = args.num_images
+# Images averaged, with their weights
+imageIndexes = list(range(1, args.num_images + 1))
+weightsPath = args.weights
+if not args.selection == "":
+    selectedImages = selection.read(args.selection)
+    imageIndexes = [a for a, _, _ in selectedImages]
+    weightsPath = "selectedWeights.txt"
+    selection.write_weights(selectedImages, weightsPath)
+
+# Wait for all registrations, failing as soon as one is known to have failed
+firstImage = 1
 if args.num_iter == 0:
-    nimTest -= 1
+    firstImage = 2
 
-numData = len(glob.glob(os.path.join("residualDir",args.prefix + "_*_flag")))
-while numData < nimTest:
-    print("Missing data " + str(numData) + " " + str(nimTest))
-    call(["sleep","600"])
-    numData = len(glob.glob(os.path.join("residualDir", args.prefix + "_*_flag")))
+flags.wait_for_flags("residualDir", args.prefix, [a for a in imageIndexes if a >= firstImage],
+                     timeout=args.flags_timeout, errorPattern="reg-" + str(max(args.num_iter, 1)) + ".*.error")
 
 # if ok proceed
 if args.num_iter == 0:
@@ -71,84 +70,111 @@ if args.num_iter == 0:
     myfile.write("FixedParameters: 0 0 0\n")
     myfile.close()
 
-    command = [animaCreateImage,"-o",os.path.join("tempDir",args.prefix + "_1_nonlinear_tr.nrrd"),
+    command = [tools.animaCreateImage,"-o",os.path.join("tempDir",args.prefix + "_1_nonlinear_tr.nrrd"),
                "-b","0","-g",os.path.join(args.prefix_base,args.prefix + "_1" + args.files_extension),"-v","3"]
     call(command)
 
 myfile = open("sumNonlinear.txt","w")
-for a in range(1,args.num_images + 1):
+for a in imageIndexes:
     myfile.write(os.path.join("tempDir",args.prefix + "_" + str(a) + "_nonlinear_tr.nrrd") + "\n")
 
 myfile.close()
 
-command = [animaAverageImages, "-i", "sumNonlinear.txt","-o",os.path.join("residualDir","sumNonlinear_tr.nrrd")]
-if not args.weights == "":
-    command += ["-w",args.weights]
+command = [tools.animaAverageImages, "-i", "sumNonlinear.txt","-o",os.path.join("residualDir","sumNonlinear_tr.nrrd")]
+if not weightsPath == "":
+    command += ["-w",weightsPath]
 
 call(command)
 
-command = [animaImageArithmetic,"-i",os.path.join("residualDir","sumNonlinear_tr.nrrd"),"-M","-1",
+command = [tools.animaImageArithmetic,"-i",os.path.join("residualDir","sumNonlinear_tr.nrrd"),"-M","-1",
            "-o",os.path.join("residualDir", "sumNonlinear_inv_tr.nrrd")]
 call(command)
 
-myfileImages = open("refIms.txt","w")
-myfileMasks = open("masksIms.txt","w")
-for a in range(1,args.num_images+1):
+# Images are resampled concurrently, each with a share of the cores
+workers, threads = execution.split_cores(args.num_cores, len(imageIndexes))
+
+
+def resample(a):
     if a == 1 and args.num_iter == 1:
-        command = [animaTransformSerieXmlGenerator,"-i",os.path.join("residualDir", "sumNonlinear_inv_tr.nrrd"),
+        command = [tools.animaTransformSerieXmlGenerator,"-i",os.path.join("residualDir", "sumNonlinear_inv_tr.nrrd"),
                    "-o",os.path.join("tempDir", "trsf_" + str(a) + ".xml")]
         call(command)
     else:
-        command = [animaTransformSerieXmlGenerator,"-i",os.path.join("tempDir", args.prefix + "_" + str(a) + "_linear_tr.txt"),
+        command = [tools.animaTransformSerieXmlGenerator,"-i",os.path.join("tempDir", args.prefix + "_" + str(a) + "_linear_tr.txt"),
                    "-i", os.path.join("tempDir",args.prefix + "_" + str(a) + "_nonlinear_tr.nrrd"),
                    "-i",os.path.join("residualDir","sumNonlinear_inv_tr.nrrd"),
                    "-o",os.path.join("tempDir","trsf_" + str(a) + ".xml")]
         call(command)
 
-    command = [animaTensorApplyTransformSerie,"-i",os.path.join(args.prefix_base,args.prefix + "_" + str(a) + args.files_extension),
+    command = [tools.animaTensorApplyTransformSerie,"-i",os.path.join(args.prefix_base,args.prefix + "_" + str(a) + args.files_extension),
                "-t",os.path.join("tempDir","trsf_" + str(a) + ".xml"),"-g",args.ref_image,
-               "-o",os.path.join("tempDir",args.prefix + "_" + str(a) + "_at.nrrd"),"-p",str(args.num_cores)]
+               "-o",os.path.join("tempDir",args.prefix + "_" + str(a) + "_at.nrrd"),"-p",str(threads)]
     call(command)
-    myfileImages.write(os.path.join("tempDir", args.prefix + "_" + str(a) + "_at.nrrd\n"))
 
-    command = [animaDTIScalarMaps,"-i",os.path.join("tempDir",args.prefix + "_" + str(a) + "_at.nrrd"),
-               "-a",os.path.join("tempDir",args.prefix + "_" + str(a) + "_at_ADC.nrrd")]
-    call(command)
+    # Mask of the tensors with a positive ADC
+    tensors = voxelwise.image(os.path.join("tempDir",args.prefix + "_" + str(a) + "_at.nrrd"))
+    voxelwise.apply(voxelwise.threshold(voxelwise.tensor_trace(tensors), 0),
+                    os.path.join("tempDir","Mask_" + str(a) + "_at.nrrd"), type="uint8")
 
-    command = [animaThrImage,"-i",os.path.join("tempDir",args.prefix + "_" + str(a) + "_at_ADC.nrrd"),
-               "-t","0","-o",os.path.join("tempDir","Mask_" + str(a) + "_at.nrrd")]
-    call(command)
+
+for _ in execution.parallel_map(resample, imageIndexes, workers):
+    pass
+
+# Lists in image order, matching the weights
+myfileImages = open("refIms.txt","w")
+myfileMasks = open("masksIms.txt","w")
+for a in imageIndexes:
+    myfileImages.write(os.path.join("tempDir", args.prefix + "_" + str(a) + "_at.nrrd\n"))
     myfileMasks.write(os.path.join("tempDir","Mask_" + str(a) + "_at.nrrd\n"))
 
 myfileImages.close()
 myfileMasks.close()
 
 if args.num_iter == 0:
-    command = [animaAverageImages,"-i","refIms.txt","-o","averageDTI1.nrrd","-m","masksIms.txt"]
+    command = [tools.animaAverageImages,"-i","refIms.txt","-o","averageDTI1.nrrd","-m","masksIms.txt"]
 else:
-    command = [animaAverageImages,"-i","refIms.txt",
+    command = [tools.animaAverageImages,"-i","refIms.txt",
                "-o","averageDTI" + str(args.num_iter) + ".nrrd","-m","masksIms.txt"]
 
-if not args.weights == "":
-    command += ["-w",args.weights]
+if not weightsPath == "":
+    command += ["-w",weightsPath]
 call(command)
 
-command = [animaAverageImages,"-i","masksIms.txt","-o",os.path.join("tempDir","meanMasks_at.nrrd")]
-if not args.weights == "":
-    command += ["-w",args.weights]
-call(command)
+masksWeights = None
+if not weightsPath == "":
+    masksWeights = voxelwise.read_weights(weightsPath)
+masks = [voxelwise.image(os.path.join("tempDir","Mask_" + str(a) + "_at.nrrd")) for a in imageIndexes]
+voxelwise.apply(voxelwise.threshold(voxelwise.weighted_mean(masks, masksWeights), 0.25),
+                os.path.join("tempDir","thrMeanMasks_at.nrrd"), type="uint8")
 
-command = [animaThrImage,"-i",os.path.join("tempDir","meanMasks_at.nrrd"),"-t","0.25",
-           "-o",os.path.join("tempDir","thrMeanMasks_at.nrrd")]
+averagePath = "averageDTI" + str(max(args.num_iter, 1)) + ".nrrd"
+command = [tools.animaMaskImage,"-i",averagePath,"-m",os.path.join("tempDir","thrMeanMasks_at.nrrd"),"-o",averagePath]
 call(command)
 
-if args.num_iter == 0:
-    command = [animaMaskImage,"-i","averageDTI1.nrrd", "-m", os.path.join("tempDir", "thrMeanMasks_at.nrrd"),
-               "-o", "averageDTI1.nrrd"]
-    call(command)
+# Convergence metrics, computed before residualDir is cleaned up
+iteration = max(args.num_iter, 1)
+if os.path.exists(averagePath):
+    displacementRms, displacementMax = convergence.displacement_norm(os.path.join("residualDir", "sumNonlinear_inv_tr.nrrd"))
+    change = None
+    previousPath = "averageDTI" + str(iteration - 1) + ".nrrd"
+    if iteration > 1 and os.path.exists(previousPath):
+        change = convergence.relative_change(averagePath, previousPath, logEuclidean=True)
 
+    convergence.record(iteration, displacementRms, displacementMax, change)
+    if convergence.is_converged(displacementRms, change, args.displacement_tolerance, args.change_tolerance):
+        convergence.mark_converged(iteration)
+
+    if args.warm_start is True:
+        warmstart.save(args.prefix, imageIndexes, iteration)
+
+    # Second runs of straggling registrations not started yet are no longer needed
+    for f in glob.glob("specRun_" + str(iteration) + "_*"):
+        os.remove(f)
+
+if args.num_iter == 0:
     if os.path.exists("averageDTI1.nrrd"):
         open("it_1_done", "w").close()
+        state.record_iteration(os.getcwd(), 1)
         if os.path.exists("iterRun_2"):
             shutil.rmtree("residualDir")
             shutil.rmtree("tempDir")
@@ -156,13 +182,9 @@ if args.num_iter == 0:
             os.makedirs('residualDir')
             os.remove("iterRun_1")
 else:
-    command = [animaMaskImage,"-i","averageDTI" + str(args.num_iter) + ".nrrd",
-               "-m",os.path.join("tempDir","thrMeanMasks_at.nrrd"),
-               "-o","averageDTI" + str(args.num_iter) + ".nrrd"]
-    call(command)
-
     if os.path.exists("averageDTI" + str(args.num_iter) + ".nrrd"):
         open("it_" + str(args.num_iter) + "_done","w").close()
+        state.record_iteration(os.getcwd(), args.num_iter)
         t = args.num_iter + 1
         if os.path.exists("iterRun_" + str(t)):
             shutil.rmtree("residualDir")
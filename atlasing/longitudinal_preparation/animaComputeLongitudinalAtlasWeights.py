@@ -4,11 +4,16 @@
 import argparse
 import os
 import shutil
+import sys
 import numpy as np
-from scipy import signal
-import pandas as pd 
 from animaPolynomialKernel import polynomial_kernel
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, os.pardir))
+from animaRuntime.lazy import lazy_import
+
+signal = lazy_import("scipy.signal")
+pd = lazy_import("pandas")
+
 # Argument parsing
 parser = argparse.ArgumentParser(description="Compute data weights for building an atlas at the specified age")
 
@@ -4,33 +4,15 @@
 import sys
 import argparse
 
-if sys.version_info[0] > 2:
-    import configparser as ConfParser
-else:
-    import ConfigParser as ConfParser
-
 import glob
 import os
 from shutil import copyfile, rmtree
-from subprocess import call, check_output
-import tempfile
-
-configFilePath = os.path.join(os.path.expanduser("~"), ".anima",  "config.txt")
-if not os.path.exists(configFilePath):
-    print('Please create a configuration file for Anima python scripts. Refer to the README')
-    quit()
-
-configParser = ConfParser.RawConfigParser()
-configParser.read(configFilePath)
-
-animaDir = configParser.get("anima-scripts", 'anima')
-animaExtraDataDir = configParser.get("anima-scripts", 'extra-data-root')
-animaPyramidalBMRegistration = os.path.join(animaDir, "animaPyramidalBMRegistration")
-animaDenseSVFBMRegistration = os.path.join(animaDir, "animaDenseSVFBMRegistration")
-animaTransformSerieXmlGenerator = os.path.join(animaDir, "animaTransformSerieXmlGenerator")
-animaApplyTransformSerie = os.path.join(animaDir, "animaApplyTransformSerie")
-animaConvertImage = os.path.join(animaDir, "animaConvertImage")
-animaMaskImage = os.path.join(animaDir, "animaMaskImage")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+from animaRuntime import config, execution, images, scratch, tools
+from animaRuntime.execution import call
+
+animaExtraDataDir = config.extra_data_dir()
 
 # Argument parsing
 parser = argparse.ArgumentParser(
@@ -47,8 +29,18 @@ parser.add_argument('-f', '--intermediate_folder', type=str, help="""Path where
                     intermediate files are deleted by default and kept if this option is given).
                     """)
 
+parser.add_argument('--scratch-root', type=str, default="",
+                    help="Folder where intermediates are written, e.g. a node-local disk (default: scratch-root in the "
+                         "config file, or the system temporary folder)")
+parser.add_argument('--plan', type=str, nargs='*', metavar='TRACE',
+                    help="Print the step graph and its critical path (timings from the given or recorded traces) "
+                         "instead of running the pipeline")
+
 args = parser.parse_args()
 
+if args.plan is not None:
+    execution.enable_plan(args.plan)
+
 numImages = len(sys.argv) - 1
 atlasImage = animaExtraDataDir + "icc_atlas/Reference_T1.nrrd"
 atlasImageMasked = animaExtraDataDir + "icc_atlas/Reference_T1_masked.nrrd"
@@ -68,7 +60,7 @@ if os.path.splitext(brainImage)[1] == '.gz':
 
 brainMask = args.mask if args.mask else brainImagePrefix + "_brainMask.nrrd"
 maskedBrain = args.brain if args.brain else brainImagePrefix + "_masked.nrrd"
-intermediateFolder = args.intermediate_folder if args.intermediate_folder else tempfile.mkdtemp()
+intermediateFolder = args.intermediate_folder if args.intermediate_folder else scratch.make_temp_dir(args.scratch_root)
 
 if not os.path.isdir(intermediateFolder):
     os.mkdir(intermediateFolder)
@@ -76,43 +68,35 @@ if not os.path.isdir(intermediateFolder):
 brainImagePrefix = os.path.join(intermediateFolder, os.path.basename(brainImagePrefix))
 
 # Decide on whether to use large image setting or small image setting
-command = [animaConvertImage, "-i", brainImage, "-I"]
-convert_output = check_output(command, universal_newlines=True)
-size_info = convert_output.split('\n')[1].split('[')[1].split(']')[0]
-large_image = False
-for i in range(0, 3):
-    size_tmp = int(size_info.split(', ')[i])
-    if size_tmp >= 350:
-        large_image = True
-        break
+large_image = any(size >= 350 for size in images.image_size(brainImage)[:3])
 
 pyramidOptions = ["-p", "4", "-l", "1"]
 if large_image:
     pyramidOptions = ["-p", "5", "-l", "2"]
 
 # Rough mask with whole brain
-command = [animaPyramidalBMRegistration, "-m", atlasImage, "-r", brainImage, "-o", brainImagePrefix + "_rig.nrrd",
+command = [tools.animaPyramidalBMRegistration, "-m", atlasImage, "-r", brainImage, "-o", brainImagePrefix + "_rig.nrrd",
            "-O", brainImagePrefix + "_rig_tr.txt", "--sp", "3"] + pyramidOptions
 call(command)
 
-command = [animaPyramidalBMRegistration, "-m", atlasImage, "-r", brainImage, "-o", brainImagePrefix + "_aff.nrrd",
+command = [tools.animaPyramidalBMRegistration, "-m", atlasImage, "-r", brainImage, "-o", brainImagePrefix + "_aff.nrrd",
            "-O", brainImagePrefix + "_aff_tr.txt", "-i", brainImagePrefix + "_rig_tr.txt", "--sp", "3", "--ot",
            "2"] + pyramidOptions
 call(command)
 
-command = [animaDenseSVFBMRegistration, "-r", brainImage, "-m", brainImagePrefix + "_aff.nrrd", "-o",
+command = [tools.animaDenseSVFBMRegistration, "-r", brainImage, "-m", brainImagePrefix + "_aff.nrrd", "-o",
            brainImagePrefix + "_nl.nrrd", "-O", brainImagePrefix + "_nl_tr.nrrd", "--sr", "1"] + pyramidOptions
 call(command)
 
-command = [animaTransformSerieXmlGenerator, "-i", brainImagePrefix + "_aff_tr.txt", "-i",
+command = [tools.animaTransformSerieXmlGenerator, "-i", brainImagePrefix + "_aff_tr.txt", "-i",
            brainImagePrefix + "_nl_tr.nrrd", "-o", brainImagePrefix + "_nl_tr.xml"]
 call(command)
 
-command = [animaApplyTransformSerie, "-i", iccImage, "-t", brainImagePrefix + "_nl_tr.xml", "-g", brainImage, "-o",
+command = [tools.animaApplyTransformSerie, "-i", iccImage, "-t", brainImagePrefix + "_nl_tr.xml", "-g", brainImage, "-o",
            brainImagePrefix + "_rough_brainMask.nrrd", "-n", "nearest"]
 call(command)
 
-command = [animaMaskImage, "-i", brainImage, "-m", brainImagePrefix + "_rough_brainMask.nrrd", "-o",
+command = [tools.animaMaskImage, "-i", brainImage, "-m", brainImagePrefix + "_rough_brainMask.nrrd", "-o",
            brainImagePrefix + "_rough_masked.nrrd"]
 call(command)
 
@@ -120,29 +104,29 @@ brainImageRoughMasked = brainImagePrefix + "_rough_masked.nrrd"
 
 if args.second_step is True:
     # Fine mask with masked brain
-    command = [animaPyramidalBMRegistration, "-m", atlasImageMasked, "-r", brainImageRoughMasked, "-o",
+    command = [tools.animaPyramidalBMRegistration, "-m", atlasImageMasked, "-r", brainImageRoughMasked, "-o",
                brainImagePrefix + "_rig.nrrd", "-O", brainImagePrefix + "_rig_tr.txt", "--sp", "3"] + pyramidOptions
     call(command)
 
-    command = [animaPyramidalBMRegistration, "-m", atlasImageMasked, "-r", brainImageRoughMasked, "-o",
+    command = [tools.animaPyramidalBMRegistration, "-m", atlasImageMasked, "-r", brainImageRoughMasked, "-o",
                brainImagePrefix + "_aff.nrrd", "-O", brainImagePrefix + "_aff_tr.txt", "-i",
                brainImagePrefix + "_rig_tr.txt", "--sp", "3", "--ot", "2"] + pyramidOptions
     call(command)
 
-    command = [animaDenseSVFBMRegistration, "-r", brainImageRoughMasked, "-m", brainImagePrefix + "_aff.nrrd", "-o",
+    command = [tools.animaDenseSVFBMRegistration, "-r", brainImageRoughMasked, "-m", brainImagePrefix + "_aff.nrrd", "-o",
                brainImagePrefix + "_nl.nrrd", "-O", brainImagePrefix + "_nl_tr.nrrd", "--sr", "1"] + pyramidOptions
     call(command)
 
-    command = [animaApplyTransformSerie, "-i", iccImage, "-t", brainImagePrefix + "_nl_tr.xml", "-g", brainImage, "-o",
+    command = [tools.animaApplyTransformSerie, "-i", iccImage, "-t", brainImagePrefix + "_nl_tr.xml", "-g", brainImage, "-o",
                brainMask, "-n", "nearest"]
     call(command)
 
-    command = [animaMaskImage, "-i", brainImage, "-m", brainMask, "-o", maskedBrain]
+    command = [tools.animaMaskImage, "-i", brainImage, "-m", brainMask, "-o", maskedBrain]
     call(command)
 else:
-    command = [animaConvertImage, "-i", brainImageRoughMasked, "-o", maskedBrain]
+    command = [tools.animaConvertImage, "-i", brainImageRoughMasked, "-o", maskedBrain]
     call(command)
-    command = [animaConvertImage, "-i", brainImagePrefix + "_rough_brainMask.nrrd", "-o", brainMask]
+    command = [tools.animaConvertImage, "-i", brainImagePrefix + "_rough_brainMask.nrrd", "-o", brainMask]
     call(command)
 
 if args.intermediate_folder is None:
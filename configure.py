@@ -11,6 +11,9 @@ parser.add_argument('-s', '--scripts-public', type=str, default="~/Anima-Scripts
 parser.add_argument('-S', '--scripts-private', type=str, default="~/Anima-Scripts/", help="Anima scripts private folder")
 parser.add_argument('-d', '--scripts-data', type=str, default="~/Anima-Scripts-Data-Public/", help="Anima scripts data folder")
 parser.add_argument('-a', '--anima', type=str, default="~/Anima-Public/build/bin/", help="Anima executables folder")
+parser.add_argument('-c', '--cache', type=str, default="", help="Folder caching Anima tool results (disabled if not provided)")
+parser.add_argument('--cache-size', type=float, default=50, help="Maximal size of the cache in GB")
+parser.add_argument('--scratch-root', type=str, default="", help="Folder for intermediate files, e.g. a node-local disk (default: system temporary folder)")
 
 args = parser.parse_args()
 
@@ -42,4 +45,13 @@ configFile.write("anima = " + animaPath + "\n")
 dataPath = os.path.abspath(os.path.expanduser(os.path.normpath(args.scripts_data))) + os.sep
 configFile.write("extra-data-root = " + dataPath + "\n")
 
+if args.cache != "":
+    cachePath = os.path.abspath(os.path.expanduser(os.path.normpath(args.cache))) + os.sep
+    configFile.write("cache-dir = " + cachePath + "\n")
+    configFile.write("cache-size = " + str(args.cache_size) + "\n")
+
+if args.scratch_root != "":
+    scratchPath = os.path.abspath(os.path.expanduser(os.path.normpath(args.scratch_root))) + os.sep
+    configFile.write("scratch-root = " + scratchPath + "\n")
+
 configFile.close()
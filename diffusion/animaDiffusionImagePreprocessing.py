@@ -3,31 +3,22 @@
 
 import sys
 import argparse
-import tempfile
-import pydicom
-import numpy as np
 import struct
 
-if sys.version_info[0] > 2:
-    import configparser as ConfParser
-else:
-    import ConfigParser as ConfParser
-
 import os
 import shutil
-from subprocess import call
 
-configFilePath = os.path.join(os.path.expanduser("~"), ".anima",  "config.txt")
-if not os.path.exists(configFilePath):
-    print('Please create a configuration file for Anima python scripts. Refer to the README')
-    quit()
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+from animaRuntime import config, execution, scratch, tools
+from animaRuntime.execution import call
+from animaRuntime.lazy import lazy_import
 
-configParser = ConfParser.RawConfigParser()
-configParser.read(configFilePath)
+# Only needed when gradients are reworked from dicoms
+pydicom = lazy_import("pydicom")
+np = lazy_import("numpy")
 
-animaDir = configParser.get("anima-scripts", 'anima')
-animaDataDir = configParser.get("anima-scripts", 'extra-data-root')
-animaScriptsDir = configParser.get("anima-scripts", 'anima-scripts-public-root')
+animaDataDir = config.extra_data_dir()
+animaScriptsDir = config.scripts_public_dir()
 
 # Argument parsing
 parser = argparse.ArgumentParser(
@@ -47,25 +38,19 @@ parser.add_argument('--no-eddy-correction', action='store_true',
 parser.add_argument('--register-t1-on-dwi', action='store_true',
                     help="T1 registration on DWI is needed as they were not acquired in the same session")
 parser.add_argument('-i', '--input', type=str, required=True, help='DWI file to process')
+parser.add_argument('--scratch-root', type=str, default="",
+                    help="Folder where intermediates are written, e.g. a node-local disk (default: scratch-root in the "
+                         "config file, or the system temporary folder)")
+parser.add_argument('--plan', type=str, nargs='*', metavar='TRACE',
+                    help="Print the step graph and its critical path (timings from the given or recorded traces) "
+                         "instead of running the pipeline")
 
 args = parser.parse_args()
 
-tmpFolder = tempfile.mkdtemp()
-
-animaEddyCurrentCorrection = os.path.join(animaDir,"animaEddyCurrentCorrection")
-animaConvertImage = os.path.join(animaDir,"animaConvertImage")
-animaCropImage = os.path.join(animaDir,"animaCropImage")
-animaMaskImage = os.path.join(animaDir,"animaMaskImage")
-animaMorphologicalOperations = os.path.join(animaDir,"animaMorphologicalOperations")
-animaTransformSerieXmlGenerator = os.path.join(animaDir,"animaTransformSerieXmlGenerator")
-animaApplyTransformSerie = os.path.join(animaDir,"animaApplyTransformSerie")
-animaPyramidalBMRegistration = os.path.join(animaDir,"animaPyramidalBMRegistration")
-animaDenseSVFBMRegistration = os.path.join(animaDir,"animaDenseSVFBMRegistration")
-animaDistortionCorrection = os.path.join(animaDir,"animaDistortionCorrection")
-animaBMDistortionCorrection = os.path.join(animaDir,"animaBMDistortionCorrection")
-animaApplyDistortionCorrection = os.path.join(animaDir,"animaApplyDistortionCorrection")
-animaNLMeansTemporal = os.path.join(animaDir,"animaNLMeansTemporal")
-animaDTIEstimator = os.path.join(animaDir,"animaDTIEstimator")
+if args.plan is not None:
+    execution.enable_plan(args.plan)
+
+tmpFolder = scratch.make_temp_dir(args.scratch_root)
 
 pythonExecutable = sys.executable
 animaBrainExtraction = os.path.join(animaScriptsDir,"brain_extraction","animaAtlasBasedBrainExtraction.py")
@@ -77,7 +62,10 @@ if os.path.splitext(dwiImage)[1] == '.gz':
 
 tmpDWIImagePrefix = os.path.join(tmpFolder, os.path.basename(dwiImagePrefix))
 
+# The 4D DWI is read by most steps, work on a copy in the scratch folder
+dwiImage = scratch.stage_in(dwiImage, tmpFolder)
 outputImage = dwiImage
+brainMask = tmpDWIImagePrefix + "_brainMask.nrrd"
 outputBVec = args.grad
 
 if not (args.dicom == "") and not (args.grad == ""):
@@ -161,7 +149,7 @@ if outputBVec == "":
 # Distortion correction first
 # Eddy current first
 if args.no_eddy_correction is False:
-    eddyCorrectionCommand = [animaEddyCurrentCorrection, "-i", dwiImage, "-I", outputBVec, "-o",
+    eddyCorrectionCommand = [tools.animaEddyCurrentCorrection, "-i", dwiImage, "-I", outputBVec, "-o",
                              tmpDWIImagePrefix + "_eddy_corrected.nrrd",
                              "-O", tmpDWIImagePrefix + "_eddy_corrected.bvec", "-d", str(args.direction)]
     call(eddyCorrectionCommand)
@@ -171,30 +159,36 @@ if args.no_eddy_correction is False:
 
 # Extract brain from T1 image if present (used for further processing)
 if (args.no_disto_correction is False or args.no_brain_masking is False) and not args.t1 == "":
+    T1Prefix = os.path.splitext(args.t1)[0]
+    if os.path.splitext(args.t1)[1] == '.gz':
+        T1Prefix = os.path.splitext(T1Prefix)[0]
+
     brainExtractionCommand = [pythonExecutable, animaBrainExtraction, "-i", args.t1]
-    call(brainExtractionCommand)
+    if args.scratch_root != "":
+        brainExtractionCommand += ["--scratch-root", args.scratch_root]
+    call(brainExtractionCommand, outputs=[T1Prefix + "_brainMask.nrrd", T1Prefix + "_masked.nrrd"])
 
 # Then susceptibility distortion
 if args.no_disto_correction is False:
     if not (args.reverse == ""):
-        b0ExtractCommand = [animaCropImage, "-i", outputImage, "-t", "0", "-T", "0", "-o",
+        b0ExtractCommand = [tools.animaCropImage, "-i", outputImage, "-t", "0", "-T", "0", "-o",
                             tmpDWIImagePrefix + "_B0.nrrd"]
         call(b0ExtractCommand)
 
         idTrsfName = os.path.join(animaDataDir, "id.txt")
         idTrsfXmlName = os.path.join(tmpFolder, "id.xml")
-        idGenCommand = [animaTransformSerieXmlGenerator, "-i", idTrsfName, "-o", idTrsfXmlName]
+        idGenCommand = [tools.animaTransformSerieXmlGenerator, "-i", idTrsfName, "-o", idTrsfXmlName]
         call(idGenCommand)
 
-        resampleB0PACommand = [animaApplyTransformSerie, "-i", args.reverse, "-t", idTrsfXmlName, "-o",
+        resampleB0PACommand = [tools.animaApplyTransformSerie, "-i", args.reverse, "-t", idTrsfXmlName, "-o",
                                tmpDWIImagePrefix + "_B0_Reverse.nrrd", "-g", tmpDWIImagePrefix + "_B0.nrrd"]
         call(resampleB0PACommand)
 
-        initCorrectionCommand = [animaDistortionCorrection, "-s", "2", "-d", str(args.direction),
+        initCorrectionCommand = [tools.animaDistortionCorrection, "-s", "2", "-d", str(args.direction),
                                  "-f", tmpDWIImagePrefix + "_B0.nrrd", "-b", tmpDWIImagePrefix + "_B0_Reverse.nrrd",
                                  "-o", tmpDWIImagePrefix + "_init_correction_tr.nrrd"]
         call(initCorrectionCommand)
-        bmCorrectionCommand = [animaBMDistortionCorrection, "-f", tmpDWIImagePrefix + "_B0.nrrd",
+        bmCorrectionCommand = [tools.animaBMDistortionCorrection, "-f", tmpDWIImagePrefix + "_B0.nrrd",
                                "-b", tmpDWIImagePrefix + "_B0_Reverse.nrrd", "-o",
                                tmpDWIImagePrefix + "_B0_corrected.nrrd", "-i",
                                tmpDWIImagePrefix + "_init_correction_tr.nrrd",
@@ -202,14 +196,14 @@ if args.no_disto_correction is False:
                                tmpDWIImagePrefix + "_B0_correction_tr.nrrd"]
         call(bmCorrectionCommand)
 
-        applyCorrectionCommand = [animaApplyDistortionCorrection, "-f", outputImage, "-t",
+        applyCorrectionCommand = [tools.animaApplyDistortionCorrection, "-f", outputImage, "-t",
                                   tmpDWIImagePrefix + "_B0_correction_tr.nrrd", "-o",
                                   tmpDWIImagePrefix + "_corrected.nrrd"]
         call(applyCorrectionCommand)
 
         outputImage = tmpDWIImagePrefix + "_corrected.nrrd"
     elif not (args.t1 == ""):
-        b0ExtractCommand = [animaCropImage, "-i", outputImage, "-t", "0", "-T", "0", "-o",
+        b0ExtractCommand = [tools.animaCropImage, "-i", outputImage, "-t", "0", "-T", "0", "-o",
                             tmpDWIImagePrefix + "_B0.nrrd"]
         call(b0ExtractCommand)
 
@@ -219,7 +213,7 @@ if args.no_disto_correction is False:
 
         tmpT1Prefix = os.path.join(tmpFolder, os.path.basename(T1Prefix))
 
-        correctionCommand = [animaPyramidalBMRegistration, "-r", tmpDWIImagePrefix + "_B0.nrrd",
+        correctionCommand = [tools.animaPyramidalBMRegistration, "-r", tmpDWIImagePrefix + "_B0.nrrd",
                              "-m", T1Prefix + "_masked.nrrd", "-o", tmpT1Prefix + "_rig.nrrd",
                              "-O", tmpT1Prefix + "_rig_tr.txt", "-p", "4", "-l", "1", "--sp", "2"]
         if args.register_t1_on_dwi is True:
@@ -228,30 +222,30 @@ if args.no_disto_correction is False:
             correctionCommand += ["-I", "0"]
         call(correctionCommand)
 
-        command = [animaTransformSerieXmlGenerator, "-i", tmpT1Prefix + "_rig_tr.txt", "-o",
+        command = [tools.animaTransformSerieXmlGenerator, "-i", tmpT1Prefix + "_rig_tr.txt", "-o",
                    tmpT1Prefix + "_rig_tr.xml"]
         call(command)
 
-        command = [animaApplyTransformSerie, "-i", T1Prefix + "_brainMask.nrrd", "-t",
+        command = [tools.animaApplyTransformSerie, "-i", T1Prefix + "_brainMask.nrrd", "-t",
                    tmpT1Prefix + "_rig_tr.xml", "-o", tmpDWIImagePrefix + "_roughMask.nrrd", "-g",
                    tmpDWIImagePrefix + "_B0.nrrd", "-n", "nearest"]
         call(command)
 
-        morphoCommand = [animaMorphologicalOperations, "-i", tmpDWIImagePrefix + "_roughMask.nrrd", "-a", "dil",
+        morphoCommand = [tools.animaMorphologicalOperations, "-i", tmpDWIImagePrefix + "_roughMask.nrrd", "-a", "dil",
                          "-r", "4", "-o", tmpDWIImagePrefix + "_roughMask_dil.nrrd"]
         call(morphoCommand)
 
-        maskCommand = [animaMaskImage, "-i", tmpDWIImagePrefix + "_B0.nrrd", "-o",
+        maskCommand = [tools.animaMaskImage, "-i", tmpDWIImagePrefix + "_B0.nrrd", "-o",
                        tmpDWIImagePrefix + "_B0_rough_masked.nrrd", "-m", tmpDWIImagePrefix + "_roughMask_dil.nrrd"]
         call(maskCommand)
 
-        correctionCommand = [animaDenseSVFBMRegistration, "-r", tmpT1Prefix + "_rig.nrrd",
+        correctionCommand = [tools.animaDenseSVFBMRegistration, "-r", tmpT1Prefix + "_rig.nrrd",
                              "-m", tmpDWIImagePrefix + "_B0_rough_masked.nrrd", "-o",
                              tmpDWIImagePrefix + "_B0_corrected.nrrd", "-d", str(args.direction),
                              "-O", tmpDWIImagePrefix + "_B0_correction_tr.nrrd", "-t", "3", "--sym-reg", "2"]
         call(correctionCommand)
 
-        applyCorrectionCommand = [animaApplyDistortionCorrection, "-f", outputImage, "-t",
+        applyCorrectionCommand = [tools.animaApplyDistortionCorrection, "-f", outputImage, "-t",
                                   tmpDWIImagePrefix + "_B0_correction_tr.nrrd", "-o",
                                   tmpDWIImagePrefix + "_corrected.nrrd"]
         call(applyCorrectionCommand)
@@ -259,14 +253,14 @@ if args.no_disto_correction is False:
         outputImage = tmpDWIImagePrefix + "_corrected.nrrd"
 
 # Then re-orient image to be axial first
-dwiReorientCommand = [animaConvertImage, "-i", outputImage, "-o", tmpDWIImagePrefix + "_or.nrrd", "-R",
+dwiReorientCommand = [tools.animaConvertImage, "-i", outputImage, "-o", tmpDWIImagePrefix + "_or.nrrd", "-R",
                       "AXIAL"]
 call(dwiReorientCommand)
 outputImage = tmpDWIImagePrefix + "_or.nrrd"
 
 # Then perform denoising
 if args.no_denoising is False:
-    denoisingCommand = [animaNLMeansTemporal, "-i", outputImage, "-b", "0.5", "-n", "3", "-o",
+    denoisingCommand = [tools.animaNLMeansTemporal, "-i", outputImage, "-b", "0.5", "-n", "3", "-o",
                         tmpDWIImagePrefix + "_nlm.nrrd"]
     call(denoisingCommand)
     outputImage = tmpDWIImagePrefix + "_nlm.nrrd"
@@ -275,17 +269,19 @@ if args.no_denoising is False:
 if args.no_brain_masking is False:
     brainImage = args.t1
 
-    b0ExtractCommand = [animaCropImage, "-i", outputImage, "-t", "0", "-T", "0", "-o",
+    b0ExtractCommand = [tools.animaCropImage, "-i", outputImage, "-t", "0", "-T", "0", "-o",
                         tmpDWIImagePrefix + "_forBrainExtract.nrrd"]
     call(b0ExtractCommand)
 
     if brainImage == "":
         brainImage = tmpDWIImagePrefix + "_forBrainExtract.nrrd"
         brainExtractionCommand = [pythonExecutable, animaBrainExtraction, "-i", brainImage]
-        call(brainExtractionCommand)
+        if args.scratch_root != "":
+            brainExtractionCommand += ["--scratch-root", args.scratch_root]
+        call(brainExtractionCommand, outputs=[tmpDWIImagePrefix + "_forBrainExtract_brainMask.nrrd"])
 
     if args.t1 == "":
-        shutil.move(tmpDWIImagePrefix + "_forBrainExtract_brainMask.nrrd", dwiImagePrefix + "_brainMask.nrrd")
+        execution.move(tmpDWIImagePrefix + "_forBrainExtract_brainMask.nrrd", brainMask)
     else:
         T1Prefix = os.path.splitext(args.t1)[0]
         if os.path.splitext(args.t1)[1] == '.gz':
@@ -293,7 +289,7 @@ if args.no_brain_masking is False:
 
         tmpT1Prefix = os.path.join(tmpFolder, os.path.basename(T1Prefix))
 
-        t1RegistrationCommand = [animaPyramidalBMRegistration, "-r",
+        t1RegistrationCommand = [tools.animaPyramidalBMRegistration, "-r",
                                  tmpDWIImagePrefix + "_forBrainExtract.nrrd", "-m", T1Prefix + "_masked.nrrd", "-o",
                                  tmpT1Prefix + "_rig.nrrd", "-O", tmpT1Prefix + "_rig_tr.txt", "-p", "4", "-l", "1",
                                  "--sp", "2"]
@@ -305,32 +301,38 @@ if args.no_brain_masking is False:
 
         call(t1RegistrationCommand)
 
-        command = [animaTransformSerieXmlGenerator, "-i", tmpT1Prefix + "_rig_tr.txt", "-o",
+        command = [tools.animaTransformSerieXmlGenerator, "-i", tmpT1Prefix + "_rig_tr.txt", "-o",
                    tmpT1Prefix + "_rig_tr.xml"]
         call(command)
 
-        command = [animaApplyTransformSerie, "-i", T1Prefix + "_brainMask.nrrd", "-t",
-                   tmpT1Prefix + "_rig_tr.xml", "-o", dwiImagePrefix + "_brainMask.nrrd", "-g",
+        command = [tools.animaApplyTransformSerie, "-i", T1Prefix + "_brainMask.nrrd", "-t",
+                   tmpT1Prefix + "_rig_tr.xml", "-o", brainMask, "-g",
                    tmpDWIImagePrefix + "_forBrainExtract.nrrd", "-n", "nearest"]
         call(command)
 
-    brainExtractionCommand = [animaMaskImage, "-i", outputImage, "-m", dwiImagePrefix + "_brainMask.nrrd",
+    brainExtractionCommand = [tools.animaMaskImage, "-i", outputImage, "-m", brainMask,
                               "-o", tmpDWIImagePrefix + "_masked.nrrd"]
     call(brainExtractionCommand)
 
     outputImage = tmpDWIImagePrefix + "_masked.nrrd"
 
-shutil.copy(outputImage, dwiImagePrefix + "_preprocessed.nrrd")
-shutil.copy(outputBVec, dwiImagePrefix + "_preprocessed.bvec")
-
 # Estimate tensors if files were provided
-dtiEstimationCommand = [animaDTIEstimator, "-i", outputImage, "-o", dwiImagePrefix + "_Tensors.nrrd",
-                        "-O", dwiImagePrefix + "_Tensors_B0.nrrd", "-N", dwiImagePrefix + "_Tensors_NoiseVariance.nrrd",
-                        "-g", outputBVec, "-b", args.bval]
+dtiEstimationCommand = [tools.animaDTIEstimator, "-i", outputImage, "-o", tmpDWIImagePrefix + "_Tensors.nrrd",
+                        "-O", tmpDWIImagePrefix + "_Tensors_B0.nrrd", "-N",
+                        tmpDWIImagePrefix + "_Tensors_NoiseVariance.nrrd", "-g", outputBVec, "-b", args.bval]
 
 if args.no_brain_masking is False:
-    dtiEstimationCommand += ["-m", dwiImagePrefix + "_brainMask.nrrd"]
+    dtiEstimationCommand += ["-m", brainMask]
 
 call(dtiEstimationCommand)
 
+# Stage final outputs out of the scratch folder
+scratch.stage_out(outputImage, dwiImagePrefix + "_preprocessed.nrrd")
+execution.copy(outputBVec, dwiImagePrefix + "_preprocessed.bvec")
+for suffix in ["_Tensors.nrrd", "_Tensors_B0.nrrd", "_Tensors_NoiseVariance.nrrd"]:
+    scratch.stage_out(tmpDWIImagePrefix + suffix, dwiImagePrefix + suffix)
+
+if args.no_brain_masking is False:
+    scratch.stage_out(brainMask, dwiImagePrefix + "_brainMask.nrrd")
+
 shutil.rmtree(tmpFolder)
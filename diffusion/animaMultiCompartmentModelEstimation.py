@@ -4,23 +4,11 @@
 import sys
 import argparse
 
-if sys.version_info[0] > 2:
-    import configparser as ConfParser
-else:
-    import ConfigParser as ConfParser
-
 import os
-from subprocess import call
-
-configFilePath = os.path.join(os.path.expanduser("~"), ".anima",  "config.txt")
-if not os.path.exists(configFilePath):
-    print('Please create a configuration file for Anima python scripts. Refer to the README')
-    quit()
 
-configParser = ConfParser.RawConfigParser()
-configParser.read(configFilePath)
-
-animaDir = configParser.get("anima-scripts", 'anima')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+from animaRuntime import execution, tools
+from animaRuntime.execution import call
 
 # Argument parsing
 parser = argparse.ArgumentParser(
@@ -42,10 +30,17 @@ parser.add_argument('-b', '--bval', type=str, required=True, help='DWI b-value o
 parser.add_argument('-g', '--bvec', type=str, required=True, help='DWI gradients file')
 parser.add_argument('-m', '--mask', type=str, default="", help='Computation mask')
 
+parser.add_argument('--plan', type=str, nargs='*', metavar='TRACE',
+                    help="Print the step graph and its critical path (timings from the given or recorded traces) "
+                         "instead of running the pipeline")
+
 args = parser.parse_args()
 
+if args.plan is not None:
+    execution.enable_plan(args.plan)
+
 # Get parameters from arguments parser
-baseEstimationCommand = [animaDir + "animaMCMEstimator", "-FR"]
+baseEstimationCommand = [tools.animaMCMEstimator, "-FR"]
 if args.type.lower() == "ddi":
     baseEstimationCommand += ["--optimizer", "bobyqa", "--ml-mode", "1"]
 else:
@@ -107,7 +102,7 @@ if (args.no_model_simplification is False) and (args.model_selection is False):
     mergeDataB0File.close()
     mergeDataS2File.close()
 
-    averagingCommand = [animaDir + "animaMCMModelAveraging", "-i", dwiImagePrefix + "_MCM_List.txt", "-b",
+    averagingCommand = [tools.animaMCMModelAveraging, "-i", dwiImagePrefix + "_MCM_List.txt", "-b",
                         dwiImagePrefix + "_MCM_B0_List.txt", "-n", dwiImagePrefix + "_MCM_S2_List.txt", "-a",
                         dwiImagePrefix + "_MCM_AIC_List.txt", "-o",
                         dwiImagePrefix + "_MCM_avg.mcm", "-O", dwiImagePrefix + "_MCM_B0_avg.nrrd", "-N",
@@ -3,23 +3,11 @@
 import sys
 import argparse
 
-if sys.version_info[0] > 2:
-    import configparser as ConfParser
-else:
-    import ConfigParser as ConfParser
-
 import os
-from subprocess import call
-
-configFilePath = os.path.join(os.path.expanduser("~"), ".anima",  "config.txt")
-if not os.path.exists(configFilePath):
-    print('Please create a configuration file for Anima python scripts. Refer to the README')
-    quit()
-
-configParser = ConfParser.RawConfigParser()
-configParser.read(configFilePath)
 
-animaDir = configParser.get("anima-scripts", 'anima')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, os.pardir))
+from animaRuntime import tools, voxelwise
+from animaRuntime.execution import call
 
 # Argument parsing
 parser = argparse.ArgumentParser(
@@ -43,18 +31,6 @@ args = parser.parse_args()
 # - Computes full brain tractography
 # - Filters it to get atlas fiber tracts
 
-animaComputeDTIScalarMaps = os.path.join(animaDir, "animaComputeDTIScalarMaps")
-animaThrImage = os.path.join(animaDir, "animaThrImage")
-animaTransformSerieXmlGenerator = os.path.join(animaDir, "animaTransformSerieXmlGenerator")
-animaApplyTransformSerie = os.path.join(animaDir, "animaApplyTransformSerie")
-animaMCMApplyTransformSerie = os.path.join(animaDir, "animaMCMApplyTransformSerie")
-animaMCMAverageImages = os.path.join(animaDir, "animaMCMAverageImages")
-animaAverageImages = os.path.join(animaDir, "animaAverageImages")
-animaDTITractography = os.path.join(animaDir, "animaDTITractography")
-animaMajorityLabelVoting = os.path.join(animaDir, "animaMajorityLabelVoting")
-animaFibersFilterer = os.path.join(animaDir, "animaFibersFilterer")
-animaTracksMCMPropertiesExtraction = os.path.join(animaDir, "animaTracksMCMPropertiesExtraction")
-
 os.makedirs('Transformed_MCM', exist_ok=True)
 os.makedirs('Transformed_Tracts_Masks', exist_ok=True)
 os.makedirs('Atlas_Tracts', exist_ok=True)
@@ -85,12 +61,12 @@ maskListFile = open(os.path.join('Transformed_MCM', 'listMasks.txt'), "w")
 
 for dataNum in range(1, args.num_subjects + 1):
     # Apply transformations to additional MCM, assumes all transforms are in residualDir
-    trsfGeneratorCommand = [animaTransformSerieXmlGenerator, "-i", os.path.join("residualDir", tensorsPrefix + "_" + str(dataNum) + "_linear_tr.txt"),
+    trsfGeneratorCommand = [tools.animaTransformSerieXmlGenerator, "-i", os.path.join("residualDir", tensorsPrefix + "_" + str(dataNum) + "_linear_tr.txt"),
                             "-i", os.path.join("residualDir", tensorsPrefix + "_" + str(dataNum) + "_nonlinear_tr.nrrd"),
                             "-i", os.path.join("residualDir", "sumNonlinear_inv_tr.nrrd"), "-o", os.path.join("residualDir", "trsf_" + str(dataNum) + ".xml")]
     call(trsfGeneratorCommand)
 
-    mcmApplyCommand = [animaMCMApplyTransformSerie,
+    mcmApplyCommand = [tools.animaMCMApplyTransformSerie,
                        "-i", os.path.join(mcmPrefixBase, mcmPrefix + "_" + str(dataNum) + ".mcm"),
                        "-o", os.path.join('Transformed_MCM', mcmPrefix + "_" + str(dataNum) + ".mcm"),
                        "-t", os.path.join("residualDir", "trsf_" + str(dataNum) + ".xml"),
@@ -99,7 +75,7 @@ for dataNum in range(1, args.num_subjects + 1):
 
     mcmListFile.write(os.path.join(os.getcwd(), 'Transformed_MCM', mcmPrefix + "_" + str(dataNum) + ".mcm") + "\n")
 
-    mcmB0ApplyCommand = [animaApplyTransformSerie,
+    mcmB0ApplyCommand = [tools.animaApplyTransformSerie,
                          "-i", os.path.join(mcmPrefixBase, mcmPrefix + "_B0_" + str(dataNum) + ".nrrd"),
                          "-o", os.path.join('Transformed_MCM', mcmPrefix + "_B0_" + str(dataNum) + ".nrrd"),
                          "-t", os.path.join("residualDir", "trsf_" + str(dataNum) + ".xml"),
@@ -108,7 +84,7 @@ for dataNum in range(1, args.num_subjects + 1):
 
     mcmB0ListFile.write(os.path.join(os.getcwd(), 'Transformed_MCM', mcmPrefix + "_B0_" + str(dataNum) + ".nrrd") + "\n")
 
-    mcmS2ApplyCommand = [animaApplyTransformSerie,
+    mcmS2ApplyCommand = [tools.animaApplyTransformSerie,
                          "-i", os.path.join(mcmPrefixBase, mcmPrefix + "_S2_" + str(dataNum) + ".nrrd"),
                          "-o", os.path.join('Transformed_MCM', mcmPrefix + "_S2_" + str(dataNum) + ".nrrd"),
                          "-t", os.path.join("residualDir", "trsf_" + str(dataNum) + ".xml"),
@@ -117,7 +93,7 @@ for dataNum in range(1, args.num_subjects + 1):
 
     mcmS2ListFile.write(os.path.join(os.getcwd(), 'Transformed_MCM', mcmPrefix + "_S2_" + str(dataNum) + ".nrrd") + "\n")
 
-    maskApplyCommand = [animaApplyTransformSerie,
+    maskApplyCommand = [tools.animaApplyTransformSerie,
                         "-i", os.path.join(maskPrefixBase, maskPrefix + "_" + str(dataNum) + ".nrrd"),
                         "-o", os.path.join('Transformed_MCM', maskPrefix + "_" + str(dataNum) + ".nrrd"),
                         "-t", os.path.join("residualDir", "trsf_" + str(dataNum) + ".xml"),
@@ -129,7 +105,7 @@ for dataNum in range(1, args.num_subjects + 1):
     # Now apply the transform to all tractseg regions
     for track in tracksLists:
         # Apply transform to fused begin and end mask
-        applyCommand = [animaApplyTransformSerie,
+        applyCommand = [tools.animaApplyTransformSerie,
                         "-i", os.path.join(args.tracts_folder, track + "_" + str(dataNum) + ".nrrd"),
                         "-o", os.path.join('Transformed_Tracts_Masks', track + "_" + str(dataNum) + ".nrrd"),
                         "-t", os.path.join("residualDir", "trsf_" + str(dataNum) + ".xml"),
@@ -142,25 +118,22 @@ mcmB0ListFile.close()
 mcmS2ListFile.close()
 maskListFile.close()
 
-mergeMCMCommand = [animaMCMAverageImages, "-i", os.path.join('Transformed_MCM', 'listMCM.txt'), "-n", "3",
+mergeMCMCommand = [tools.animaMCMAverageImages, "-i", os.path.join('Transformed_MCM', 'listMCM.txt'), "-n", "3",
                    "-m", os.path.join('Transformed_MCM', 'listMasks.txt'), "-o", "averageMCM.mcm"]
 call(mergeMCMCommand)
 
-mergeMCMB0Command = [animaAverageImages, "-i", os.path.join('Transformed_MCM', 'listMCM_B0.txt'), "-m", os.path.join('Transformed_MCM', 'listMasks.txt'), "-o", "averageMCM_B0.nrrd"]
+mergeMCMB0Command = [tools.animaAverageImages, "-i", os.path.join('Transformed_MCM', 'listMCM_B0.txt'), "-m", os.path.join('Transformed_MCM', 'listMasks.txt'), "-o", "averageMCM_B0.nrrd"]
 call(mergeMCMB0Command)
 
-mergeMCMS2Command = [animaAverageImages, "-i", os.path.join('Transformed_MCM', 'listMCM_S2.txt'), "-m", os.path.join('Transformed_MCM', 'listMasks.txt'), "-o", "averageMCM_S2.nrrd"]
+mergeMCMS2Command = [tools.animaAverageImages, "-i", os.path.join('Transformed_MCM', 'listMCM_S2.txt'), "-m", os.path.join('Transformed_MCM', 'listMasks.txt'), "-o", "averageMCM_S2.nrrd"]
 call(mergeMCMS2Command)
 
 # Perform tractography on average MCM model
-adcCommand = [animaComputeDTIScalarMaps, "-i", args.dti_atlas_image, "-a", "averageADC.nrrd"]
-call(adcCommand)
-
-thrCommand = [animaThrImage, "-t", "0", "-i", "averageADC.nrrd", "-o",
-              "averageMask.nrrd"]
-call(thrCommand)
+# Tractography mask: tensors with a positive ADC
+voxelwise.apply(voxelwise.threshold(voxelwise.tensor_trace(voxelwise.image(args.dti_atlas_image)), 0),
+                "averageMask.nrrd", type="uint8")
 
-trackingCommand = [animaDTITractography, "-i", args.dti_atlas_image, "-s", "averageMask.nrrd", "--nb-fibers", "2", "-a", "90", "-p", "0",
+trackingCommand = [tools.animaDTITractography, "-i", args.dti_atlas_image, "-s", "averageMask.nrrd", "--nb-fibers", "2", "-a", "90", "-p", "0",
                    "-o", os.path.join('Atlas_Tracts', 'WholeBrain_Tractography.fds')]
 call(trackingCommand)
 
@@ -172,11 +145,11 @@ for track in tracksLists:
 
     trackMasksListFile.close()
 
-    majorityVoteCommand = [animaMajorityLabelVoting, "-i", os.path.join('Transformed_Tracts_Masks', 'listMasks.txt'),
+    majorityVoteCommand = [tools.animaMajorityLabelVoting, "-i", os.path.join('Transformed_Tracts_Masks', 'listMasks.txt'),
                            "-o", os.path.join('Transformed_Tracts_Masks', track + '_FilterMask.nrrd')]
     call(majorityVoteCommand)
 
-    fiberFilterCommand = [animaFibersFilterer, "-i", os.path.join('Atlas_Tracts', 'WholeBrain_Tractography.fds'),
+    fiberFilterCommand = [tools.animaFibersFilterer, "-i", os.path.join('Atlas_Tracts', 'WholeBrain_Tractography.fds'),
                           "-o", os.path.join('Atlas_Tracts', track + '.fds'),
                           "-r", os.path.join('Transformed_Tracts_Masks', track + '_FilterMask.nrrd'),
                           "-e", "1", "-e", "2"]
@@ -184,7 +157,7 @@ for track in tracksLists:
 
     trackListFile = open(os.path.join('Augmented_Atlas_Tracts', 'listData_' + track + '.txt'), "w")
     for dataNum in range(1, args.num_subjects + 1):
-        propsExtractionCommand = [animaTracksMCMPropertiesExtraction, "-i", os.path.join('Atlas_Tracts', track + '.fds'),
+        propsExtractionCommand = [tools.animaTracksMCMPropertiesExtraction, "-i", os.path.join('Atlas_Tracts', track + '.fds'),
                                   "-m", os.path.join('Transformed_MCM', mcmPrefix + "_" + str(dataNum) + ".mcm"),
                                   "-o", os.path.join('Augmented_Atlas_Tracts', track + '_MCM_augmented_' + str(dataNum) + '.fds')]
         call(propsExtractionCommand)
@@ -3,27 +3,15 @@
 import sys
 import argparse
 
-if sys.version_info[0] > 2:
-    import configparser as ConfParser
-else:
-    import ConfigParser as ConfParser
-
-import tempfile
 import os
 import glob
-from subprocess import call
 import shutil
 
-configFilePath = os.path.join(os.path.expanduser("~"), ".anima",  "config.txt")
-if not os.path.exists(configFilePath):
-    print('Please create a configuration file for Anima python scripts. Refer to the README')
-    quit()
-
-configParser = ConfParser.RawConfigParser()
-configParser.read(configFilePath)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, os.pardir))
+from animaRuntime import config, scratch, tools
+from animaRuntime.execution import call
 
-animaDir = configParser.get("anima-scripts", 'anima')
-animaScriptsDir = configParser.get("anima-scripts", 'anima-scripts-public-root')
+animaScriptsDir = config.scripts_public_dir()
 
 # Argument parsing
 parser = argparse.ArgumentParser(description="Given a fiber atlas constructed from controls data, and a patient image, performs patient to atlas comparison")
@@ -40,6 +28,9 @@ parser.add_argument('--register-t1-on-dwi', action='store_true', help="T1 regist
 parser.add_argument('-a', '--dti-atlas-image', type=str, required=True, help='DTI atlas image')
 parser.add_argument('-r', '--raw-tracts-folder', type=str, default='Atlas_Tracts', help='Raw atlas tracts folder')
 parser.add_argument('--tracts-folder', type=str, default='Augmented_Atlas_Tracts', help='Atlas tracts augmented with controls data')
+parser.add_argument('--scratch-root', type=str, default="",
+                    help="Folder where intermediates are written, e.g. a node-local disk (default: scratch-root in the "
+                         "config file, or the system temporary folder)")
 
 args = parser.parse_args()
 
@@ -50,21 +41,6 @@ args = parser.parse_args()
 # - for each tract, augment raw atlas tracts with data from patient
 # - for each tract, compute pairwise tests along tracts between patient and controls
 
-animaComputeDTIScalarMaps = os.path.join(animaDir, "animaComputeDTIScalarMaps")
-animaPyramidalBMRegistration = os.path.join(animaDir, "animaPyramidalBMRegistration")
-animaTransformSerieXmlGenerator = os.path.join(animaDir, "animaTransformSerieXmlGenerator")
-animaCreateImage = os.path.join(animaDir, "animaCreateImage")
-animaApplyTransformSerie = os.path.join(animaDir, "animaApplyTransformSerie")
-animaMaskImage = os.path.join(animaDir, "animaMaskImage")
-animaTensorApplyTransformSerie = os.path.join(animaDir, "animaTensorApplyTransformSerie")
-animaDenseTensorSVFBMRegistration = os.path.join(animaDir, "animaDenseTensorSVFBMRegistration")
-animaMCMApplyTransformSerie = os.path.join(animaDir, "animaMCMApplyTransformSerie")
-animaTracksMCMPropertiesExtraction = os.path.join(animaDir, "animaTracksMCMPropertiesExtraction")
-animaPatientToGroupComparisonOnTracks = os.path.join(animaDir, "animaPatientToGroupComparisonOnTracks")
-animaFibersApplyTransformSerie = os.path.join(animaDir, "animaFibersApplyTransformSerie")
-animaFibersFDRCorrectPValues = os.path.join(animaDir, "animaFibersFDRCorrectPValues")
-animaFibersDiseaseScores = os.path.join(animaDir, "animaFibersDiseaseScores")
-
 os.makedirs('Preprocessed_Patients_DWI', exist_ok=True)
 os.makedirs('Patients_Tensors', exist_ok=True)
 os.makedirs('Patients_MCM', exist_ok=True)
@@ -106,6 +82,9 @@ else:
     dicomGlobFiles = glob.glob(os.path.join(args.dw_dicom_folder, "*"))
     preprocCommand += ["-D"] + dicomGlobFiles
 
+if args.scratch_root != "":
+    preprocCommand += ["--scratch-root", args.scratch_root]
+
 call(preprocCommand)
 
 # Move preprocessed results to output folders
@@ -142,61 +121,61 @@ for f in glob.glob(os.path.join("Preprocessed_Patients_DWI", dwiPrefix + "_MCM*"
         os.remove(f)
 
 # Register patient onto atlas (same as register DT Image in atlas construction)
-tmpFolder = tempfile.mkdtemp()
-adcCommand = [animaComputeDTIScalarMaps, "-i", args.dti_atlas_image, "-a", os.path.join(tmpFolder, "averageADC.nrrd")]
+tmpFolder = scratch.make_temp_dir(args.scratch_root)
+adcCommand = [tools.animaComputeDTIScalarMaps, "-i", args.dti_atlas_image, "-a", os.path.join(tmpFolder, "averageADC.nrrd")]
 call(adcCommand)
 
-adcCommand = [animaComputeDTIScalarMaps, "-i", os.path.join("Patients_Tensors", dwiPrefix + "_Tensors.nrrd"),
+adcCommand = [tools.animaComputeDTIScalarMaps, "-i", os.path.join("Patients_Tensors", dwiPrefix + "_Tensors.nrrd"),
               "-a", os.path.join("Patients_Tensors", dwiPrefix + "_ADC.nrrd")]
 call(adcCommand)
 
-regCommand = [animaPyramidalBMRegistration, "-r", os.path.join(tmpFolder, "averageADC.nrrd"), "-m", os.path.join("Patients_Tensors", dwiPrefix + "_ADC.nrrd"),
+regCommand = [tools.animaPyramidalBMRegistration, "-r", os.path.join(tmpFolder, "averageADC.nrrd"), "-m", os.path.join("Patients_Tensors", dwiPrefix + "_ADC.nrrd"),
               "-o", os.path.join(tmpFolder, "Patient_aff.nrrd"), "-O", os.path.join(tmpFolder, "Patient_aff_tr.txt"),
               "--ot", "2", "-p", "3", "-l", "0", "-I", "2", "--sym-reg", "2", "-s", "0"]
 call(regCommand)
 
-command = [animaTransformSerieXmlGenerator, "-i", os.path.join(tmpFolder, "Patient_aff_tr.txt"), "-o", os.path.join(tmpFolder, "Patient_aff_tr.xml")]
+command = [tools.animaTransformSerieXmlGenerator, "-i", os.path.join(tmpFolder, "Patient_aff_tr.txt"), "-o", os.path.join(tmpFolder, "Patient_aff_tr.xml")]
 call(command)
 
-command = [animaCreateImage, "-b", "1", "-v", "1", "-g", os.path.join("Patients_Tensors", dwiPrefix + "_ADC.nrrd"),
+command = [tools.animaCreateImage, "-b", "1", "-v", "1", "-g", os.path.join("Patients_Tensors", dwiPrefix + "_ADC.nrrd"),
            "-o", os.path.join(tmpFolder,"tmpFullMask.nrrd")]
 call(command)
 
-command = [animaApplyTransformSerie, "-g", os.path.join(tmpFolder, "averageADC.nrrd"), "-i", os.path.join(tmpFolder,"tmpFullMask.nrrd"),
+command = [tools.animaApplyTransformSerie, "-g", os.path.join(tmpFolder, "averageADC.nrrd"), "-i", os.path.join(tmpFolder,"tmpFullMask.nrrd"),
            "-t", os.path.join(tmpFolder, "Patient_aff_tr.xml"), "-o", os.path.join(tmpFolder,"tmpMask_aff.nrrd"),
            "-n", "nearest"]
 call(command)
 
-command = [animaMaskImage, "-i", args.dti_atlas_image, "-m", os.path.join(tmpFolder, "tmpMask_aff.nrrd"),
+command = [tools.animaMaskImage, "-i", args.dti_atlas_image, "-m", os.path.join(tmpFolder, "tmpMask_aff.nrrd"),
            "-o", os.path.join(tmpFolder, "refDTI_c.nrrd")]
 call(command)
 
-command = [animaTensorApplyTransformSerie, "-i", os.path.join("Patients_Tensors", dwiPrefix + "_Tensors.nrrd"),
+command = [tools.animaTensorApplyTransformSerie, "-i", os.path.join("Patients_Tensors", dwiPrefix + "_Tensors.nrrd"),
            "-g", args.dti_atlas_image, "-t", os.path.join(tmpFolder, "Patient_aff_tr.xml"),
            "-o", os.path.join(tmpFolder, dwiPrefix + "_Tensors_aff.nrrd")]
 call(command)
 
-command = [animaDenseTensorSVFBMRegistration, "-r", os.path.join(tmpFolder, "refDTI_c.nrrd"),
+command = [tools.animaDenseTensorSVFBMRegistration, "-r", os.path.join(tmpFolder, "refDTI_c.nrrd"),
            "-m", os.path.join(tmpFolder, dwiPrefix + "_Tensors_aff.nrrd"), "-o", os.path.join(tmpFolder, dwiPrefix + "_nl.nrrd"),
            "-O", os.path.join(tmpFolder, dwiPrefix + "_nl_tr.nrrd"), "--sr", "1", "--es", "3", "--fs", "2", "--sym-reg", "2", "--metric", "3", "-s", "0.001"]
 call(command)
 
 # Non linear registration done. Now applying to MCM image
-command = [animaTransformSerieXmlGenerator, "-i", os.path.join(tmpFolder, "Patient_aff_tr.txt"), "-i", os.path.join(tmpFolder, dwiPrefix + "_nl_tr.nrrd"),
+command = [tools.animaTransformSerieXmlGenerator, "-i", os.path.join(tmpFolder, "Patient_aff_tr.txt"), "-i", os.path.join(tmpFolder, dwiPrefix + "_nl_tr.nrrd"),
            "-o", os.path.join(tmpFolder, "Patient_nl_tr.xml")]
 call(command)
 
-mcmApplyCommand = [animaMCMApplyTransformSerie, "-i", os.path.join("Patients_MCM", dwiPrefix + "_MCM_avg.mcm"),
+mcmApplyCommand = [tools.animaMCMApplyTransformSerie, "-i", os.path.join("Patients_MCM", dwiPrefix + "_MCM_avg.mcm"),
                    "-o", os.path.join('Transformed_Patients_MCM', dwiPrefix + "_MCM_avg_onAtlas.mcm"),
                    "-t", os.path.join(tmpFolder, "Patient_nl_tr.xml"), "-g", args.dti_atlas_image, "-n", "3"]
 call(mcmApplyCommand)
 
-mcmB0ApplyCommand = [animaApplyTransformSerie, "-i", os.path.join("Patients_MCM", dwiPrefix + "_MCM_avg_B0.nrrd"),
+mcmB0ApplyCommand = [tools.animaApplyTransformSerie, "-i", os.path.join("Patients_MCM", dwiPrefix + "_MCM_avg_B0.nrrd"),
                      "-o", os.path.join('Transformed_Patients_MCM', dwiPrefix + "_MCM_avg_B0_onAtlas.nrrd"),
                      "-t", os.path.join(tmpFolder, "Patient_nl_tr.xml"), "-g", args.dti_atlas_image]
 call(mcmB0ApplyCommand)
 
-mcmS2ApplyCommand = [animaApplyTransformSerie, "-i", os.path.join("Patients_MCM", dwiPrefix + "_MCM_avg_S2.nrrd"),
+mcmS2ApplyCommand = [tools.animaApplyTransformSerie, "-i", os.path.join("Patients_MCM", dwiPrefix + "_MCM_avg_S2.nrrd"),
                      "-o", os.path.join('Transformed_Patients_MCM', dwiPrefix + "_MCM_avg_S2_onAtlas.nrrd"),
                      "-t", os.path.join(tmpFolder, "Patient_nl_tr.xml"), "-g", args.dti_atlas_image]
 call(mcmS2ApplyCommand)
@@ -206,7 +185,7 @@ T1Prefix = os.path.splitext(args.t1_image)[0]
 if os.path.splitext(args.t1_image)[1] == '.gz':
     T1Prefix = os.path.splitext(T1Prefix)[0]
 
-t1RegistrationCommand = [animaPyramidalBMRegistration, "-r", os.path.join("Patients_Tensors", dwiPrefix + "_ADC.nrrd"),
+t1RegistrationCommand = [tools.animaPyramidalBMRegistration, "-r", os.path.join("Patients_Tensors", dwiPrefix + "_ADC.nrrd"),
                          "-m", T1Prefix + "_masked.nrrd", "-o", os.path.join(tmpFolder, "T1_reg_rig.nrrd"), "-O", os.path.join(tmpFolder, "T1_reg_rig_tr.txt"),
                          "-p", "4", "-l", "1", "--sp", "2", "-s", "0"]
 
@@ -217,48 +196,48 @@ else:
 
 call(t1RegistrationCommand)
 
-command = [animaTransformSerieXmlGenerator, "-i", os.path.join(tmpFolder, "T1_reg_rig_tr.txt"), "-i", os.path.join(tmpFolder, "Patient_aff_tr.txt"),
+command = [tools.animaTransformSerieXmlGenerator, "-i", os.path.join(tmpFolder, "T1_reg_rig_tr.txt"), "-i", os.path.join(tmpFolder, "Patient_aff_tr.txt"),
            "-i", os.path.join(tmpFolder, dwiPrefix + "_nl_tr.nrrd"), "-o", os.path.join(tmpFolder, "Patient_T1_nl_tr.xml")]
 call(command)
 
 # Process tracks: augmenting with patient and perform comparison
 for track in tracksLists:
     # augment tracks of the atlas with MCM patient data
-    propsExtractionCommand = [animaTracksMCMPropertiesExtraction, "-i", os.path.join(args.raw_tracts_folder, track + '.fds'),
+    propsExtractionCommand = [tools.animaTracksMCMPropertiesExtraction, "-i", os.path.join(args.raw_tracts_folder, track + '.fds'),
                               "-m", os.path.join('Transformed_Patients_MCM', dwiPrefix + "_MCM_avg_onAtlas.mcm"),
                               "-o", os.path.join('Patients_Augmented_Tracts', track + '_' + dwiPrefix + '_MCM_augmented_onAtlas.fds')]
     call(propsExtractionCommand)
 
     # Compare to controls list of augmented tracts
-    propsComparisonCommand = [animaPatientToGroupComparisonOnTracks, "-i", os.path.join('Patients_Augmented_Tracts', track + '_' + dwiPrefix + '_MCM_augmented_onAtlas.fds'),
+    propsComparisonCommand = [tools.animaPatientToGroupComparisonOnTracks, "-i", os.path.join('Patients_Augmented_Tracts', track + '_' + dwiPrefix + '_MCM_augmented_onAtlas.fds'),
                               "-l", os.path.join(args.tracts_folder, "listData_" + track + ".txt"),
                               "-o", os.path.join(tmpFolder, track + '_' + dwiPrefix + '_PV.fds'),
                               "-a", os.path.join('Patients_Augmented_Tracts', track + '_' + dwiPrefix + '_controls_avg.fds')]
     call(propsComparisonCommand)
 
-    fdrCorrectionCommand = [animaFibersFDRCorrectPValues, "-i", os.path.join(tmpFolder, track + '_' + dwiPrefix + '_PV.fds'),
+    fdrCorrectionCommand = [tools.animaFibersFDRCorrectPValues, "-i", os.path.join(tmpFolder, track + '_' + dwiPrefix + '_PV.fds'),
                             "-o", os.path.join('Patients_Augmented_Tracts', track + '_' + dwiPrefix + '_FDR.fds'), "-q", "0.05"]
     call(fdrCorrectionCommand)
 
     # Bring back fibers into native image space
-    bringFibersBackCommand = [animaFibersApplyTransformSerie, "-i", os.path.join('Patients_Augmented_Tracts', track + '_' + dwiPrefix + '_MCM_augmented_onAtlas.fds'), "-I",
+    bringFibersBackCommand = [tools.animaFibersApplyTransformSerie, "-i", os.path.join('Patients_Augmented_Tracts', track + '_' + dwiPrefix + '_MCM_augmented_onAtlas.fds'), "-I",
                               "-t", os.path.join(tmpFolder, "Patient_T1_nl_tr.xml"), "-o", os.path.join('Patients_Augmented_Tracts', track + '_' + dwiPrefix + '_MCM_augmented.fds')]
     call(bringFibersBackCommand)
 
-    bringFibersBackCommand = [animaFibersApplyTransformSerie, "-i", os.path.join('Patients_Augmented_Tracts', track + '_' + dwiPrefix + '_FDR.fds'), "-I",
+    bringFibersBackCommand = [tools.animaFibersApplyTransformSerie, "-i", os.path.join('Patients_Augmented_Tracts', track + '_' + dwiPrefix + '_FDR.fds'), "-I",
                               "-t", os.path.join(tmpFolder, "Patient_T1_nl_tr.xml"), "-o", os.path.join('Patients_Augmented_Tracts', track + '_' + dwiPrefix + '_FDR.fds')]
     call(bringFibersBackCommand)
 
-    bringFibersBackCommand = [animaFibersApplyTransformSerie, "-i", os.path.join('Patients_Augmented_Tracts', track + '_' + dwiPrefix + '_AC.fds'), "-I",
+    bringFibersBackCommand = [tools.animaFibersApplyTransformSerie, "-i", os.path.join('Patients_Augmented_Tracts', track + '_' + dwiPrefix + '_AC.fds'), "-I",
                               "-t", os.path.join(tmpFolder, "Patient_T1_nl_tr.xml"), "-o", os.path.join('Patients_Augmented_Tracts', track + '_' + dwiPrefix + '_AC.fds')]
     call(bringFibersBackCommand)
 
-    bringFibersBackCommand = [animaFibersApplyTransformSerie, "-i", os.path.join('Patients_Augmented_Tracts', track + '_' + dwiPrefix + '_controls_avg.fds'), "-I",
+    bringFibersBackCommand = [tools.animaFibersApplyTransformSerie, "-i", os.path.join('Patients_Augmented_Tracts', track + '_' + dwiPrefix + '_controls_avg.fds'), "-I",
                               "-t", os.path.join(tmpFolder, "Patient_T1_nl_tr.xml"), "-o", os.path.join('Patients_Augmented_Tracts', track + '_' + dwiPrefix + '_controls_avg.fds')]
     call(bringFibersBackCommand)
 
     # Compute final scores CSV
-    command = [animaFibersDiseaseScores, "-i", os.path.join('Patients_Augmented_Tracts', track + '_' + dwiPrefix + '_FDR.fds'),
+    command = [tools.animaFibersDiseaseScores, "-i", os.path.join('Patients_Augmented_Tracts', track + '_' + dwiPrefix + '_FDR.fds'),
                "-o", os.path.join('Patients_Disease_Scores', track + '_' + dwiPrefix + '.csv'), "-p", "6"]
     call(command)
 
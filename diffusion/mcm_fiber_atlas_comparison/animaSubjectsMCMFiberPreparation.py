@@ -3,30 +3,19 @@
 import sys
 import argparse
 
-if sys.version_info[0] > 2:
-    import configparser as ConfParser
-else:
-    import ConfigParser as ConfParser
-
-import tempfile
 import glob
 import os
 import shutil
-import numpy as np
-import nibabel as nib
-from subprocess import call
 
-configFilePath = os.path.join(os.path.expanduser("~"), ".anima",  "config.txt")
-if not os.path.exists(configFilePath):
-    print('Please create a configuration file for Anima python scripts. Refer to the README')
-    quit()
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, os.pardir))
+from animaRuntime import config, execution, imageio, scratch, tools, voxelwise
+from animaRuntime.execution import call
+from animaRuntime.lazy import lazy_import
 
-configParser = ConfParser.RawConfigParser()
-configParser.read(configFilePath)
+np = lazy_import("numpy")
 
-animaDir = configParser.get("anima-scripts", 'anima')
-animaDataDir = configParser.get("anima-scripts", 'extra-data-root')
-animaScriptsDir = configParser.get("anima-scripts", 'anima-scripts-public-root')
+animaDataDir = config.extra_data_dir()
+animaScriptsDir = config.scripts_public_dir()
 
 # Argument parsing
 parser = argparse.ArgumentParser(
@@ -45,6 +34,9 @@ parser.add_argument('--type', type=str, default="tensor", help="Type of compartm
 parser.add_argument('--dw-without-reversed-b0', action='store_true', help="No reversed B0 provided with the DWIs")
 
 parser.add_argument('-b', '--bvalue-extract', type=int, default=0, help="Extract only a specific b-value for TractSeg (recommended for CUSP)")
+parser.add_argument('--scratch-root', type=str, default="",
+                    help="Folder where intermediates are written, e.g. a node-local disk (default: scratch-root in the "
+                         "config file, or the system temporary folder)")
 
 args = parser.parse_args()
 
@@ -62,13 +54,6 @@ args = parser.parse_args()
 #    - MCM: MCM estimations from DWI
 # And that's it we're done, after that the DTI atlas may be created
 
-animaComputeDTIScalarMaps = os.path.join(animaDir, "animaComputeDTIScalarMaps")
-animaPyramidalBMRegistration = os.path.join(animaDir, "animaPyramidalBMRegistration")
-animaTransformSerieXmlGenerator = os.path.join(animaDir, "animaTransformSerieXmlGenerator")
-animaApplyTransformSerie = os.path.join(animaDir, "animaApplyTransformSerie")
-animaImageArithmetic = os.path.join(animaDir, "animaImageArithmetic")
-animaThrImage = os.path.join(animaDir, "animaThrImage")
-
 os.makedirs('Tensors', exist_ok=True)
 os.makedirs('Preprocessed_DWI', exist_ok=True)
 os.makedirs('MCM', exist_ok=True)
@@ -107,6 +92,9 @@ for dataNum in range(args.start_subject, args.num_subjects + 1):
         dicomGlobFiles = glob.glob(os.path.join(args.dw_dicom_folders_prefix + "_" + str(dataNum), "*"))
         preprocCommand = preprocCommand + ["-D"] + dicomGlobFiles
 
+    if args.scratch_root != "":
+        preprocCommand = preprocCommand + ["--scratch-root", args.scratch_root]
+
     call(preprocCommand)
 
     # Move preprocessed results to output folders
@@ -142,18 +130,18 @@ for dataNum in range(args.start_subject, args.num_subjects + 1):
             os.remove(f)
 
     # Now transform subject FA to MNI reference FA template in tractseg
-    tmpFolder = tempfile.mkdtemp()
-    extractFACommand = [animaComputeDTIScalarMaps, "-i", os.path.join("Tensors", "DTI_" + str(dataNum) + ".nrrd"), "-f", os.path.join(tmpFolder,"Subject_FA.nrrd")]
+    tmpFolder = scratch.make_temp_dir(args.scratch_root)
+    extractFACommand = [tools.animaComputeDTIScalarMaps, "-i", os.path.join("Tensors", "DTI_" + str(dataNum) + ".nrrd"), "-f", os.path.join(tmpFolder,"Subject_FA.nrrd")]
     call(extractFACommand)
 
-    regFACommand = [animaPyramidalBMRegistration, "-r", tractsegFATemplate, "-m", os.path.join(tmpFolder,"Subject_FA.nrrd"), "-o", os.path.join(tmpFolder,"Subject_FA_OnMNI.nrrd"),
+    regFACommand = [tools.animaPyramidalBMRegistration, "-r", tractsegFATemplate, "-m", os.path.join(tmpFolder,"Subject_FA.nrrd"), "-o", os.path.join(tmpFolder,"Subject_FA_OnMNI.nrrd"),
                     "-O", os.path.join(tmpFolder,"Subject_FA_OnMNI_tr.txt"), "-s", "0"]
     call(regFACommand)
 
-    trsfSerieGenCommand = [animaTransformSerieXmlGenerator, "-i", os.path.join(tmpFolder,"Subject_FA_OnMNI_tr.txt"), "-o", os.path.join(tmpFolder,"Subject_FA_OnMNI_tr.xml")]
+    trsfSerieGenCommand = [tools.animaTransformSerieXmlGenerator, "-i", os.path.join(tmpFolder,"Subject_FA_OnMNI_tr.txt"), "-o", os.path.join(tmpFolder,"Subject_FA_OnMNI_tr.xml")]
     call(trsfSerieGenCommand)
 
-    applyTrsfCommand = [animaApplyTransformSerie, "-i", os.path.join("Preprocessed_DWI","DWI_" + str(dataNum) + ".nrrd"), "-t", os.path.join(tmpFolder,"Subject_FA_OnMNI_tr.xml"),
+    applyTrsfCommand = [tools.animaApplyTransformSerie, "-i", os.path.join("Preprocessed_DWI","DWI_" + str(dataNum) + ".nrrd"), "-t", os.path.join(tmpFolder,"Subject_FA_OnMNI_tr.xml"),
                         "-g", tractsegFATemplate, "-o", os.path.join(tmpFolder, "DWI_MNI.nii.gz"), "--grad", os.path.join("Preprocessed_DWI","DWI_" + str(dataNum) + ".bvec"),
                         "-O", os.path.join(tmpFolder, "DWI_MNI.bvec")]
     call(applyTrsfCommand)
@@ -164,7 +152,7 @@ for dataNum in range(args.start_subject, args.num_subjects + 1):
     tmpData[1] *= -1
     np.savetxt(os.path.join(tmpFolder, "DWI_MNI.bvec"), tmpData)
 
-    applyTrsfCommand = [animaApplyTransformSerie, "-i", os.path.join("Preprocessed_DWI", "DWI_BrainMask_" + str(dataNum) + ".nrrd"),
+    applyTrsfCommand = [tools.animaApplyTransformSerie, "-i", os.path.join("Preprocessed_DWI", "DWI_BrainMask_" + str(dataNum) + ".nrrd"),
                         "-t", os.path.join(tmpFolder, "Subject_FA_OnMNI_tr.xml"), "-g", tractsegFATemplate,
                         "-o", os.path.join(tmpFolder, "DWI_MNI_brainMask.nii.gz"), "-n", "nearest"]
     call(applyTrsfCommand)
@@ -174,7 +162,6 @@ for dataNum in range(args.start_subject, args.num_subjects + 1):
     bvecTS = os.path.join(tmpFolder, "DWI_MNI.bvec")
     dwiTS = os.path.join(tmpFolder, "DWI_MNI.nii.gz")
     if args.bvalue_extract > 0:
-        img = nib.load(dwiTS)
         bvals = np.loadtxt(bvalTS)
         bvecs = np.loadtxt(bvecTS)
         div5ShellValue = int(args.bvalue_extract/5)
@@ -186,11 +173,12 @@ for dataNum in range(args.start_subject, args.num_subjects + 1):
         indexesValues = np.where((bvals <= upperShellValue) * (bvals >= lowerShellValue) | (bvals == 0))[0]
         bvals = bvals[indexesValues]
         bvecs = bvecs[:, indexesValues]
-        data_crop = img.get_data()[:, :, :, indexesValues]
-        img_crop = nib.Nifti1Image(data_crop, img.affine, img.header)
         np.savetxt(os.path.join(tmpFolder, "DWI_MNI_crop.bval"), bvals)
         np.savetxt(os.path.join(tmpFolder, "DWI_MNI_crop.bvec"), bvecs)
-        nib.save(img_crop, os.path.join(tmpFolder, "DWI_MNI_crop.nii.gz"))
+        # Streams the selected volumes without loading the whole DWI
+        execution.run("extractVolumes", lambda: imageio.extract_volumes(dwiTS, os.path.join(tmpFolder, "DWI_MNI_crop.nii.gz"),
+                                                                        [int(i) for i in indexesValues]),
+                      [dwiTS], [os.path.join(tmpFolder, "DWI_MNI_crop.nii.gz")])
 
         bvalTS = os.path.join(tmpFolder, "DWI_MNI_crop.bval")
         bvecTS = os.path.join(tmpFolder, "DWI_MNI_crop.bvec")
@@ -202,20 +190,14 @@ for dataNum in range(args.start_subject, args.num_subjects + 1):
     call(tractsegCommand)
 
     for track in tracksLists:
-        # Merge begin and end into a single label image
-        labelsMergeCommand = [animaImageArithmetic, "-i", os.path.join(tmpFolder, "endings_segmentations", track + "_e.nii.gz"), "-M", "2",
-                              "-a", os.path.join(tmpFolder, "endings_segmentations", track + "_b.nii.gz"), "-o", os.path.join(tmpFolder, "endings_segmentations", track + ".nrrd")]
-        call(labelsMergeCommand)
-
-        labelsThrCommand = [animaThrImage, "-i", os.path.join(tmpFolder, "endings_segmentations", track + ".nrrd"), "-t", "2.1", "-o", os.path.join(tmpFolder, "tmp.nrrd")]
-        call(labelsThrCommand)
-
-        labelFinalizeCommand = [animaImageArithmetic, "-i", os.path.join(tmpFolder, "endings_segmentations", track + ".nrrd"), "-s", os.path.join(tmpFolder, "tmp.nrrd"),
-                               "-o", os.path.join(tmpFolder, "endings_segmentations", track + ".nrrd")]
-        call(labelFinalizeCommand)
+        # Merge begin and end into a single label image: 1 for begin, 2 for end (and overlap)
+        endings = voxelwise.image(os.path.join(tmpFolder, "endings_segmentations", track + "_e.nii.gz")) * 2 + \
+            voxelwise.image(os.path.join(tmpFolder, "endings_segmentations", track + "_b.nii.gz"))
+        voxelwise.apply(endings - voxelwise.threshold(endings, 2.1),
+                        os.path.join(tmpFolder, "endings_segmentations", track + ".nrrd"), type="uint8")
 
         # Now move back to native space
-        applyTrsfCommand = [animaApplyTransformSerie, "-i", os.path.join(tmpFolder, "endings_segmentations", track + ".nrrd"), "-t",
+        applyTrsfCommand = [tools.animaApplyTransformSerie, "-i", os.path.join(tmpFolder, "endings_segmentations", track + ".nrrd"), "-t",
                             os.path.join(tmpFolder, "Subject_FA_OnMNI_tr.xml"), "-g", os.path.join("Preprocessed_DWI","DWI_" + str(dataNum) + ".nrrd"),
                             "-o", os.path.join("Tracts_Masks", track + "_" + str(dataNum) + ".nrrd"), "-I", "-n", "nearest"]
         call(applyTrsfCommand)
@@ -3,26 +3,14 @@
 import argparse
 import sys
 
-if sys.version_info[0] > 2:
-    import configparser as ConfParser
-else:
-    import ConfigParser as ConfParser
-
 import os
 import shutil
-import tempfile
-from subprocess import call, check_output
-
-configFilePath = os.path.join(os.path.expanduser("~"), ".anima",  "config.txt")
-if not os.path.exists(configFilePath):
-    print('Please create a configuration file for Anima python scripts. Refer to the README')
-    quit()
 
-configParser = ConfParser.RawConfigParser()
-configParser.read(configFilePath)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+from animaRuntime import config, execution, images, scratch, tools
+from animaRuntime.execution import call
 
-animaDir = configParser.get("anima-scripts", 'anima')
-animaScriptsDir = configParser.get("anima-scripts", 'anima-scripts-public-root')
+animaScriptsDir = config.scripts_public_dir()
 
 parser = argparse.ArgumentParser(
     prog='animaMSExamPreparation',
@@ -36,15 +24,21 @@ parser.add_argument('-t', '--t1', required=True, help='Path to the MS patient T1
 parser.add_argument('-g', '--t1-gd', required=True, help='Path to the MS patient T1-Gd image to register')
 parser.add_argument('-T', '--t2', default="", help='Path to the MS patient T2 image to register')
 
+parser.add_argument('--scratch-root', type=str, default="",
+                    help="Folder where intermediates are written, e.g. a node-local disk (default: scratch-root in the "
+                         "config file, or the system temporary folder)")
+parser.add_argument('--plan', type=str, nargs='*', metavar='TRACE',
+                    help="Print the step graph and its critical path (timings from the given or recorded traces) "
+                         "instead of running the pipeline")
+
 args = parser.parse_args()
-tmpFolder = tempfile.mkdtemp()
+
+if args.plan is not None:
+    execution.enable_plan(args.plan)
+
+tmpFolder = scratch.make_temp_dir(args.scratch_root)
 
 # Anima commands
-animaPyramidalBMRegistration = os.path.join(animaDir, "animaPyramidalBMRegistration")
-animaMaskImage = os.path.join(animaDir, "animaMaskImage")
-animaNLMeans = os.path.join(animaDir, "animaNLMeans")
-animaN4BiasCorrection = os.path.join(animaDir, "animaN4BiasCorrection")
-animaConvertImage = os.path.join(animaDir, "animaConvertImage")
 animaBrainExtractionScript = os.path.join(animaScriptsDir, "brain_extraction", "animaAtlasBasedBrainExtraction.py")
 
 refImage = args.reference
@@ -53,18 +47,12 @@ if args.t2 != "":
     listImages.append(args.t2)
 
 brainExtractionCommand = ["python", animaBrainExtractionScript, "-i", refImage, "-S"]
+if args.scratch_root != "":
+    brainExtractionCommand += ["--scratch-root", args.scratch_root]
 call(brainExtractionCommand)
 
 # Decide on whether to use large image setting or small image setting
-command = [animaConvertImage, "-i", refImage, "-I"]
-convert_output = check_output(command, universal_newlines=True)
-size_info = convert_output.split('\n')[1].split('[')[1].split(']')[0]
-large_image = False
-for i in range(0, 3):
-    size_tmp = int(size_info.split(', ')[i])
-    if size_tmp >= 350:
-        large_image = True
-        break
+large_image = any(size >= 350 for size in images.image_size(refImage)[:3])
 
 pyramidOptions = ["-p", "4", "-l", "1"]
 if large_image:
@@ -83,20 +71,20 @@ for i in range(0, len(listImages)):
         inputPrefix = os.path.splitext(inputPrefix)[0]
 
     registeredDataFile = inputPrefix + "_registered.nrrd"
-    rigidRegistrationCommand = [animaPyramidalBMRegistration, "-r", refImage, "-m", listImages[i], "-o",
+    rigidRegistrationCommand = [tools.animaPyramidalBMRegistration, "-r", refImage, "-m", listImages[i], "-o",
                                 registeredDataFile] + pyramidOptions
     call(rigidRegistrationCommand)
 
     unbiasedSecondImage = os.path.join(tmpFolder, "SecondImage_unbiased.nrrd")
-    biasCorrectionCommand = [animaN4BiasCorrection, "-i", registeredDataFile, "-o", unbiasedSecondImage, "-B", "0.3"]
+    biasCorrectionCommand = [tools.animaN4BiasCorrection, "-i", registeredDataFile, "-o", unbiasedSecondImage, "-B", "0.3"]
     call(biasCorrectionCommand)
 
     nlmSecondImage = os.path.join(tmpFolder, "SecondImage_unbiased_nlm.nrrd")
-    nlmCommand = [animaNLMeans, "-i", unbiasedSecondImage, "-o", nlmSecondImage, "-n", "3"]
+    nlmCommand = [tools.animaNLMeans, "-i", unbiasedSecondImage, "-o", nlmSecondImage, "-n", "3"]
     call(nlmCommand)
 
     outputPreprocessedFile = inputPrefix + "_preprocessed.nrrd"
-    secondMaskCommand = [animaMaskImage, "-i", nlmSecondImage, "-m", brainMask, "-o", outputPreprocessedFile]
+    secondMaskCommand = [tools.animaMaskImage, "-i", nlmSecondImage, "-m", brainMask, "-o", outputPreprocessedFile]
     call(secondMaskCommand)
 
 shutil.rmtree(tmpFolder)
@@ -3,25 +3,12 @@
 import argparse
 import sys
 
-if sys.version_info[0] > 2:
-    import configparser as ConfParser
-else:
-    import ConfigParser as ConfParser
-
 import os
 import shutil
-import tempfile
-from subprocess import call, check_output
-
-configFilePath = os.path.join(os.path.expanduser("~"), ".anima",  "config.txt")
-if not os.path.exists(configFilePath):
-    print('Please create a configuration file for Anima python scripts. Refer to the README')
-    quit()
-
-configParser = ConfParser.RawConfigParser()
-configParser.read(configFilePath)
 
-animaDir = configParser.get("anima-scripts", 'anima')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+from animaRuntime import execution, images, scratch, tools
+from animaRuntime.execution import call
 
 parser = argparse.ArgumentParser(
     prog='animaMSExamPreparationMSSEG2016',
@@ -36,31 +23,27 @@ parser.add_argument('-g', '--t1-gd', required=True, help='Path to the MS patient
 parser.add_argument('-T', '--t2', required=True, help='Path to the MS patient T2 image to register')
 parser.add_argument('-p', '--pd', required=True, help='Path to the MS patient PD image to register')
 
+parser.add_argument('--scratch-root', type=str, default="",
+                    help="Folder where intermediates are written, e.g. a node-local disk (default: scratch-root in the "
+                         "config file, or the system temporary folder)")
+parser.add_argument('--plan', type=str, nargs='*', metavar='TRACE',
+                    help="Print the step graph and its critical path (timings from the given or recorded traces) "
+                         "instead of running the pipeline")
+
 args = parser.parse_args()
-tmpFolder = tempfile.mkdtemp()
+
+if args.plan is not None:
+    execution.enable_plan(args.plan)
+
+tmpFolder = scratch.make_temp_dir(args.scratch_root)
 
 # Anima commands
-animaPyramidalBMRegistration = os.path.join(animaDir, "animaPyramidalBMRegistration")
-animaTransformSerieXmlGenerator = os.path.join(animaDir, "animaTransformSerieXmlGenerator")
-animaApplyTransformSerie = os.path.join(animaDir, "animaApplyTransformSerie")
-animaMaskImage = os.path.join(animaDir, "animaMaskImage")
-animaNLMeans = os.path.join(animaDir, "animaNLMeans")
-animaN4BiasCorrection = os.path.join(animaDir, "animaN4BiasCorrection")
-animaConvertImage = os.path.join(animaDir, "animaConvertImage")
 
 refImage = args.flair
 listImages = [args.flair, args.t1, args.t1_gd, args.t2, args.pd]
 
 # Decide on whether to use large image setting or small image setting
-command = [animaConvertImage, "-i", refImage, "-I"]
-convert_output = check_output(command, universal_newlines=True)
-size_info = convert_output.split('\n')[1].split('[')[1].split(']')[0]
-large_image = False
-for i in range(0, 3):
-    size_tmp = int(size_info.split(', ')[i])
-    if size_tmp >= 350:
-        large_image = True
-        break
+large_image = any(size >= 350 for size in images.image_size(refImage)[:3])
 
 pyramidOptions = ["-p", "4", "-l", "1"]
 if large_image:
@@ -71,16 +54,16 @@ if os.path.splitext(refImage)[1] == '.gz':
     refImagePrefix = os.path.splitext(refImagePrefix)[0]
 
 # Register brain mask on reference
-rigidRegistrationCommand = [animaPyramidalBMRegistration, "-r", refImage, "-m", args.t1, "-o",
+rigidRegistrationCommand = [tools.animaPyramidalBMRegistration, "-r", refImage, "-m", args.t1, "-o",
                             os.path.join(tmpFolder, "t1Reg.nrrd"), "-O", os.path.join(tmpFolder, "t1Reg_tr.txt")] + pyramidOptions
 call(rigidRegistrationCommand)
 
-trsfGenCommand = [animaTransformSerieXmlGenerator, "-i", os.path.join(tmpFolder, "t1Reg_tr.txt"),
+trsfGenCommand = [tools.animaTransformSerieXmlGenerator, "-i", os.path.join(tmpFolder, "t1Reg_tr.txt"),
                   "-o", os.path.join(tmpFolder, "t1Reg_tr.xml")]
 call(trsfGenCommand)
 
 brainMask = refImagePrefix + "_brainMask.nii.gz"
-maskTrsfCommand = [animaApplyTransformSerie, "-i", args.mask, "-t", os.path.join(tmpFolder, "t1Reg_tr.xml"),
+maskTrsfCommand = [tools.animaApplyTransformSerie, "-i", args.mask, "-t", os.path.join(tmpFolder, "t1Reg_tr.xml"),
                    "-g", refImage, "-o", brainMask, "-n", "nearest"]
 call(maskTrsfCommand)
 
@@ -91,7 +74,7 @@ for i in range(0, len(listImages)):
         inputPrefix = os.path.splitext(inputPrefix)[0]
 
     nlmSecondImage = os.path.join(tmpFolder, "SecondImage_" + str(i) + "_nlm.nrrd")
-    nlmCommand = [animaNLMeans, "-i", listImages[i], "-o", nlmSecondImage, "-n", "3"]
+    nlmCommand = [tools.animaNLMeans, "-i", listImages[i], "-o", nlmSecondImage, "-n", "3"]
     call(nlmCommand)
 
     registeredDataFile = nlmSecondImage
@@ -99,23 +82,23 @@ for i in range(0, len(listImages)):
         registeredDataFile = os.path.join(tmpFolder, "SecondImage_registered_" + str(i) + ".nrrd")
         registeredDataTrsf = os.path.join(tmpFolder, "SecondImage_registered_" + str(i) + "_tr.txt")
         registeredDataTrsfXml = os.path.join(tmpFolder, "SecondImage_registered_" + str(i) + "_tr.xml")
-        rigidRegistrationCommand = [animaPyramidalBMRegistration, "-r", refImage, "-m", nlmSecondImage, "-o",
+        rigidRegistrationCommand = [tools.animaPyramidalBMRegistration, "-r", refImage, "-m", nlmSecondImage, "-o",
                                     registeredDataFile, "-O", registeredDataTrsf] + pyramidOptions
         call(rigidRegistrationCommand)
 
-        trsfGenCommand = [animaTransformSerieXmlGenerator, "-i", registeredDataTrsf, "-o", registeredDataTrsfXml]
+        trsfGenCommand = [tools.animaTransformSerieXmlGenerator, "-i", registeredDataTrsf, "-o", registeredDataTrsfXml]
         call(trsfGenCommand)
 
-        imTrsfCommand = [animaApplyTransformSerie, "-i", nlmSecondImage, "-t", registeredDataTrsfXml,
+        imTrsfCommand = [tools.animaApplyTransformSerie, "-i", nlmSecondImage, "-t", registeredDataTrsfXml,
                            "-g", refImage, "-o", registeredDataFile, "-n", "sinc"]
         call(imTrsfCommand)
 
     maskedSecondImage = os.path.join(tmpFolder, "SecondImage_" + str(i) + "_masked.nrrd")
-    secondMaskCommand = [animaMaskImage, "-i", registeredDataFile, "-m", brainMask, "-o", maskedSecondImage]
+    secondMaskCommand = [tools.animaMaskImage, "-i", registeredDataFile, "-m", brainMask, "-o", maskedSecondImage]
     call(secondMaskCommand)
 
     outputPreprocessedFile = inputPrefix + "_preprocessed.nii.gz"
-    biasCorrectionCommand = [animaN4BiasCorrection, "-i", maskedSecondImage, "-o", outputPreprocessedFile]
+    biasCorrectionCommand = [tools.animaN4BiasCorrection, "-i", maskedSecondImage, "-o", outputPreprocessedFile]
     call(biasCorrectionCommand)
 
 shutil.rmtree(tmpFolder)
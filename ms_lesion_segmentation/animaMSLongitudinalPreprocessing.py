@@ -1,9 +1,9 @@
 import sys
 import os
-import configparser as ConfParser
 import argparse
-import subprocess
-import shutil
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+from animaRuntime import config, execution, tools, voxelwise
 
 # Data preprocessing for the Longitudinal Multipel Sclerosis Lesion Segmentation Challenge of MICCAI 2021.
 
@@ -47,40 +47,28 @@ parser.add_argument('-f', '--intermediate_folder', type=str, help="""Path where
                     intermediate files are deleted by default and kept if this option is given).
                     """)
 
+parser.add_argument('--plan', type=str, nargs='*', metavar='TRACE',
+                    help="Print the step graph and its critical path (timings from the given or recorded traces) "
+                         "instead of running the pipeline")
+
 args = parser.parse_args()
 
+if args.plan is not None:
+    execution.enable_plan(args.plan)
+
 patients = args.input
 templateFlair = args.template if args.template else None
 output = args.output
 intermediateFolder = args.intermediate_folder
 
-# The configuration file for anima is ~/.anima/config.txt (can be overridden with -a and -s arguments)
-configFilePath = os.path.join(os.path.expanduser("~"),'.anima', 'config.txt')
-
-# Open the configuration parser and exit if anima configuration cannot be loaded
-configParser = ConfParser.RawConfigParser()
-
-if os.path.exists(configFilePath):
-    configParser.read(configFilePath)
-else:
-    sys.exit('Please create a configuration file (~/.anima/config.txt) for Anima python scripts.')
-
-# Initialize anima directories
-animaDir = configParser.get("anima-scripts", 'anima')
-animaScriptsPublicDir = configParser.get("anima-scripts", 'anima-scripts-public-root')
-
-# Anima commands
+# Anima scripts (Anima executables are resolved through tools on first use)
+animaScriptsPublicDir = config.scripts_public_dir()
 animaBrainExtraction = os.path.join(animaScriptsPublicDir, "brain_extraction", "animaAtlasBasedBrainExtraction.py")
-animaN4BiasCorrection = os.path.join(animaDir, "animaN4BiasCorrection")
-animaNyulStandardization = os.path.join(animaDir, "animaNyulStandardization")
-animaThrImage = os.path.join(animaDir, "animaThrImage")
-animaMaskImage = os.path.join(animaDir, "animaMaskImage")
-animaImageArithmetic = os.path.join(animaDir, "animaImageArithmetic")
 
 # Calls a command, if there are errors: outputs them and exit
 def call(command):
     command = [str(arg) for arg in command]
-    status = subprocess.call(command)
+    status = execution.call(command)
     if status != 0:
         print(' '.join(command) + '\n')
         sys.exit('Command exited with status: ' + str(status))
@@ -124,12 +112,12 @@ for patientName in os.listdir(patients):
     maskUnion = os.path.join(patientOutput, 'brain_mask.nii.gz')
 
     # Compute the union of the masks of both time points
-    call([animaImageArithmetic, "-i", masks[0], "-a", masks[1], "-o", maskUnion])    # add the two masks
-    call([animaThrImage, "-i", maskUnion, "-t", "0.5", "-o", maskUnion])                  # threshold to get a binary mask
+    voxelwise.apply(voxelwise.threshold(voxelwise.image(masks[0]) + voxelwise.image(masks[1]), 0.5), maskUnion,
+                    type="uint8")
 
     # Remove intermediate masks
     for mask in masks:
-        os.remove(mask)
+        execution.remove(mask)
 
     # For both time points: mask, remove bias and normalize if necessary
     for flairName in flairs:
@@ -138,18 +126,18 @@ for patientName in os.listdir(patients):
         brain = os.path.join(patientOutput, flairName)
 
         # Mask original FLAIR images with the union mask
-        call([animaMaskImage, "-i", flair, "-m", maskUnion, "-o", brain])
+        call([tools.animaMaskImage, "-i", flair, "-m", maskUnion, "-o", brain])
 
         # Remove bias
-        call([animaN4BiasCorrection, "-i", brain, "-o", brain, "-B", "0.3"])
+        call([tools.animaN4BiasCorrection, "-i", brain, "-o", brain, "-B", "0.3"])
         
         if templateFlair:
             if os.path.exists(templateFlair):
                 # Normalize intensities with the given template
-                call([animaNyulStandardization, "-m", brain, "-r", templateFlair, "-o", brain])
+                call([tools.animaNyulStandardization, "-m", brain, "-r", templateFlair, "-o", brain])
             else:
                 print('Template file ' + templateFlair + ' not found, skipping normalization.')
     
     # Copy the ground truths to the output directory
     for imageName in groundTruths:
-        shutil.copyfile(os.path.join(patient, imageName), os.path.join(patientOutput, imageName))
+        execution.copy(os.path.join(patient, imageName), os.path.join(patientOutput, imageName))
@@ -5,29 +5,9 @@ import sys
 import argparse
 import os
 import stat
-import subprocess
 
-if sys.version_info[0] > 2:
-    import configparser as ConfParser
-else:
-    import ConfigParser as ConfParser
-
-configFilePath = os.path.join(os.path.expanduser("~"), ".anima",  "config.txt")
-if not os.path.exists(configFilePath):
-    print('Please create a configuration file for Anima python scripts. Refer to the README')
-    quit()
-
-configParser = ConfParser.RawConfigParser()
-configParser.read(configFilePath)
-
-animaDir = configParser.get("anima-scripts", 'anima')
-animaPyramidalBMRegistration = os.path.join(animaDir, "animaPyramidalBMRegistration")
-animaDenseSVFBMRegistration = os.path.join(animaDir, "animaDenseSVFBMRegistration")
-animaTransformSerieXmlGenerator = os.path.join(animaDir, "animaTransformSerieXmlGenerator")
-animaApplyTransformSerie = os.path.join(animaDir, "animaApplyTransformSerie")
-animaConvertImage = os.path.join(animaDir, "animaConvertImage")
-animaConcatenateImages = os.path.join(animaDir, "animaConcatenateImages")
-animaMajorityLabelVoting = os.path.join(animaDir, "animaMajorityLabelVoting")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+from animaRuntime import jobs, tools
 
 # Argument parsing
 parser = argparse.ArgumentParser(description="Propagate and fuse segmentations from multiple atlases onto a list of subjects")
@@ -37,8 +17,11 @@ parser.add_argument('-a', '--anat-file', required=True, type=str, help='list of
 parser.add_argument('-s', '--seg-file', required=True, type=str, help='list of atlas label images (segmentations) (in txt file)')
 parser.add_argument('-o', '--out-dir', required=True, type=str, help='output directory')
 parser.add_argument('-c', '--num-cores', type=int, default=8, help='Number of cores to run on (default: 8)')
+parser.add_argument('--scheduler', type=str, default=jobs.default_scheduler(), choices=jobs.schedulers,
+                    help="Submit jobs to OAR or run them on this machine (default: oar, or scheduler in the config file)")
 
 args = parser.parse_args()
+jobs.set_scheduler(args.scheduler)
 
 images = [line.rstrip('\n') for line in open(args.image_file)]            
 N = len(images)
@@ -73,32 +56,31 @@ for i in range(0, N):
     imageBasename = os.path.basename(imagePrefix)
 
     nCoresPhysical = int(args.num_cores / 2)
+
+    # Short registrations are packed in array elements, walltime set from the durations of previous ones
+    numJobs, tasksPerJob, walltime = jobs.array_layout(outDir, "multi-atlas-registration", P, "01:59:00")
         
     filename = os.path.join(outDir, "regRun_" + imageBasename)
     myfile = open(filename,"w")
     myfile.write("#!/bin/bash\n")
     if args.num_cores<=16:
-        myfile.write("#OAR -l {hyperthreading=\'NO\'}/nodes=1/core=" + str(args.num_cores) + ",walltime=01:59:00\n")
-    myfile.write("#OAR -l {hyperthreading=\'YES\'}/nodes=1/core=" + str(nCoresPhysical) + ",walltime=01:59:00\n")
-    myfile.write("#OAR --array " + str(P) + "\n")
+        myfile.write("#OAR -l {hyperthreading=\'NO\'}/nodes=1/core=" + str(args.num_cores) + ",walltime=" + walltime + "\n")
+    myfile.write("#OAR -l {hyperthreading=\'YES\'}/nodes=1/core=" + str(nCoresPhysical) + ",walltime=" + walltime + "\n")
+    myfile.write("#OAR --array " + str(numJobs) + "\n")
     myfile.write("#OAR -O " + os.path.join(outDir, "out" , imageBasename) + ".%jobid%.output\n")
     myfile.write("#OAR -E " + os.path.join(outDir, "err" , imageBasename) + ".%jobid%.error\n")
     myfile.write("anats=(" + " ".join(anats) + ")\n")
     myfile.write("segs=(" + " ".join(segs) + ")\n")            
-    myfile.write(animaPyramidalBMRegistration + " -m ${anats[$(($OAR_ARRAY_INDEX-1))]} -r " + image + " -o " + os.path.join(outDir, "registrations", imageBasename) + "_${OAR_ARRAY_INDEX}_aff.nrrd -O " + os.path.join(outDir, "registrations", imageBasename) + "_${OAR_ARRAY_INDEX}_aff_tr.txt --sp 3 --ot 2 -p 4 -l 0" + "\n" )
-    myfile.write(animaDenseSVFBMRegistration + " -m " + os.path.join(outDir, "registrations", imageBasename) + "_${OAR_ARRAY_INDEX}_aff.nrrd -r " + image + " -o " + os.path.join(outDir, "registrations", imageBasename) + "_${OAR_ARRAY_INDEX}_diffeo.nrrd -O " + os.path.join(outDir, "registrations", imageBasename) + "_${OAR_ARRAY_INDEX}_diffeo_tr.nrrd --sr 1 -p 3 -l 0" + "\n" )
-    myfile.write(animaTransformSerieXmlGenerator + " -i " + os.path.join(outDir, "registrations", imageBasename) + "_${OAR_ARRAY_INDEX}_aff_tr.txt -i " + os.path.join(outDir, "registrations", imageBasename) + "_${OAR_ARRAY_INDEX}_diffeo_tr.nrrd -o " + os.path.join(outDir, "registrations", imageBasename) + "_${OAR_ARRAY_INDEX}_tr.xml\n" )
-    myfile.write(animaApplyTransformSerie + " -i ${segs[$(($OAR_ARRAY_INDEX-1))]} -g " + image + " -t " + os.path.join(outDir, "registrations", imageBasename) + "_${OAR_ARRAY_INDEX}_tr.xml" + " -o " + os.path.join(outDir, "segmentations", imageBasename) + "_${OAR_ARRAY_INDEX}_seg.nrrd -n nearest\n" )
+    myfile.write(jobs.array_loop_start(1, P, tasksPerJob))
+    myfile.write(tools.animaPyramidalBMRegistration + " -m ${anats[$((${index}-1))]} -r " + image + " -o " + os.path.join(outDir, "registrations", imageBasename) + "_${index}_aff.nrrd -O " + os.path.join(outDir, "registrations", imageBasename) + "_${index}_aff_tr.txt --sp 3 --ot 2 -p 4 -l 0" + "\n" )
+    myfile.write(tools.animaDenseSVFBMRegistration + " -m " + os.path.join(outDir, "registrations", imageBasename) + "_${index}_aff.nrrd -r " + image + " -o " + os.path.join(outDir, "registrations", imageBasename) + "_${index}_diffeo.nrrd -O " + os.path.join(outDir, "registrations", imageBasename) + "_${index}_diffeo_tr.nrrd --sr 1 -p 3 -l 0" + "\n" )
+    myfile.write(tools.animaTransformSerieXmlGenerator + " -i " + os.path.join(outDir, "registrations", imageBasename) + "_${index}_aff_tr.txt -i " + os.path.join(outDir, "registrations", imageBasename) + "_${index}_diffeo_tr.nrrd -o " + os.path.join(outDir, "registrations", imageBasename) + "_${index}_tr.xml\n" )
+    myfile.write(tools.animaApplyTransformSerie + " -i ${segs[$((${index}-1))]} -g " + image + " -t " + os.path.join(outDir, "registrations", imageBasename) + "_${index}_tr.xml" + " -o " + os.path.join(outDir, "segmentations", imageBasename) + "_${index}_seg.nrrd -n nearest\n" )
+    myfile.write(jobs.array_loop_end(outDir, "multi-atlas-registration"))
     myfile.close()
 
     os.chmod(filename, stat.S_IRWXU)
-    oarRunCommand = ["oarsub","-n","reg-" + imageBasename,"-S", filename]
-    jobsIds = []
-    procStat = subprocess.run(oarRunCommand, stdout=subprocess.PIPE)
-    statLines = procStat.stdout.decode('utf-8').split('\n')
-    for statsLine in statLines:
-        if "OAR_JOB_ID" in statsLine:
-            jobsIds += [statsLine.split("=")[1]]
+    jobsIds = jobs.submit(filename, "reg-" + imageBasename, cores=args.num_cores)
     
     # Label fusion
     
@@ -116,13 +98,10 @@ for i in range(0, N):
     myfile2.write("#OAR -l {hyperthreading=\'YES\'}/nodes=1/core=" + str(nCoresPhysical) + ",walltime=01:59:00\n")
     myfile2.write("#OAR -O " + os.path.join(outDir, "out" , imageBasename) + "_fusion.%jobid%.output\n")
     myfile2.write("#OAR -E " + os.path.join(outDir, "err" , imageBasename) + "_fusion.%jobid%.error\n")
-    myfile2.write(animaMajorityLabelVoting + " -i " + listSeg + " -o " + os.path.join(outDir, imageBasename) + "_consensus_seg.nrrd \n")
+    myfile2.write(tools.animaMajorityLabelVoting + " -i " + listSeg + " -o " + os.path.join(outDir, imageBasename) + "_consensus_seg.nrrd \n")
     myfile2.close()
     
     os.chmod(filename2, stat.S_IRWXU)
-    oarFuseCommand = ["oarsub","-n","fusion_" + imageBasename,"-S", filename2]            
+    jobs.submit(filename2, "fusion_" + imageBasename, dependencies=jobsIds, cores=args.num_cores)
 
-    for jobId in jobsIds:
-        oarFuseCommand += ["-a",jobId]
-    
-    subprocess.call(oarFuseCommand, stdout=open(os.devnull, "w"))
+jobs.wait()
@@ -3,27 +3,15 @@
 
 import sys
 import argparse
-import tempfile
 import os
 import shutil
-from subprocess import call
 
-if sys.version_info[0] > 2:
-    import configparser as ConfParser
-else:
-    import ConfigParser as ConfParser
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+from animaRuntime import config, execution, scratch, tools
+from animaRuntime.execution import call
 
-configFilePath = os.path.join(os.path.expanduser("~"), ".anima",  "config.txt")
-if not os.path.exists(configFilePath):
-    print('Please create a configuration file for Anima python scripts. Refer to the README')
-    quit()
-
-configParser = ConfParser.RawConfigParser()
-configParser.read(configFilePath)
-
-animaDir = configParser.get("anima-scripts", 'anima')
-animaDataDir = configParser.get("anima-scripts", 'extra-data-root')
-animaScriptsDir = configParser.get("anima-scripts", 'anima-scripts-public-root')
+animaDataDir = config.extra_data_dir()
+animaScriptsDir = config.scripts_public_dir()
 
 # Argument parsing
 parser = argparse.ArgumentParser(
@@ -38,16 +26,23 @@ parser.add_argument('-o', '--mono-out', type=str, default="", help="Mono T2 esti
 parser.add_argument('-g', '--gmm-out', type=str, default="", help="Multi T2 weights estimation output")
 parser.add_argument('--no-brain-masking', action='store_true', help="Do not perform any brain masking, may be much longer")
 
+parser.add_argument('--scratch-root', type=str, default="",
+                    help="Folder where intermediates are written, e.g. a node-local disk (default: scratch-root in the "
+                         "config file, or the system temporary folder)")
+parser.add_argument('--plan', type=str, nargs='*', metavar='TRACE',
+                    help="Print the step graph and its critical path (timings from the given or recorded traces) "
+                         "instead of running the pipeline")
+
 args = parser.parse_args()
+
+if args.plan is not None:
+    execution.enable_plan(args.plan)
+
 if args.mono_out == "" and args.gmm_out == "":
     print('No output was specified, please specify at least one of mono-out, gmm-out')
     quit()
 
-tmpFolder = tempfile.mkdtemp()
-
-animaPyramidalBMRegistration = os.path.join(animaDir,"animaPyramidalBMRegistration")
-animaTransformSerieXmlGenerator = os.path.join(animaDir,"animaTransformSerieXmlGenerator")
-animaApplyTransformSerie = os.path.join(animaDir,"animaApplyTransformSerie")
+tmpFolder = scratch.make_temp_dir(args.scratch_root)
 
 inputImage = args.input
 inputImagePrefix = os.path.splitext(inputImage)[0]
@@ -61,20 +56,24 @@ maskImage = ""
 if args.no_brain_masking is False:
     outputMask = ""
     imageToMask = tmpInputImagePrefix + "_extract.nrrd"
-    firstVolumeExtractionCommand = [animaDir + "animaCropImage", "-i", inputImage, "-o", imageToMask, "-t", "0",
+    firstVolumeExtractionCommand = [tools.animaCropImage, "-i", inputImage, "-o", imageToMask, "-t", "0",
                                     "-T", "0"]
     call(firstVolumeExtractionCommand)
 
     if args.image_for_mask == "":
-        brainExtractionCommand = ["python", animaScriptsDir + "brain_extraction/animaAtlasBasedBrainExtraction.py",
+        brainExtractionCommand = ["python", os.path.join(animaScriptsDir, "brain_extraction", "animaAtlasBasedBrainExtraction.py"),
                                   "-i", imageToMask]
+        if args.scratch_root != "":
+            brainExtractionCommand += ["--scratch-root", args.scratch_root]
         call(brainExtractionCommand)
 
         outputMask = tmpInputImagePrefix + "_extract_brainMask.nrrd"
     else:
         imageToMask = tmpInputImagePrefix + "_extract.nrrd"
-        brainExtractionCommand = ["python", animaScriptsDir + "brain_extraction/animaAtlasBasedBrainExtraction.py",
+        brainExtractionCommand = ["python", os.path.join(animaScriptsDir, "brain_extraction", "animaAtlasBasedBrainExtraction.py"),
                                   "-i", args.image_for_mask]
+        if args.scratch_root != "":
+            brainExtractionCommand += ["--scratch-root", args.scratch_root]
         call(brainExtractionCommand)
 
         imagePrefix = os.path.splitext(args.image_for_mask)[0]
@@ -86,18 +85,18 @@ if args.no_brain_masking is False:
         # Now resample T1 on our reference volume
         tmpImagePrefix = os.path.join(tmpFolder, os.path.basename(imagePrefix))
 
-        imageRegistrationCommand = [animaPyramidalBMRegistration, "-r",
+        imageRegistrationCommand = [tools.animaPyramidalBMRegistration, "-r",
                                     imageToMask, "-m", args.image_for_mask, "-o",
                                     tmpImagePrefix + "_rig.nrrd", "-O", tmpImagePrefix + "_rig_tr.txt",
                                     "-p", "4", "-l", "1", "--sp", "2", "-I", "1"]
 
         call(imageRegistrationCommand)
 
-        command = [animaTransformSerieXmlGenerator, "-i", tmpImagePrefix + "_rig_tr.txt", "-o",
+        command = [tools.animaTransformSerieXmlGenerator, "-i", tmpImagePrefix + "_rig_tr.txt", "-o",
                    tmpImagePrefix + "_rig_tr.xml"]
         call(command)
 
-        resampleCommand = [animaApplyTransformSerie, "-i", outputMask, "-t",
+        resampleCommand = [tools.animaApplyTransformSerie, "-i", outputMask, "-t",
                            tmpImagePrefix + "_rig_tr.xml", "-o", os.path.join(tmpFolder, "generatorMask.nrrd"),
                            "-g", inputImage, "-n", "nearest"]
         call(resampleCommand)
@@ -109,11 +108,11 @@ if args.no_brain_masking is False:
 t1Image = ""
 # Resample T1 image if it is there
 if args.T1 != "":
-    xmlCommand = [animaDir + "animaTransformSerieXmlGenerator", "-i", os.path.join(animaDataDir, "id.txt"),
+    xmlCommand = [tools.animaTransformSerieXmlGenerator, "-i", os.path.join(animaDataDir, "id.txt"),
                   "-o", os.path.join(tmpFolder, "id.xml")]
     call(xmlCommand)
 
-    resampleCommand = [animaDir + "animaApplyTransformSerie", "-i", args.T1, "-o",
+    resampleCommand = [tools.animaApplyTransformSerie, "-i", args.T1, "-o",
                        os.path.join(tmpFolder, "t1Resampled.nrrd"), "-t", os.path.join(tmpFolder, "id.xml"),
                        "-g", inputImage]
     call(resampleCommand)
@@ -125,7 +124,7 @@ if args.mono_out != "":
     if os.path.splitext(args.mono_out)[1] == '.gz':
         outPrefix = os.path.splitext(outPrefix)[0]
 
-    monoT2Command = [animaDir + "animaT2EPGRelaxometryEstimation", "-i", inputImage, "-o", args.mono_out, "--tr", str(args.tr_value),
+    monoT2Command = [tools.animaT2EPGRelaxometryEstimation, "-i", inputImage, "-o", args.mono_out, "--tr", str(args.tr_value),
                      "-e", str(args.echo_spacing), "--out-b1", outPrefix + "_B1.nrrd", "-O", outPrefix + "_M0.nrrd"]
 
     if maskImage != "":
@@ -139,7 +138,7 @@ if args.mono_out != "":
 
 # Multi T2 estimation
 if args.gmm_out != "":
-    multiT2Command = [animaDir + "animaGMMT2RelaxometryEstimation", "-i", inputImage, "-e", str(args.echo_spacing)]
+    multiT2Command = [tools.animaGMMT2RelaxometryEstimation, "-i", inputImage, "-e", str(args.echo_spacing)]
 
     outPrefix = os.path.splitext(args.gmm_out)[0]
     if os.path.splitext(args.gmm_out)[1] == '.gz':
@@ -158,7 +157,7 @@ if args.gmm_out != "":
     call(multiT2Command)
 
     if args.gmm_out != "":
-        collapseCommand = [animaDir + "animaCollapseImage", "-i", args.gmm_out, "-o", args.gmm_out]
+        collapseCommand = [tools.animaCollapseImage, "-i", args.gmm_out, "-o", args.gmm_out]
         call(collapseCommand)
 
 shutil.rmtree(tmpFolder)